@@ -1,2 +1,4 @@
 from .info import *
 from .config import *
+from .job import *
+from .channel import *
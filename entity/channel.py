@@ -0,0 +1,88 @@
+import logging
+import os
+from typing import Mapping, Optional
+
+from exceptions import ChannelNotFoundException
+from utils import FileUtils
+from .config import RoomConfig
+from .utils import _cached
+
+logger = logging.getLogger('bililive-uploader')
+__all__ = ['ChannelRegistry']
+
+CHANNEL_PATH = './resources/channel.json'
+
+
+def _channel(channel: str) -> Optional[tuple[str, str]]:
+    parts = tuple(channel.split()) if isinstance(channel, str) else tuple(channel or ())
+    return parts if len(parts) == 2 else None
+
+
+def _tidIndex(channels: list) -> dict[tuple[str, str], int]:
+    return {(main['name'], sub['name']): sub['tid']
+            for main in channels for sub in main.get('sub', []) if 'tid' in sub}
+
+
+def _live2videoIndex(areas: list) -> dict[tuple[str, Optional[str]], Optional[tuple[str, str]]]:
+    """ {(live parent area, live child area or None for the whole parent area): video channel} """
+    index = {}
+    for parent_area in areas:
+        if parent_area.get('channel'):
+            index[(parent_area['name'], None)] = _channel(parent_area['channel'])
+        for child_area in parent_area.get('sub') or []:
+            index[(parent_area['name'], child_area.get('name'))] = _channel(child_area.get('channel'))
+    return index
+
+
+class ChannelRegistry:
+    """ video channel tids and the live area -> video channel map, reloaded when the files change
+
+    Attributes:
+        channel_path: channel.json路径
+        live2video_path: live2video.json路径
+    """
+    channel_path: str
+    live2video_path: str
+
+    def __init__(self, channel_path: str, live2video_path: str):
+        self.channel_path = channel_path
+        self.live2video_path = live2video_path
+
+    @classmethod
+    def init(cls, work_dir: str) -> 'ChannelRegistry':
+        """ channel.json shipped with the bot, live2video.json copied to the work dir """
+        return cls(CHANNEL_PATH, os.path.join(work_dir, 'resources', 'live2video.json'))
+
+    def tid(self, parent_area: str, child_area: str) -> int:
+        """ get video channel tid
+
+        :exception ChannelNotFoundException
+        """
+        tid = _cached(self.channel_path, _tidIndex, 'tid', FileUtils.readJson).get((parent_area, child_area))
+        if tid is None:
+            raise ChannelNotFoundException('Cannot find channel in channel.json.', parent_area, child_area)
+        return tid
+
+    def video_channel(self, parent_area: str, child_area: str) -> Optional[tuple[str, str]]:
+        """ video channel of a live area, a channel set for the whole parent area comes first """
+        index = _cached(self.live2video_path, _live2videoIndex, 'live2video', FileUtils.readJson)
+        return index.get((parent_area, None)) or index.get((parent_area, child_area))
+
+    def validate(self, rooms: Mapping[int, RoomConfig]) -> list[str]:
+        """ find channels in room-config.yml and live2video.json that have no tid
+
+        :return: problems found
+        """
+        tids = _cached(self.channel_path, _tidIndex, 'tid', FileUtils.readJson)
+        problems = []
+        for (parent_area, child_area), channel in \
+                _cached(self.live2video_path, _live2videoIndex, 'live2video', FileUtils.readJson).items():
+            if channel not in tids:
+                problems.append(f'live2video.json: {parent_area} {child_area or ""} -> {channel}')
+        for room_id, room in rooms.items():
+            channels = [('channel', room.channel)] + \
+                       [(f'conditions/{condition.item}', condition.channel) for condition in room.conditions]
+            for where, channel in channels:
+                if channel and channel not in tids:
+                    problems.append(f'room-config.yml: room {room_id} {where} -> {channel}')
+        return problems
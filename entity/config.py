@@ -2,7 +2,8 @@ import os.path
 import functools
 import re
 from dataclasses import dataclass
-from typing import Optional
+from types import MappingProxyType
+from typing import Mapping, Optional, Union
 import logging
 
 from exceptions import *
@@ -10,10 +11,54 @@ from bilibili_api import Credential
 
 from utils import FileUtils
 from .info import LiveInfo
-from .utils import _getValue, _setChannel
+from .utils import _getValue, _setChannel, _cached
 
 logger = logging.getLogger('bililive-uploader')
-__all__ = ['BotConfig', 'RoomConfig']
+__all__ = ['BotConfig', 'RoomConfig', 'DanmakuConfig', 'EncodingProfile']
+
+
+@dataclass
+class EncodingProfile:
+    """ ffmpeg settings used when burning danmaku into videos
+
+    Attributes:
+        codec: 视频编码器
+        preset: 编码预设
+        crf: 质量(CRF), 设置bitrate时忽略
+        bitrate: 视频码率, 例如6M
+        tune: 编码器tune
+        threads: 线程数, 0为使用ffmpeg-threads
+        container: 输出格式(flv/mp4), mp4会启用faststart
+        audio_copy: 是否直接复制音频流
+        max_height: 最大高度, 超过时等比缩小, 0为不缩放
+    """
+    codec: str
+    preset: str
+    crf: int
+    bitrate: str
+    tune: str
+    threads: int
+    container: str
+    audio_copy: bool
+    max_height: int
+
+    extension = property(lambda self: '.' + self.container)
+
+    def __init__(self, config: dict, base: 'EncodingProfile' = None):
+        """ unset keys are taken from base, or defaults when there is no base """
+        config = {k: v for k, v in config.items() if v is not None}
+        get_value = functools.partial(_getValue, data=config)
+        base = base or self
+        self.codec = get_value('codec', getattr(base, 'codec', 'libx264'))
+        self.preset = get_value('preset', getattr(base, 'preset', 'medium'))
+        self.crf = int(get_value('crf', getattr(base, 'crf', 23)))
+        self.bitrate = str(get_value('bitrate', getattr(base, 'bitrate', '')))
+        self.tune = get_value('tune', getattr(base, 'tune', ''))
+        self.threads = int(get_value('threads', getattr(base, 'threads', 0)))
+        self.container = get_value('container', getattr(base, 'container', 'flv')).lower()
+        self.audio_copy = get_value('audio-copy', getattr(base, 'audio_copy', True))
+        self.max_height = int(get_value('max-height', getattr(base, 'max_height', 0)))
+        assert self.container in ('flv', 'mp4'), f'Unsupported container: {self.container}'
 
 
 @dataclass
@@ -25,32 +70,73 @@ class BotConfig:
         rec_dir: B站录播姬工作目录
         docker: 是否使用docker
         workers: 线程数
+        concurrency: 同时运行的ffmpeg数量, 0为根据CPU核心数自动设置
+        ffmpeg_threads: 每个ffmpeg使用的线程数, 0为自动设置
+        command_timeout: ffmpeg超时时间(秒), 0为不限制
         danmaku: 是否压制弹幕
+        incremental: 是否在录制时处理已完成的分段
+        parallel: 是否将长视频按关键帧切分后并行压制
+        min_danmaku: 压制弹幕所需的最少弹幕数, 不足时只转封装
+        smart_combine: 是否只压制有弹幕的时间段, 其余部分直接复制
+        remote: 是否交给worker(run.pyw --worker)处理
+        lease_seconds: worker租用处理任务的时长(秒), 到期未续租的任务重新排队
+        remote_token: 协调端与worker共用的令牌, worker的请求须携带, 未设置时读取环境变量BILILIVE_REMOTE_TOKEN
+        path_map: worker路径映射, {协调端路径前缀: 本机路径前缀}
         multipart: 是否多p
         delete: 是否上传后删除
         auto_upload: 是否自动上传
+        upload_concurrency: 同时上传数
+        upload_attempts: 上传最大尝试次数
+        retry_delay: 上传失败后首次重试间隔(秒), 之后指数增长
         min_time: 录播最短时长
         port: 录播bot监听端口
         webhooks: webhook发送url
+        webhook_concurrency: 每个webhook地址的同时请求数
+        webhook_attempts: webhook最大尝试次数
+        capture: 录播姬webhook记录文件(JSONL), 为空时不记录
         credential: B站凭据
+        session_store: 录制会话存储(sqlite/json)
+        profiles: 编码配置
+        profile: 默认编码配置名
     """
     work_dir: str
     rec_dir: str
     docker: bool
     workers: int
+    concurrency: int
+    ffmpeg_threads: int
+    command_timeout: int
     danmaku: bool
+    incremental: bool
+    parallel: bool
+    min_danmaku: int
+    smart_combine: bool
+    remote: bool
+    lease_seconds: int
+    remote_token: str
+    path_map: dict[str, str]
     multipart: bool
     delete: bool
     auto_upload: bool
+    upload_concurrency: int
+    upload_attempts: int
+    retry_delay: float
     min_time: int
     port: int
     webhooks: list
+    webhook_concurrency: int
+    webhook_attempts: int
+    capture: str
     credential: Credential
+    session_store: str
+    profiles: dict[str, EncodingProfile]
+    profile: str
 
     config_dir = property(lambda self: os.path.join(self.work_dir, 'config'))
 
-    def __init__(self, work_dir: str):
-        config = FileUtils.readYml(os.path.join(work_dir, 'config', 'bot-config.yml'))
+    def __init__(self, work_dir: str, config: dict = None):
+        if config is None:
+            config = FileUtils.readYml(os.path.join(work_dir, 'config', 'bot-config.yml'))
         get_value = functools.partial(_getValue, data=config)
 
         self.docker = get_value('bot/is-docker', False)
@@ -64,13 +150,40 @@ class BotConfig:
             self.port = get_value('bot/server/port', 8866)
 
         self.workers = get_value('bot/workers', 1)
+        self.concurrency = get_value('bot/process/concurrency', 0)
+        self.ffmpeg_threads = get_value('bot/process/ffmpeg-threads', 0)
+        self.command_timeout = get_value('bot/process/timeout', 0)
         self.danmaku = get_value('bot/process/danmaku', True)
+        self.incremental = get_value('bot/process/incremental', False)
+        self.parallel = get_value('bot/process/parallel', False)
+        min_danmaku = get_value('bot/process/min-danmaku', 1)
+        self.min_danmaku = 1 if min_danmaku is None else int(min_danmaku)
+        self.smart_combine = get_value('bot/process/smart-combine', False)
+        self.remote = get_value('bot/process/remote', False)
+        self.lease_seconds = get_value('bot/process/lease-seconds', 60) or 60
+        self.remote_token = str(get_value('bot/process/remote-token', '')
+                                or os.environ.get('BILILIVE_REMOTE_TOKEN', ''))
+        self.path_map = get_value('bot/worker/path-map', {}) or {}
+        self.profiles = {'default': EncodingProfile({})}
+        self.profiles.update({name: EncodingProfile(profile or {})
+                              for name, profile in (get_value('bot/process/profiles', {}) or {}).items()})
+        self.profile = get_value('bot/process/profile', 'default') or 'default'
+        if self.profile not in self.profiles:
+            raise ConfigNotCompletedException(f'bot/process/profiles/{self.profile}')
         self.multipart = get_value('bot/upload/multipart', False)
         self.delete = get_value('bot/upload/delete-after-upload', True)
         self.auto_upload = get_value('bot/upload/auto-upload', True)
+        self.upload_concurrency = get_value('bot/upload/concurrency', 1) or 1
+        self.upload_attempts = get_value('bot/upload/max-attempts', 5) or 5
+        self.retry_delay = get_value('bot/upload/retry-delay', 60) or 60
         self.min_time = eval(str(get_value('bot/upload/min-time', 0)))
 
-        self.webhooks = get_value('bot/server/webhooks', [])
+        self.webhooks = get_value('bot/server/webhooks', []) or []
+        self.webhook_concurrency = get_value('bot/server/webhook-concurrency', 2) or 2
+        self.webhook_attempts = get_value('bot/server/webhook-attempts', 5) or 5
+        capture = get_value('bot/server/capture', '')
+        self.capture = self.path2absolute(capture) if capture else ''
+        self.session_store = get_value('bot/storage/session-store', 'sqlite')
 
         if self.auto_upload:
             credential = get_value('account/credential')
@@ -78,6 +191,24 @@ class BotConfig:
         else:
             self.credential = Credential()
 
+    @classmethod
+    def load(cls, work_dir: str) -> 'BotConfig':
+        """ shared config, bot-config.yml is parsed again only after it changes, do not modify it """
+        path = os.path.join(work_dir, 'config', 'bot-config.yml')
+        return _cached(path, functools.partial(cls, work_dir), 'bot')
+
+    def encoding_profile(self, override=None) -> EncodingProfile:
+        """ get encoding profile
+
+        :param override: profile name, or a dict of settings on top of the profile named by its 'base' key
+        :return:
+        """
+        if isinstance(override, dict):
+            return EncodingProfile(override, base=self.encoding_profile(override.get('base')))
+        if override and override not in self.profiles:
+            logger.warning('Encoding profile %s not found, use %s instead.', override, self.profile)
+        return self.profiles.get(override or self.profile, self.profiles[self.profile])
+
     def path2absolute(self, path: str) -> str:
         """ convert relative path to absolute path """
         return os.path.join(self.work_dir, path)
@@ -90,13 +221,15 @@ class Condition:
     Attributes:
         item: 条件名称
         regexp: 正则表达式
+        pattern: 编译后的正则, 正则无效时为None
         tags: 此条件下的上传标签
         channel: 此条件下的上传频道
         process: 此条件是否需要处理
     """
     item: str
     regexp: str
-    tags: list[str]
+    pattern: Optional[re.Pattern]
+    tags: tuple[str, ...]
     channel = property(lambda self: self._channel, _setChannel)
     process: bool
 
@@ -106,11 +239,46 @@ class Condition:
         get_value = functools.partial(_getValue, data=config)
         self.item = get_value('item')
         self.regexp = str(get_value('regexp'))
+        try:
+            self.pattern = re.compile(self.regexp)
+        except re.error as e:
+            logger.error('Invalid regexp %s: %s', self.regexp, e)
+            self.pattern = None
         self.process = get_value('process', True)
-        self.tags = get_value('tags', '').split(',')
+        self.tags = tuple(get_value('tags', '').split(','))
         self.channel = config.get('channel', '')
 
 
+@dataclass
+class DanmakuConfig:
+    """ danmaku style for each room
+
+    Attributes:
+        font: 字体
+        fontsize: 字号
+        density: 同屏最大弹幕数, 0为不限制
+        duration: 滚动弹幕持续时间(秒)
+        fixed_duration: 顶部/底部弹幕持续时间(秒)
+        opacity: 不透明度(0-1)
+    """
+    font: str
+    fontsize: int
+    density: int
+    duration: float
+    fixed_duration: float
+    opacity: float
+
+    def __init__(self, config: dict):
+        # empty keys fall back to defaults
+        get_value = functools.partial(_getValue, data={k: v for k, v in config.items() if v is not None})
+        self.font = get_value('font', 'Microsoft YaHei')
+        self.fontsize = int(get_value('fontsize', 55))
+        self.density = int(get_value('density', 50))
+        self.duration = float(get_value('duration', 12))
+        self.fixed_duration = float(get_value('fixed-duration', 5))
+        self.opacity = float(get_value('opacity', 0.8))
+
+
 @dataclass
 class RoomConfig:
     """
@@ -123,14 +291,18 @@ class RoomConfig:
         channel: 上传频道
         tags: 上传标签
         conditions: 房间额外条件
+        danmaku: 弹幕样式
+        profile: 编码配置名, 或基于某个编码配置的覆盖项
     """
     id: int
     title: str
     description: str
     dynamic: str
     channel = property(lambda self: self._channel, _setChannel)
-    tags: list[str]
-    conditions: list[Condition]
+    tags: tuple[str, ...]
+    conditions: tuple[Condition, ...]
+    danmaku: DanmakuConfig
+    profile: Optional[Union[str, dict]]
 
     _channel: (str, str) = None
 
@@ -141,8 +313,10 @@ class RoomConfig:
         self.title = get_value('title', '{title}')
         self.description = get_value('description', '')
         self.dynamic = get_value('dynamic', '')
-        self.tags = get_value('tags', '').split(',')
-        self.conditions = [Condition(c) for c in get_value('conditions', [])]
+        self.tags = tuple(get_value('tags', '').split(','))
+        self.conditions = tuple(Condition(c) for c in get_value('conditions', []))
+        self.danmaku = DanmakuConfig(get_value('danmaku', {}) or {})
+        self.profile = config.get('profile')
         self.channel = get_value('channel', '')
 
     def __post_init__(self):
@@ -151,13 +325,19 @@ class RoomConfig:
 
     @classmethod
     def init(cls, work_dir: str, room_id: int, short_id: int = 0) -> Optional['RoomConfig']:
+        """ shared config of a room, room-config.yml is parsed again only after it changes, do not modify it """
+        rooms = cls.index(work_dir)
+        room = rooms.get(int(room_id)) or (rooms.get(int(short_id)) if short_id else None)
+        if room is None:
+            logger.warning('Unknown room: [id: %d] [short id: %d]', room_id, short_id)
+        return room
+
+    @classmethod
+    def index(cls, work_dir: str) -> Mapping[int, 'RoomConfig']:
+        """ {id in room-config.yml: room config} """
         path = os.path.join(work_dir, 'config', 'room-config.yml')
-        configs = FileUtils.readYml(path)
-        for room in configs['rooms']:
-            if int(room['id']) in (room_id, short_id):
-                return cls(room)
-        logger.warning('Unknown room: [id: %d] [short id: %d]', room_id, short_id)
-        return None
+        return _cached(path, lambda configs: MappingProxyType({int(room['id']): cls(room)
+                                                               for room in configs['rooms']}), 'room')
 
     def list_conditions(self, live_info: LiveInfo) -> list[Condition]:
         """ list proper conditions
@@ -167,8 +347,10 @@ class RoomConfig:
         """
         result = []
         for condition in self.conditions:
+            if condition.pattern is None:
+                continue
             try:
-                if re.search(pattern=condition.regexp, string=getattr(live_info, condition.item)):
+                if condition.pattern.search(str(getattr(live_info, condition.item))):
                     result.append(condition)
             except AttributeError as _:
                 logger.warning('Invalid condition: %s', condition.item)
@@ -1,7 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
 
-from utils import FileUtils
 from .utils import _setChannel
 
 __all__ = ['LiveInfo', 'UploadInfo']
@@ -39,10 +38,24 @@ class LiveInfo:
         self.child_area = event_data['AreaNameChild']
         self.anchor = event_data['Name']
 
-    def read_start_time(self, json_file: str, room_id: int):
-        """ read session start time from json file(time cache) """
-        data = FileUtils.readJson(json_file)
-        self.start_time = datetime.fromisoformat(data[str(room_id)])
+    def to_dict(self) -> dict:
+        """ serializable form, in the shape of recorder event data """
+        return {
+            'RoomId': self.room_id,
+            'ShortId': self.short_id,
+            'Title': self.title,
+            'SessionId': self.session_id,
+            'AreaNameParent': self.parent_area,
+            'AreaNameChild': self.child_area,
+            'Name': self.anchor,
+            'StartTime': self.start_time.isoformat() if getattr(self, 'start_time', None) else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'LiveInfo':
+        live_info = cls(data)
+        live_info.start_time = datetime.fromisoformat(data['StartTime']) if data.get('StartTime') else None
+        return live_info
 
     def fill_module_string(self, module_string: str) -> str:
         """ set template string """
@@ -81,7 +94,7 @@ class UploadInfo:
     def __init__(self, room_config, videos: list[str]):
         self.videos = videos
         self.description = room_config.description
-        self.tags = room_config.tags
+        self.tags = list(room_config.tags)
         self.dynamic = room_config.dynamic
         self.title = room_config.title
 
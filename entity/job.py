@@ -0,0 +1,38 @@
+from dataclasses import dataclass
+
+from .info import LiveInfo
+
+__all__ = ['UploadJob']
+
+
+@dataclass
+class UploadJob:
+    """ a processed session waiting to be uploaded
+
+    Attributes:
+        live_info: 直播信息
+        videos: 处理后的视频(完整路径)
+        origins: 原始录播文件(完整路径, 不带后缀)
+        folder: 处理文件夹, 上传后删除
+    """
+    live_info: LiveInfo
+    videos: list[str]
+    origins: list[str]
+    folder: str
+
+    session_id = property(lambda self: self.live_info.session_id)
+    room_id = property(lambda self: self.live_info.room_id)
+
+    def to_dict(self) -> dict:
+        return {
+            'live_info': self.live_info.to_dict(),
+            'videos': self.videos,
+            'origins': self.origins,
+            'folder': self.folder,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UploadJob':
+        """ :exception KeyError, ValueError: invalid data """
+        return cls(live_info=LiveInfo.from_dict(data['live_info']), videos=list(data['videos']),
+                   origins=list(data.get('origins', [])), folder=data['folder'])
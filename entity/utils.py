@@ -1,6 +1,13 @@
-from typing import Union, Tuple
+import logging
+import os
+import threading
+import time
+from typing import Callable, Union, Tuple
 
 from exceptions import ConfigNotCompletedException
+from utils import FileUtils
+
+logger = logging.getLogger('bililive-uploader')
 
 
 def _getValue(path: str, default=None, data: dict = None):
@@ -33,3 +40,59 @@ def _setChannel(self, data: Union[Tuple[str], str, list[str]]):
         self._channel = tuple(data.split())
     else:
         self._channel = None
+
+
+# config files are checked for changes at most once in this time(seconds)
+CHECK_INTERVAL = 1
+
+
+class _ConfigFile:
+    """ a config file parsed only when its mtime or size changes
+
+    Attributes:
+        path: 文件路径
+        build: 由解析结果构建配置的函数
+        read: 解析文件的函数
+    """
+
+    def __init__(self, path: str, build: Callable[[dict], object], read: Callable[[str], object]):
+        self.path = path
+        self.build = build
+        self.read = read
+        self._lock = threading.Lock()
+        self._key = None
+        self._value = None
+        self._checked = 0.0
+
+    def get(self):
+        if time.monotonic() - self._checked < CHECK_INTERVAL:
+            return self._value
+        with self._lock:
+            stat = os.stat(self.path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            if key != self._key:
+                self._value = self.build(self.read(self.path))
+                self._key = key
+                logger.debug('Loaded %s.', self.path)
+            self._checked = time.monotonic()
+        return self._value
+
+
+_config_files: dict[tuple, _ConfigFile] = {}
+_config_files_lock = threading.Lock()
+
+
+def _cached(path: str, build: Callable[[dict], object], kind: str,
+            read: Callable[[str], object] = FileUtils.readYml):
+    """ shared snapshot of a config file, rebuilt when the file changes
+
+    :param path:
+    :param build: builds the snapshot from the parsed file
+    :param kind: what is built, one file can be cached for several kinds
+    :param read: parses the file
+    """
+    with _config_files_lock:
+        config_file = _config_files.get((kind, path))
+        if config_file is None:
+            config_file = _config_files[(kind, path)] = _ConfigFile(path, build, read)
+    return config_file.get()
@@ -46,6 +46,21 @@ class UploadVideosNotFoundException(Exception):
         return f'{self.__class__.__name__}: {self.msg}'
 
 
+class ProcessFailedException(Exception):
+    executable: str
+    failed: dict
+
+    def __init__(self, executable: str, failed: dict):
+        super().__init__()
+        self.executable = executable
+        self.failed = failed
+        logger.error(self)
+
+    def __str__(self):
+        details = ', '.join(f'{file} ({reason})' for file, reason in self.failed.items())
+        return f'{self.__class__.__name__}: {self.executable} failed on {details}'
+
+
 class UnknownError(Exception):
     msg: str
 
@@ -0,0 +1,173 @@
+""" Metrics in the prometheus text format, kept in memory of each worker.
+
+Counters and histograms are updated where things happen, gauges are set right before a scrape.
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render',
+           'STAGE_SECONDS', 'STAGED_BYTES', 'ENCODED_SECONDS', 'ENCODED_BYTES', 'ENCODE_SPEED', 'REENCODED_FRACTION',
+           'COMBINE_MODES', 'COMMAND_FAILURES', 'WEBHOOKS', 'UPLOADS', 'EVENTS', 'EVENT_DELAY', 'EVENT_LOG',
+           'PROCESS_JOBS', 'PROCESS_OLDEST_QUEUED', 'REMOTE_JOBS', 'LEASES', 'UPLOAD_QUEUE', 'UPLOAD_QUEUE_OLDEST',
+           'RECORDING_SESSIONS']
+
+_metrics: list['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    """ a metric family
+
+    Attributes:
+        name: 指标名
+        description: 说明
+        label_names: 标签名
+    """
+    kind = ''
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        assert set(labels) == set(self.label_names), f'{self.name} needs labels {self.label_names}'
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        with self._lock:
+            samples = self._samples()
+        return '\n'.join([f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}', *samples])
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.label_names, key)} {_number(value)}' for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def clear(self):
+        """ drop all label values, before setting the current ones """
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.label_names, key)} {_number(value)}' for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = (.1, .5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """ observe the time spent in the block, also when it fails """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                samples.append(f'{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}')
+            samples.append(f'{self.name}_sum{_labels(self.label_names, key)} {_number(total)}')
+            samples.append(f'{self.name}_count{_labels(self.label_names, key)} {cumulative}')
+        return samples
+
+
+def render() -> str:
+    """ all metrics in the prometheus text format """
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+STAGE_SECONDS = Histogram('bililive_stage_duration_seconds', 'Time spent in each pipeline stage.', ('stage',),
+                          buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400))
+STAGED_BYTES = Counter('bililive_staged_bytes_total', 'Bytes staged into process dirs, by method.', ('method',))
+ENCODED_SECONDS = Counter('bililive_encoded_media_seconds_total', 'Media duration encoded.')
+ENCODED_BYTES = Counter('bililive_encoded_bytes_total', 'Bytes of encoded output.')
+ENCODE_SPEED = Histogram('bililive_encode_speed_ratio', 'Encoding speed, media seconds per wall second.',
+                         buckets=(.25, .5, 1, 2, 4, 8, 16, 32, 64))
+REENCODED_FRACTION = Histogram('bililive_reencoded_fraction', 'Fraction of each combined video that was encoded.',
+                               buckets=(0, .1, .25, .5, .75, .9, 1))
+COMBINE_MODES = Counter('bililive_combine_total', 'Videos combined, encode burns danmaku in, copy only remuxes.',
+                        ('mode',))
+COMMAND_FAILURES = Counter('bililive_command_failures_total', 'Failed or timed out external commands.',
+                           ('executable',))
+WEBHOOKS = Counter('bililive_webhooks_total', 'Webhook delivery attempts, by outcome.', ('url', 'outcome'))
+UPLOADS = Counter('bililive_uploads_total', 'Upload attempts, by outcome.', ('outcome',))
+EVENTS = Counter('bililive_events_total', 'Recorder webhooks applied, by type and outcome.', ('event_type', 'outcome'))
+EVENT_DELAY = Histogram('bililive_event_apply_delay_seconds', 'Time from receiving a recorder webhook to applying it.',
+                        buckets=(.001, .01, .1, 1, 10, 60, 300, 1800))
+EVENT_LOG = Gauge('bililive_event_log_items', 'Recorder webhooks in the event log, by state.', ('state',))
+PROCESS_JOBS = Gauge('bililive_process_jobs', 'Jobs in the processing pool, by state.', ('state',))
+PROCESS_OLDEST_QUEUED = Gauge('bililive_process_oldest_queued_seconds', 'Wait time of the oldest queued job.')
+REMOTE_JOBS = Gauge('bililive_remote_jobs', 'Jobs in the queue of remote workers, by state.', ('state',))
+LEASES = Counter('bililive_leases_total', 'Leases of remote jobs, by outcome.', ('outcome',))
+UPLOAD_QUEUE = Gauge('bililive_upload_queue_items', 'Items in the upload queue, by state.', ('state',))
+UPLOAD_QUEUE_OLDEST = Gauge('bililive_upload_queue_oldest_seconds',
+                            'Time since the oldest pending upload was queued or last failed.')
+RECORDING_SESSIONS = Gauge('bililive_recording_sessions', 'Sessions still recording.')
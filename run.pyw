@@ -1,44 +1,103 @@
 import getopt
 import logging
-import multiprocessing
+import os
+import socket
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+import time
 
 from sanic import Sanic, text
+from sanic.response import raw
 
 import server.upload
 import server.process
-from entity import BotConfig
+import server.webhook
+import metrics
+from entity import BotConfig, ChannelRegistry, RoomConfig
 from logger import init_logger
+from storage import Database, EventLog, JobJournal, LeaseQueue, UploadQueue, UploadSessionStore, WebhookOutbox, \
+    create_session_store
 from utils import FileUtils
 
+CACHE_DIR = './cache'
+DATABASE_PATH = os.path.join(CACHE_DIR, 'bot.db')
+
 app = Sanic('bililive-uploader')
 app.blueprint(server.upload.bp)
 app.blueprint(server.process.bp)
+app.blueprint(server.webhook.bp)
+# signal handlers look up the app when imported
+import server.upload.signals  # pylint: disable=wrong-import-position
+import server.process.signals  # pylint: disable=wrong-import-position
+import server.process.remote  # pylint: disable=wrong-import-position
+import server.process.worker  # pylint: disable=wrong-import-position
 
 
 @app.main_process_start
 def init(*_):
-    cpu_count = multiprocessing.cpu_count() or 1
+    """ runs once before workers start """
+    bot_config = BotConfig.load(app.config.WORK_DIR)
+    FileUtils.copyFiles(['./resources/live2video.json'], bot_config.path2absolute('resources'))
+    # a wrong channel would otherwise only show up when uploading
+    for problem in ChannelRegistry.init(bot_config.work_dir).validate(RoomConfig.index(bot_config.work_dir)):
+        logging.getLogger('bililive-uploader').error('Channel not found in channel.json: %s', problem)
+    database = Database(DATABASE_PATH)
+    job_journal = JobJournal(database)
+    interrupted = job_journal.interrupt_running()
+    if interrupted:
+        logging.getLogger('bililive-uploader').info('Found %d interrupted jobs.', interrupted)
+    pruned = job_journal.prune()
+    if pruned:
+        logging.getLogger('bililive-uploader').debug('Pruned %d finished jobs.', pruned)
+    recovered = UploadQueue(database).recover()
+    if recovered:
+        logging.getLogger('bililive-uploader').info('Found %d interrupted uploads.', recovered)
+    WebhookOutbox(database).recover()
+    recovered = EventLog(database).recover()
+    if recovered:
+        logging.getLogger('bililive-uploader').info('Found %d interrupted events.', recovered)
+
+
+@app.before_server_start
+def setup(*_):
+    """ runs in every worker """
+    bot_config = BotConfig.load(app.config.WORK_DIR)
     app.ctx.bot_config = bot_config
-    app.ctx.process_pool = ThreadPoolExecutor(max_workers=min(cpu_count, bot_config.workers),
-                                              thread_name_prefix='process-pool')
-    app.ctx.upload_queue = Queue()
-    app.config.TIME_CACHE_PATH = './cache/time.json'
-    app.config.VIDEO_CACHE_PATH = './cache/videos.json'
-    app.config.FFMPEG_PATH = 'ffmpeg' if bot_config.docker else 'resources\\ffmpeg'
-    app.config.DANMAKU_FACTORY_PATH = '/DanmakuFactory/DanmakuFactory' \
-        if bot_config.docker else 'resources\\DanmakuFactory'
+    app.ctx.channels = ChannelRegistry.init(bot_config.work_dir)
+    app.ctx.segment_jobs = {}
+    app.config.CACHE_DIR = CACHE_DIR
+    app.ctx.database = Database(DATABASE_PATH)
+    app.ctx.session_store = create_session_store(bot_config.session_store, CACHE_DIR, app.ctx.database)
+    app.ctx.job_journal = JobJournal(app.ctx.database)
+    app.ctx.upload_sessions = UploadSessionStore(app.ctx.database)
+    app.ctx.upload_queue = UploadQueue(app.ctx.database)
+    app.ctx.webhook_outbox = WebhookOutbox(app.ctx.database)
+    app.ctx.event_log = EventLog(app.ctx.database)
+    app.ctx.lease_queue = LeaseQueue(app.ctx.database)
+    set_tool_paths(bot_config)
 
-    FileUtils.copyFiles(['./resources/live2video.json'], bot_config.path2absolute('resources'))
+    server.upload.init_upload_scheduler(app)
+    server.webhook.init_webhook_sender(app)
+    server.process.init_process_scheduler(app)
+    server.process.init_event_consumer(app)
 
-    server.upload.init_upload_thread(app)
+
+def set_tool_paths(bot_config: BotConfig):
+    """ SANIC_FFMPEG_PATH environment variable takes precedence """
+    if 'FFMPEG_PATH' not in app.config:
+        app.config.FFMPEG_PATH = 'ffmpeg' if bot_config.docker else 'resources\\ffmpeg'
+
+
+@app.after_server_start
+def resume(*_):
+    server.process.signals.resume_jobs()
+    # apply logged events after interrupted jobs are resumed
+    app.add_task(app.ctx.event_consumer.run())
+    app.add_task(server.process.remote.reclaim_leases())
 
 
 @app.on_request
 def refresh_config(*_):
-    app.ctx.bot_config = BotConfig(app.ctx.work_dir)
+    app.ctx.bot_config = BotConfig.load(app.config.WORK_DIR)
 
 
 @app.route('/')
@@ -46,23 +105,53 @@ def test(_):
     return text('This is a test page.')
 
 
+@app.route('/metrics')
+def export_metrics(_):
+    """ metrics of this worker in the prometheus text format """
+    now = time.time()
+    queued = server.process.signals.queued_jobs()
+    metrics.PROCESS_JOBS.set(len(queued), state='queued')
+    metrics.PROCESS_OLDEST_QUEUED.set(now - min(queued) if queued else 0)
+    metrics.REMOTE_JOBS.clear()
+    for state, count in app.ctx.lease_queue.counts().items():
+        metrics.REMOTE_JOBS.set(count, state=state)
+    metrics.UPLOAD_QUEUE.clear()
+    for state, count in app.ctx.upload_queue.counts().items():
+        metrics.UPLOAD_QUEUE.set(count, state=state)
+    oldest = app.ctx.upload_queue.oldest_pending()
+    metrics.UPLOAD_QUEUE_OLDEST.set(now - oldest if oldest else 0)
+    metrics.EVENT_LOG.clear()
+    for state, count in app.ctx.event_log.counts().items():
+        metrics.EVENT_LOG.set(count, state=state)
+    metrics.RECORDING_SESSIONS.set(len(app.ctx.session_store.sessions()))
+    return raw(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 if __name__ == '__main__':
     try:
-        options, args = getopt.getopt(sys.argv[1:], 'w:', ['work-dir='])
-        for option, value in options:
-            if option in ('-w', '--work-dir'):
-                work_dir = value
-                app.ctx.work_dir = work_dir
-                break
-        else:
+        options, args = getopt.getopt(sys.argv[1:], 'w:', ['work-dir=', 'worker=', 'name='])
+        options = dict(options)
+        work_dir = options.get('-w') or options.get('--work-dir')
+        if not work_dir:
             raise getopt.GetoptError('work dir is not specified')
+        # workers load SANIC_ prefixed environment variables into app.config
+        os.environ['SANIC_WORK_DIR'] = app.config.WORK_DIR = work_dir
     except getopt.GetoptError as e:
         logging.critical(e)
         sys.exit(2)
-    FileUtils.deleteFolder('./cache')
     logger = init_logger(work_dir)
+    bot_config = BotConfig.load(work_dir)
+    if '--worker' in options:
+        # process jobs leased from the coordinator at the given url, no server is started
+        set_tool_paths(bot_config)
+        worker = server.process.worker.init_worker(options['--worker'],
+                                                   options.get('--name') or f'{socket.gethostname()}-{os.getpid()}')
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            logger.info('Worker stopped.')
+        sys.exit(0)
     logger.info('Server started.')
-    bot_config = BotConfig(work_dir)
     logger.debug('Work dir: %s\nRecord dir: %s', work_dir, bot_config.rec_dir)
     logger.debug('Configs:\n %s', bot_config)
     app.run(host='0.0.0.0', port=bot_config.port, auto_reload=True,
@@ -1,34 +1,108 @@
+import json
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from sanic import Sanic, text, Blueprint
-from utils.TimeUtils import fromIso
+from sanic import json as json_response
 
-from entity import RoomConfig
+from storage import JobCostLog
 
 logger = logging.getLogger('bililive-uploader')
 bp = Blueprint('process', url_prefix='/process')
+# processing jobs listed by /process/state unless asked otherwise
+STATE_JOBS = 100
+
+# the event consumer dispatches to signals of this blueprint
+from .ingest import EVENT_TYPES, EventConsumer, validate_event  # pylint: disable=wrong-import-position
+from .scheduler import CostModel, ProcessScheduler  # pylint: disable=wrong-import-position
 
 
 @bp.post('')
 async def process(request):
-    logger.debug('Received request: %s', request.json)
-
+    """log a BililiveRecorder webhook and reply at once, events are applied by the event consumer"""
     request_body = request.json
-    event_type, event_data = request_body['EventType'], request_body['EventData']
-    event_time = fromIso(request_body['EventTimestamp'])
-    room_id, short_id = int(event_data['RoomId']), int(event_data['ShortId'])
-
-    if event_type == 'SessionStarted':
-        await _dispatch(f'session.start.{room_id}', start_time=event_time)
-    elif event_type == 'FileOpening':
-        await _dispatch(f'file.open.{room_id}', file_path=event_data['RelativePath'])
-    elif event_type == 'SessionEnded':
-        work_dir = bp.ctx.bot_config.work_dir
-        room_config = RoomConfig.init(work_dir, room_id, short_id)
-        await _dispatch(f'session.end.{room_id}', event_data=event_data, room_config=room_config)
-
-    logger.debug('Request processed.')
+    logger.debug('Received request: %s', request_body)
+    if request.app.ctx.bot_config.capture:
+        _capture(request.app.ctx.bot_config.capture, request_body)
+    problem = validate_event(request_body)
+    if problem:
+        logger.warning('Invalid webhook: %s', problem)
+        return text(problem, status=400)
+    if request_body.get('EventType') in EVENT_TYPES:
+        event_data = request_body['EventData']
+        request.app.ctx.event_log.append(int(event_data['RoomId']), event_data['SessionId'],
+                                         request_body['EventType'], request_body)
+        request.app.ctx.event_consumer.wake()
     return text('done')
 
 
-async def _dispatch(route: str, **kwargs):
-    await bp.dispatch(route, context=kwargs)
+@bp.get('/state')
+async def state(request):
+    """event log, sessions still recording, latest processing jobs(?jobs=count) and upload queue of this instance"""
+    ctx = request.app.ctx
+    try:
+        limit = int(request.args.get('jobs', STATE_JOBS))
+    except ValueError:
+        return text('jobs should be a number.', status=400)
+    return json_response({
+        'events': ctx.event_log.counts(),
+        'sessions': [{'session_id': session.session_id, 'room_id': session.room_id, 'files': len(session.filenames)}
+                     for session in ctx.session_store.sessions()],
+        'jobs': [{'session_id': job.session_id, 'room_id': job.room_id, 'stage': job.stage, 'state': job.state,
+                  'combine': job.data.get('combine_modes', {}),
+                  'reencoded': reencoded_fraction(job.data.get('reencoded', {}))}
+                 for job in ctx.job_journal.jobs(limit=max(0, limit))],
+        'uploads': [{'session_id': item.session_id, 'room_id': item.room_id, 'state': item.state}
+                    for item in ctx.upload_queue.items()],
+    })
+
+
+def reencoded_fraction(reencoded: dict[str, list[float]]):
+    """ fraction of a session encoded, None before combining """
+    duration = sum(duration for _, duration in reencoded.values())
+    return round(sum(encoded for encoded, _ in reencoded.values()) / duration, 4) if duration else None
+
+
+def _capture(path: str, body: dict):
+    """ append the webhook to a JSONL file, for replaying it later """
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'ReceivedAt': time.time(), 'Body': body}, ensure_ascii=False) + '\n')
+
+
+@bp.get('/jobs')
+async def list_jobs(request):
+    """running processing jobs, then queued ones in the order they will start"""
+    now = time.time()
+    return json_response([{
+        'id': job.id, 'session_id': job.session_id, 'room_id': job.room_id, 'kind': job.kind, 'state': job.state,
+        'estimated_seconds': round(job.estimate, 1), 'media_seconds': round(job.features.media_seconds, 1),
+        'waited_seconds': round((job.started_at or now) - job.submitted_at, 1),
+        'running_seconds': round(now - job.started_at, 1) if job.started_at else None,
+    } for job in request.app.ctx.process_scheduler.jobs()])
+
+
+@bp.delete('/jobs/<job_id:int>')
+async def cancel_job(request, job_id: int):
+    """drop a queued job or stop a running one, a cancelled session is not resumed after restart"""
+    job = request.app.ctx.process_scheduler.cancel(job_id)
+    if job is None:
+        return text('Job not found.', status=404)
+    if job.kind != 'segment':  # the session is processed anyway when it ends
+        request.app.ctx.job_journal.fail(job.session_id, 'cancelled')
+        if request.app.ctx.bot_config.remote:
+            request.app.ctx.lease_queue.cancel(job.session_id)
+    return text('Cancelled.')
+
+
+def init_process_scheduler(app: Sanic):
+    """ create the process pool and the scheduler running jobs in it """
+    slots = min(multiprocessing.cpu_count() or 1, app.ctx.bot_config.workers)
+    app.ctx.process_pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix='process-pool')
+    app.ctx.process_scheduler = ProcessScheduler(app.ctx.process_pool, slots, CostModel(JobCostLog(app.ctx.database)))
+
+
+def init_event_consumer(app: Sanic):
+    """ create the event consumer, it is started after interrupted jobs are resumed """
+    app.ctx.event_consumer = EventConsumer(app.ctx.event_log)
@@ -1,13 +1,18 @@
 import logging
 import os
+import time
+from datetime import datetime
+from typing import Optional
 
 from sanic import Sanic
 
-from entity import LiveInfo, RoomConfig
+from entity import BotConfig, LiveInfo, RoomConfig, DanmakuConfig, EncodingProfile
 from exceptions import UnknownError
-from utils import FileUtils, VideoUtils
+from metrics import COMBINE_MODES, STAGE_SECONDS, STAGED_BYTES
+from storage import STAGES, JobRecord, SessionRecord
+from utils import FileUtils, FlvUtils, VideoUtils
 
-from .utils import merge_videos, merge_danmaku, convert_danmakus, combine_videos_and_danmakus
+from .utils import merge_videos, merge_danmaku, convert_danmakus, combine_videos_and_danmakus, encode_videos
 
 app = Sanic.get_app()
 logger = logging.getLogger('bililive-uploader')
@@ -29,48 +34,203 @@ class Process:
         process_dir: 处理后文件所在文件夹
         processes: 处理文件名（不带后缀）
         extensions: 后缀名
+        event_data: 录播姬事件数据
         live_info: 直播信息
         room_config: 房间配置
+        bot_config: 处理使用的设置, worker上为租约中协调端的设置
+        stage: 已完成的阶段
+        ended_at: 录制结束时间
+        output_extension: 处理结果的后缀名, 由编码配置决定
+        combine_modes: 每个处理结果的生成方式, encode为按编码配置编码(压制弹幕), copy为只转封装
+        reencoded: 每个处理结果重新编码的时长和总时长(秒)
     """
     folder: str
     origins: list[str]
     process_dir: str
     processes: list[str]
     extensions: list[str]
+    event_data: dict
     live_info: LiveInfo
     room_config: RoomConfig
+    bot_config: BotConfig
+    stage: str
+    ended_at: float
+    output_extension: str
+    combine_modes: dict[str, str]
+    reencoded: dict[str, list[float]]
 
-    def __init__(self, event_data: dict, room_config: RoomConfig):
+    def __init__(self, event_data: dict, room_config: RoomConfig, bot_config: BotConfig = None):
+        self.event_data = event_data
         self.live_info = LiveInfo(event_data)
         self.origins, self.processes = [], []
         self.room_config = room_config
-        self.live_info.read_start_time(app.config.TIME_CACHE_PATH, self.live_info.room_id)
+        self.bot_config = bot_config or app.ctx.bot_config
+        self.stage = None
+        self.ended_at = None
+        self.output_extension = None
+        self.combine_modes = {}
+        self.reencoded = {}
+
+    @classmethod
+    def resume(cls, job: JobRecord) -> 'Process':
+        """ rebuild an interrupted job from the job journal """
+        processor = cls.from_snapshot(job.data)
+        processor.stage = job.stage
+        if not app.ctx.job_journal.verify(job.session_id):
+            logger.warning('Artifacts of stage %s are invalid, restart from beginning.', job.stage,
+                           extra={'room_id': job.room_id})
+            processor.stage = STAGES[0]
+        return processor
+
+    @classmethod
+    def from_snapshot(cls, data: dict, room_config: RoomConfig = None, bot_config: BotConfig = None) -> 'Process':
+        """ rebuild a job from its snapshot, the stage is not set
+
+        :param data: from snapshot()
+        :param room_config: taken from room-config.yml if not given
+        :param bot_config: app.ctx.bot_config if not given
+        """
+        event_data = data['event_data']
+        bot_config = bot_config or app.ctx.bot_config
+        if room_config is None:
+            room_config = RoomConfig.init(bot_config.work_dir, event_data['RoomId'], event_data['ShortId'])
+        processor = cls(event_data, room_config, bot_config)
+        processor.live_info.start_time = datetime.fromisoformat(data['start_time'])
+        processor.folder, processor.origins, processor.extensions = \
+            data['folder'], data['origins'], data['extensions']
+        processor.process_dir, processor.processes = data['process_dir'], data['processes']
+        processor.ended_at = data.get('ended_at')
+        processor.output_extension = data.get('output_extension')
+        processor.combine_modes = data.get('combine_modes', {})
+        processor.reencoded = data.get('reencoded', {})
+        return processor
+
+    def snapshot(self) -> dict:
+        """ data needed to resume this job """
+        return {
+            'event_data': self.event_data,
+            'start_time': self.live_info.start_time.isoformat(),
+            'folder': self.folder,
+            'origins': self.origins,
+            'extensions': self.extensions,
+            'process_dir': self.process_dir,
+            'processes': self.processes,
+            'ended_at': self.ended_at,
+            'output_extension': self.output_extension,
+            'combine_modes': self.combine_modes,
+            'reencoded': self.reencoded,
+        }
+
+    @property
+    def danmaku_config(self) -> DanmakuConfig:
+        return self.room_config.danmaku if self.room_config else DanmakuConfig({})
+
+    @property
+    def profile_name(self):
+        """ encoding profile of this room, a name or overrides """
+        return self.room_config.profile if self.room_config else None
+
+    @property
+    def encoding_profile(self) -> EncodingProfile:
+        return self.bot_config.encoding_profile(self.profile_name)
+
+    def result(self, name: str) -> str:
+        """ path of a processed video """
+        if self.output_extension is None:
+            self.output_extension = self.encoding_profile.extension
+        return os.path.join(self.process_dir, name + self.output_extension)
+
+    async def encode(self, files: list[tuple[str, str, str]]):
+        profile_name = self.profile_name if isinstance(self.profile_name, str) else self.bot_config.profile
+        results = await combine_videos_and_danmakus(files, self.encoding_profile, profile_name,
+                                                    self.bot_config.parallel, self.bot_config.smart_combine)
+        for output, (encoded, duration) in results.items():
+            self.reencoded[os.path.splitext(os.path.basename(output))[0]] = [round(encoded, 3), round(duration, 3)]
+
+    def choose_combine_modes(self, danmakus: list[tuple[str, str]], counts: dict[str, int]):
+        """ burn danmaku in only when there are enough, otherwise encoding buys nothing and the video is remuxed
+
+        :param danmakus: [(result name, ass file)]
+        :param counts: {ass file: danmakus}, from convert_danmakus
+        """
+        for name, ass in danmakus:
+            count = counts.get(ass, 0)
+            mode = 'encode' if count and count >= self.bot_config.min_danmaku else 'copy'
+            if mode == 'copy':
+                logger.info('%d danmakus for %s, remux it without encoding.', count, name,
+                            extra={'room_id': self.live_info.room_id})
+                FileUtils.deleteFiles([ass])
+            self.combine_modes[name] = mode
+            COMBINE_MODES.inc(mode=mode)
+
+    def source_parameters(self, name: str) -> bool:
+        """ whether result `name` keeps the codec parameters of its recording, i.e. remuxed or smart combined """
+        encoded, duration = self.reencoded.get(name, (0, 0))
+        return self.combine_modes.get(name) == 'copy' or encoded < duration
+
+    async def uniform_results(self):
+        """ Encode results kept at their recording's parameters when others have been encoded with the profile,
+        otherwise they can't be joined by stream copy. """
+        kept = [name for name in self.processes if self.source_parameters(name)]
+        if not kept or len(kept) == len(self.processes):
+            return
+        logger.info('Encoding %d of %d segments to join them with encoded ones...', len(kept), len(self.processes),
+                    extra={'room_id': self.live_info.room_id})
+        encoding = {name: self.result(f'{name}.encoding') for name in kept}
+        with STAGE_SECONDS.time(stage='combine'):
+            await encode_videos([(self.result(name), encoding[name]) for name in kept], self.encoding_profile)
+        for name in kept:
+            os.replace(encoding[name], self.result(name))
+            duration = self.reencoded.get(name, [0, 0])[1]
+            self.combine_modes[name], self.reencoded[name] = 'encode', [duration, duration]
+            app.ctx.job_journal.merge_data(self.live_info.session_id, {'combine_modes': {name: 'encode'},
+                                                                       'reencoded': {name: [duration, duration]}})
+
+    def danmaku_to_burn(self, name: str, ass: str) -> Optional[str]:
+        """ ass file to burn into result `name`, None if it's only remuxed """
+        return None if self.combine_modes.get(name) == 'copy' else ass
+
+    def done(self, stage: str) -> bool:
+        """ whether stage has been completed before """
+        return self.stage is not None and STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def checkpoint(self, stage: str):
+        """ record completed stage, current processing files are the artifacts """
+        extensions = dict.fromkeys(('.flv', '.xml', '.ass', self.output_extension or '.flv'))
+        artifacts = [os.path.join(self.process_dir, process + extension)
+                     for process in self.processes for extension in extensions]
+        app.ctx.job_journal.checkpoint(self.live_info.session_id, stage, self.snapshot(), artifacts)
+        self.stage = stage
+        logger.debug('Stage %s completed.', stage, extra={'room_id': self.live_info.room_id})
 
     def live_end(self):
-        rooms = FileUtils.readJson(app.config.VIDEO_CACHE_PATH)
-        if str(self.live_info.room_id) not in rooms:
-            raise UnknownError(f'Room {self.live_info.room_id} not found in video_cache.json')
-        room = rooms.pop(str(self.live_info.room_id))
-        FileUtils.writeDict(app.config.VIDEO_CACHE_PATH, rooms)
-        self.folder, self.origins, self.extensions = room['folder'], room['filenames'], room['extensions']
+        session = app.ctx.session_store.end(self.live_info.session_id)
+        if session is None:
+            raise UnknownError(f'Session {self.live_info.session_id} of room {self.live_info.room_id} not found.')
+        self.ended_at = time.time()
+        self.load_session(session)
+
+    def load_session(self, session: SessionRecord):
+        if session.start_time is None:
+            logger.warning('Session start time not recorded, use current time instead.',
+                           extra={'room_id': self.live_info.room_id})
+            session.start_time = datetime.now().astimezone()
+        self.live_info.start_time = session.start_time
+        self.folder, self.origins, self.extensions = session.folder, session.filenames, session.extensions
         self.generate_process_dir()
 
     def generate_process_dir(self):
         room_id = self.live_info.room_id
         start_time = self.live_info.start_time
-        bot_config = app.ctx.bot_config
-        self.process_dir = os.path.join(bot_config.work_dir, f'{room_id}_{start_time.strftime("%Y%m%d-%H%M%S")}')
+        self.process_dir = os.path.join(self.bot_config.work_dir, f'{room_id}_{start_time.strftime("%Y%m%d-%H%M%S")}')
 
     @property
-    def need_process(self) -> bool:
+    def room_allowed(self) -> bool:
+        """ whether this room is configured and not filtered by extra conditions """
         # whether this room is in config
         if self.room_config is None:
             logger.debug('Room not found in config.', extra={'room_id': self.live_info.room_id})
             return False
-        # whether videos exist
-        if len(self.origins) == 0:
-            logger.warning('No video found.', extra={'room_id': self.live_info.room_id})
-            return False
         # whether this room is filtered by extra config
         for condition in self.room_config.list_conditions(self.live_info):
             if not condition.process:
@@ -78,62 +238,176 @@ class Process:
                              'details: item -- %s | regexp -- %s',
                              condition.item, condition.regexp, extra={'room_id': self.live_info.room_id})
                 return False
-        # whether total time is enough
-        videos = [os.path.join(self.folder, origin + '.flv') for origin in self.origins]
-        total_time = VideoUtils.getTotalTime(videos)
-        if total_time < app.ctx.bot_config.min_time:
+        return True
+
+    @property
+    def need_process(self) -> bool:
+        if not self.room_allowed:
+            return False
+        # whether videos exist
+        if len(self.origins) == 0:
+            logger.warning('No video found.', extra={'room_id': self.live_info.room_id})
+            return False
+        # whether total time is enough, segments processed while recording may be gone or no longer flv
+        durations = app.ctx.job_journal.segment_durations(self.live_info.session_id)
+        total_time = sum(durations.values()) + VideoUtils.getTotalTime(
+            [self.origin_video(i) for i in range(len(self.origins)) if i not in durations])
+        if total_time < self.bot_config.min_time:
             logger.debug('Total time is not enough, details: total time -- %s | min time -- %s',
-                         total_time, app.ctx.bot_config.min_time, extra={'room_id': self.live_info.room_id})
+                         total_time, self.bot_config.min_time, extra={'room_id': self.live_info.room_id})
             return False
         return True
 
+    def origin_video(self, index: int) -> str:
+        """ original flv of a segment, which may have been moved into process dir while recording """
+        candidates = [os.path.join(self.folder, self.origins[index] + '.flv'),
+                      os.path.join(self.process_dir, f'{TRANSFORMED_NAME}{index}.flv')]
+        return next((video for video in candidates if os.path.exists(video)), candidates[0])
+
     async def process(self):
-        # move files to process_dir
-        assert not os.path.exists(self.process_dir), UnknownError(f"Process dir '{self.process_dir}' shouldn't exist.")
-        os.makedirs(self.process_dir)
-        logger.info('Moving files to process dir.', extra={'room_id': self.live_info.room_id})
-        files = [os.path.join(self.folder, origin + extension)
-                 for origin in self.origins for extension in self.extensions]
-        # move and rename files
-        moved = FileUtils.copyFiles(files, self.process_dir)
-        news = [os.path.join(self.process_dir, TRANSFORMED_NAME + str(i) + extension)
-                for i in range(len(self.origins)) for extension in self.extensions]
-        FileUtils.renameFiles(list(zip(moved, news)))
+        journal = app.ctx.job_journal
+        if self.stage is None:
+            # segments may have been processed while recording
+            journal.ensure(self.live_info.session_id, self.live_info.room_id, self.snapshot())
+            self.stage = journal.get(self.live_info.session_id).stage
+        if self.stage != STAGES[0]:
+            logger.info('Resuming from stage %s.', self.stage, extra={'room_id': self.live_info.room_id})
+        if self.bot_config.incremental:
+            await self.process_incremental()
+            return
+        if not self.done('staged'):
+            self.stage_files()
+        if not self.done('merged'):
+            if not self.bot_config.multipart and len(self.processes) > 1:
+                await self.merge()
+            else:
+                self.checkpoint('merged')
+        if not self.done('danmaku'):
+            await self.make_danmaku()
+        if not self.done('combined'):
+            await self.combine()
+
+    async def process_incremental(self):
+        """ Process the segments not processed while recording, then assemble results. """
+        if self.done('combined'):
+            return
+        processed = app.ctx.job_journal.segments(self.live_info.session_id)
+        # results of segments processed while recording
+        data = app.ctx.job_journal.get(self.live_info.session_id).data
+        self.combine_modes = {**data.get('combine_modes', {}), **self.combine_modes}
+        self.reencoded = {**data.get('reencoded', {}), **self.reencoded}
+        for i in range(len(self.origins)):
+            if i not in processed or not os.path.exists(processed[i]):
+                await self.process_segment(i)
+        self.processes = [PROCESSED_PREFIX + str(i) for i in range(len(self.origins))]
+        if not self.bot_config.multipart and len(self.processes) > 1:
+            await self.uniform_results()
+            logger.info('Merging processed segments...', extra={'room_id': self.live_info.room_id})
+            results = [self.result(process) for process in self.processes]
+            await merge_videos(results, self.process_dir, os.path.basename(self.result(PROCESSED_PREFIX)))
+            self.processes = [PROCESSED_PREFIX]
+            self.checkpoint('combined')
+            FileUtils.deleteFiles(results)
+        else:
+            self.checkpoint('combined')
+
+    async def process_segment(self, index: int):
+        """ Stage, convert danmaku and combine a single finished segment. """
+        room_id = self.live_info.room_id
+        logger.info('Processing segment %d...', index, extra={'room_id': room_id})
+        app.ctx.job_journal.ensure(self.live_info.session_id, room_id, self.snapshot())
+        os.makedirs(self.process_dir, exist_ok=True)
+        process = TRANSFORMED_NAME + str(index)
+        with STAGE_SECONDS.time(stage='stage'):
+            self.stage_to_process_dir([(os.path.join(self.folder, self.origins[index] + extension),
+                                        os.path.join(self.process_dir, process + extension))
+                                       for extension in self.extensions])
+        video, xml, ass = (os.path.join(self.process_dir, process + extension)
+                           for extension in ('.flv', '.xml', '.ass'))
+        name = f'{PROCESSED_PREFIX}{index}'
+        output = self.result(name)
+        duration = FlvUtils.getDuration(video) if os.path.exists(video) else None
+        with STAGE_SECONDS.time(stage='make_danmaku'):
+            counts = await self.convert_danmakus([(xml, ass, video)])
+        self.choose_combine_modes([(name, ass)], counts)
+        with STAGE_SECONDS.time(stage='combine'):
+            await self.encode([(video, self.danmaku_to_burn(name, ass), output)])
+        app.ctx.job_journal.merge_data(self.live_info.session_id, {'combine_modes': {name: self.combine_modes[name]},
+                                                                   'reencoded': {name: self.reencoded[name]}})
+        app.ctx.job_journal.segment_done(self.live_info.session_id, index, output, duration)
+        FileUtils.deleteFiles([video, xml, ass])
+
+    def stage_files(self):
+        """ Stage record files into process dir under new names. """
+        os.makedirs(self.process_dir, exist_ok=True)
+        logger.info('Staging files to process dir.', extra={'room_id': self.live_info.room_id})
+        with STAGE_SECONDS.time(stage='stage'):
+            self.stage_to_process_dir([(os.path.join(self.folder, origin + extension),
+                                        os.path.join(self.process_dir, TRANSFORMED_NAME + str(i) + extension))
+                                       for i, origin in enumerate(self.origins) for extension in self.extensions])
         self.processes = [TRANSFORMED_NAME + str(i) for i in range(len(self.origins))]
-        # process videos
-        if not app.ctx.bot_config.multipart and len(self.processes) > 1:
-            await self.merge()
-        await self.make_danmaku()
-        await self.combine()
+        self.checkpoint('staged')
+
+    def stage_to_process_dir(self, files: list[tuple[str, str]]):
+        """ Link files when possible, copy only when they are on another filesystem.
+
+        Originals stay in the record dir, they are deleted only after a successful upload.
+        """
+        start = time.monotonic()
+        result = FileUtils.stageFiles(files)
+        linked = sum(size for method, size in result.items() if method in ('hardlink', 'reflink'))
+        copied = sum(size for method, size in result.items() if method in ('copy_file_range', 'copy'))
+        logger.info('Staged %d files in %.3fs, linked %.1fMB, copied %.1fMB.', len(files), time.monotonic() - start,
+                    linked / 2 ** 20, copied / 2 ** 20, extra={'room_id': self.live_info.room_id})
+        logger.debug('Staging details: %s', result, extra={'room_id': self.live_info.room_id})
+        for method, size in result.items():
+            STAGED_BYTES.inc(size, method=method)
+        if 'missing' in result:
+            logger.warning('Some record files are missing.', extra={'room_id': self.live_info.room_id})
 
     async def merge(self):
         """ Merge seperated danmaku xml files and flv files to 1 file each. """
         logger.info('Merging files...', extra={'room_id': self.live_info.room_id})
         videos = [os.path.join(self.process_dir, process + '.flv') for process in self.processes]
         danmakus = [os.path.join(self.process_dir, process + '.xml') for process in self.processes]
-        # videos
-        await merge_videos(videos, self.process_dir, TRANSFORMED_NAME + '.flv')
-        FileUtils.deleteFiles(videos)
-        # danmakus
-        await merge_danmaku(danmakus, self.process_dir, TRANSFORMED_NAME + '.xml')
-        FileUtils.deleteFiles(danmakus)
+        with STAGE_SECONDS.time(stage='merge'):
+            # videos
+            await merge_videos(videos, self.process_dir, TRANSFORMED_NAME + '.flv')
+            # danmakus
+            await merge_danmaku(list(zip(danmakus, videos)), self.process_dir, TRANSFORMED_NAME + '.xml')
         self.processes = [TRANSFORMED_NAME]
+        self.checkpoint('merged')
+        FileUtils.deleteFiles(videos)
+        FileUtils.deleteFiles([danmaku for danmaku in danmakus if danmaku])
 
     async def make_danmaku(self):
         xml_files = [os.path.join(self.process_dir, process + '.xml') for process in self.processes]
         ass_files = [os.path.join(self.process_dir, process + '.ass') for process in self.processes]
         logger.debug('Transforming damaku files:\ninputs: %s\noutputs: %s',
                      xml_files, ass_files, extra={'room_id': self.live_info.room_id})
-        await convert_danmakus(list(zip(xml_files, ass_files)))
+        videos = [os.path.join(self.process_dir, process + '.flv') for process in self.processes]
+        with STAGE_SECONDS.time(stage='make_danmaku'):
+            counts = await self.convert_danmakus(list(zip(xml_files, ass_files, videos)))
+        self.choose_combine_modes([(f'{PROCESSED_PREFIX}{i}', ass) for i, ass in enumerate(ass_files)], counts)
+        self.checkpoint('danmaku')
+
+    async def convert_danmakus(self, files: list[tuple[str, str, str]]) -> dict[str, int]:
+        """ nothing is converted when danmaku is disabled """
+        if not self.bot_config.danmaku:
+            return {}
+        return await convert_danmakus(files, self.danmaku_config)
 
     async def combine(self):
         logger.info('Combining record videos and danmaku...', extra={'room_id': self.live_info.room_id})
         videos = [os.path.join(self.process_dir, process + '.flv') for process in self.processes]
-        danmakus = [os.path.join(self.process_dir, process + '.ass') for process in self.processes]
-        outputs = [os.path.join(self.process_dir, f'{PROCESSED_PREFIX}{i}.flv') for i in range(len(self.processes))]
+        danmakus = [self.danmaku_to_burn(f'{PROCESSED_PREFIX}{i}', os.path.join(self.process_dir, process + '.ass'))
+                    for i, process in enumerate(self.processes)]
+        outputs = [self.result(f'{PROCESSED_PREFIX}{i}') for i in range(len(self.processes))]
         logger.debug('Combining videos:\ninput videos: %s\ninput danmakus: %s\noutput: %s',
                      videos, danmakus, outputs, extra={'room_id': self.live_info.room_id})
-        await combine_videos_and_danmakus(list(zip(videos, danmakus, outputs)))
+        with STAGE_SECONDS.time(stage='combine'):
+            await self.encode(list(zip(videos, danmakus, outputs)))
         self.processes = [PROCESSED_PREFIX + str(i) for i in range(len(self.processes))]
+        self.checkpoint('combined')
         FileUtils.deleteFiles(videos)
-        FileUtils.deleteFiles(danmakus)
+        FileUtils.deleteFiles([danmaku for danmaku in danmakus if danmaku])
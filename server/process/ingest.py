@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+
+from sanic import Sanic
+
+from entity import RoomConfig
+from metrics import EVENTS, EVENT_DELAY
+from storage import EventLog, EventRecord
+from utils.TimeUtils import fromIso
+from ..process import bp
+
+logger = logging.getLogger('bililive-uploader')
+
+# BililiveRecorder events handled by the bot, others are acknowledged and dropped
+EVENT_TYPES = ('SessionStarted', 'FileOpening', 'SessionEnded')
+# events logged by other workers are noticed within this time(seconds)
+POLL_INTERVAL = 5
+
+
+def validate_event(body) -> str:
+    """ check a BililiveRecorder webhook before logging it
+
+    :return: problem found, empty if the event can be applied
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('EventData'), dict):
+        return 'EventData not found'
+    event_data = body['EventData']
+    try:
+        int(event_data['RoomId']), int(event_data['ShortId'])
+        fromIso(body['EventTimestamp'])
+    except (KeyError, ValueError, TypeError) as e:
+        return f'invalid event: {e!r}'
+    if not isinstance(event_data.get('SessionId'), str):
+        return 'SessionId not found'
+    if body.get('EventType') == 'FileOpening' and not isinstance(event_data.get('RelativePath'), str):
+        return 'RelativePath not found'
+    return ''
+
+
+class EventConsumer:
+    """ applies logged webhooks on the server event loop
+
+    Events of a room are applied one by one in the order received, different rooms are applied
+    concurrently, at most `concurrency` rooms at the same time. A failed event is recorded and skipped.
+
+    Attributes:
+        event_log: 事件日志
+        concurrency: 同时处理的房间数
+    """
+    event_log: EventLog
+    concurrency: int
+
+    def __init__(self, event_log: EventLog, concurrency: int = 16):
+        self.event_log = event_log
+        self.concurrency = max(1, concurrency)
+        self._running: dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        """ an event has been logged, called on the server event loop """
+        self._wakeup.set()
+
+    async def run(self):
+        """ consuming loop, sleeps until an event is logged or applied """
+        pruned = self.event_log.prune()
+        if pruned:
+            logger.debug('Pruned %d applied events.', pruned)
+        while True:
+            self._wakeup.clear()
+            if len(self._running) < self.concurrency:
+                for event in self.event_log.claim(self.concurrency - len(self._running)):
+                    self._running[event.id] = asyncio.create_task(self._apply(event))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _apply(self, event: EventRecord):
+        try:
+            await apply_event(event.body)
+            self.event_log.done(event.id)
+            EVENTS.inc(event_type=event.event_type, outcome='done')
+        except Exception as e:
+            logger.exception('Applying %s failed.', event.event_type, extra={'room_id': event.room_id})
+            self.event_log.fail(event.id, repr(e))
+            EVENTS.inc(event_type=event.event_type, outcome='failed')
+        finally:
+            EVENT_DELAY.observe(time.time() - event.received_at)
+            self._running.pop(event.id, None)
+            self._wakeup.set()
+
+
+async def apply_event(body: dict):
+    """ dispatch a BililiveRecorder webhook to the process signals and wait for them """
+    app = Sanic.get_app()
+    event_type, event_data = body['EventType'], body['EventData']
+    room_id, short_id = int(event_data['RoomId']), int(event_data['ShortId'])
+    session_id = event_data['SessionId']
+
+    if event_type == 'SessionStarted':
+        await _dispatch(f'session.start.{room_id}', session_id=session_id,
+                        start_time=fromIso(body['EventTimestamp']))
+    elif event_type == 'FileOpening':
+        await _dispatch(f'file.open.{room_id}', session_id=session_id, file_path=event_data['RelativePath'],
+                        event_data=event_data)
+    elif event_type == 'SessionEnded':
+        room_config = RoomConfig.init(app.ctx.bot_config.work_dir, room_id, short_id)
+        await _dispatch(f'session.end.{room_id}', event_data=event_data, room_config=room_config)
+
+
+async def _dispatch(route: str, **kwargs):
+    await bp.dispatch(route, context=kwargs, inline=True)
@@ -0,0 +1,214 @@
+import asyncio
+import dataclasses
+import functools
+import hmac
+import logging
+import os
+import time
+from typing import Optional
+
+from sanic import Sanic, text, empty
+from sanic import json as json_response
+
+from entity import RoomConfig, DanmakuConfig
+from metrics import LEASES
+from storage import STAGES, LeaseItem
+from .handler import Process
+from .signals import finish_job
+from ..process import bp
+
+app = Sanic.get_app()
+logger = logging.getLogger('bililive-uploader')
+
+# a job failed or abandoned this many times is given up
+MAX_ATTEMPTS = 3
+# job journal methods workers may call, only for the session of their lease
+JOURNAL_METHODS = ('ensure', 'get', 'checkpoint', 'segments', 'segment_done', 'merge_data')
+# bot config deciding what a job produces, workers take it from the lease instead of their own config
+LEASED_SETTINGS = ('danmaku', 'incremental', 'parallel', 'min_danmaku', 'smart_combine', 'multipart', 'profile',
+                   'delete')
+
+
+def _from_worker(handler):
+    """ refuse requests without the remote-token of the coordinator, nothing is allowed while it's unset """
+    @functools.wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        token = request.app.ctx.bot_config.remote_token
+        if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return text('Unauthorized.', status=401)
+        return await handler(request, *args, **kwargs)
+    return wrapper
+
+
+@bp.post('/leases')
+@_from_worker
+async def claim_lease(request):
+    """lease the next job to a worker, 204 if there is none"""
+    worker = (request.json or {}).get('worker') or request.ip
+    queue = request.app.ctx.lease_queue
+    while True:
+        item = queue.claim(worker, request.app.ctx.bot_config.lease_seconds)
+        if item is None:
+            return empty()
+        lease = await asyncio.to_thread(_lease, item)
+        if lease is not None:
+            break
+        queue.complete(item.lease_id)
+    LEASES.inc(outcome='claimed')
+    logger.info('Leased %s job to %s.', item.kind, worker, extra={'room_id': item.room_id})
+    return json_response(lease)
+
+
+def _lease(item: LeaseItem) -> Optional[dict]:
+    """ what a worker needs to run the job, None if it has been done """
+    journal = app.ctx.job_journal
+    stage, data = None, item.payload
+    if item.kind == 'segment':
+        output = journal.segments(item.session_id).get(item.index)
+        if output and os.path.exists(output):
+            return None
+    else:
+        job = journal.get(item.session_id)
+        if job is not None and job.stage != STAGES[0]:
+            # leased before, continue from the last checkpoint
+            processor = Process.resume(job)
+            stage, data = processor.stage, processor.snapshot()
+    return {'lease_id': item.lease_id, 'session_id': item.session_id, 'room_id': item.room_id, 'kind': item.kind,
+            'index': item.index, 'stage': stage, 'data': data, 'lease_seconds': app.ctx.bot_config.lease_seconds,
+            **_settings(data['event_data'])}
+
+
+def _settings(event_data: dict) -> dict:
+    """ processing settings of the coordinator, see worker.Worker.config """
+    bot_config = app.ctx.bot_config
+    room_config = RoomConfig.init(bot_config.work_dir, event_data['RoomId'], event_data['ShortId'])
+    settings = {key: getattr(bot_config, key) for key in LEASED_SETTINGS}
+    settings['profiles'] = {name: _dashed(profile) for name, profile in bot_config.profiles.items()}
+    room = {'profile': room_config.profile if room_config else None,
+            'danmaku': _dashed(room_config.danmaku if room_config else DanmakuConfig({}))}
+    return {'settings': settings, 'room': room}
+
+
+def _dashed(config) -> dict:
+    """ a config dataclass as the dict it is built from """
+    return {key.replace('_', '-'): value for key, value in dataclasses.asdict(config).items()}
+
+
+@bp.post('/leases/<lease_id:str>/heartbeat')
+@_from_worker
+async def heartbeat(request, lease_id: str):
+    """extend a lease, 409 if it has expired or the job has been cancelled"""
+    if not request.app.ctx.lease_queue.heartbeat(lease_id, request.app.ctx.bot_config.lease_seconds):
+        return text('Lease lost.', status=409)
+    return text('done')
+
+
+@bp.post('/leases/<lease_id:str>/complete')
+@_from_worker
+async def complete_lease(request, lease_id: str):
+    """a worker finished the job, a processed session is uploaded from here"""
+    item = request.app.ctx.lease_queue.get(lease_id)
+    if item is None:
+        return text('Lease lost.', status=409)
+    if item.kind == 'session':
+        processor = await asyncio.to_thread(Process.from_snapshot, request.json['data'])
+        processor.stage = STAGES[-1]
+        finish_job(processor, processor.event_data, item.room_id)
+    request.app.ctx.lease_queue.complete(lease_id)
+    LEASES.inc(outcome='completed')
+    logger.info('%s job completed by %s.', item.kind.capitalize(), item.worker, extra={'room_id': item.room_id})
+    return text('done')
+
+
+@bp.post('/leases/<lease_id:str>/fail')
+@_from_worker
+async def fail_lease(request, lease_id: str):
+    """a worker failed the job, it is queued again until MAX_ATTEMPTS"""
+    error = (request.json or {}).get('error', '')
+    item = request.app.ctx.lease_queue.fail(lease_id, error, MAX_ATTEMPTS)
+    if item is None:
+        return text('Lease lost.', status=409)
+    LEASES.inc(outcome='failed')
+    _log_given_back(item, f'failed on {item.worker}: {error}')
+    return text('done')
+
+
+@bp.post('/leases/<lease_id:str>/journal')
+@_from_worker
+async def call_journal(request, lease_id: str):
+    """job journal of the coordinator, for the worker holding the lease"""
+    item = request.app.ctx.lease_queue.get(lease_id)
+    if item is None:
+        return text('Lease lost.', status=409)
+    method, args = request.json['method'], request.json['args']
+    if method not in JOURNAL_METHODS or not args or args[0] != item.session_id:
+        return text('Not allowed.', status=403)
+    try:
+        refused = _refuse_paths(item, method, args)
+    except (IndexError, TypeError, AttributeError, ValueError):
+        return text('Bad arguments.', status=400)
+    if refused:
+        logger.warning('Journal call %s of %s refused: %s', method, item.worker, refused,
+                       extra={'room_id': item.room_id})
+        return text(refused, status=403)
+    result = await asyncio.to_thread(getattr(request.app.ctx.job_journal, method), *args)
+    if dataclasses.is_dataclass(result):
+        result = dataclasses.asdict(result)
+    return json_response({'result': result})
+
+
+def _refuse_paths(item: LeaseItem, method: str, args: list) -> Optional[str]:
+    """ why a journal call is refused, None if it's allowed
+
+    The coordinator stats and deletes the paths recorded in the journal later, so a worker may only record
+    files in the process dir of its session, and job data of the session itself.
+    """
+    data, paths = None, []
+    if method == 'checkpoint':
+        data, paths = args[2], args[3]
+    elif method == 'segment_done':
+        paths = [args[2]]
+    elif method == 'ensure':
+        data = args[2]
+    if data is not None and (data['process_dir'] != item.payload['process_dir']
+                             or data['folder'] != item.payload['folder']):
+        return 'Job data of another session.'
+    process_dir = os.path.realpath(item.payload['process_dir'])
+    outside = [path for path in paths
+               if os.path.commonpath([os.path.realpath(path), process_dir]) != process_dir]
+    if outside:
+        return f'Paths outside {process_dir}: {outside}'
+    return None
+
+
+@bp.get('/leases')
+async def list_leases(request):
+    """jobs queued for, leased to or given up by workers"""
+    now = time.time()
+    return json_response([{
+        'id': item.id, 'session_id': item.session_id, 'room_id': item.room_id, 'kind': item.kind,
+        'index': item.index, 'state': item.state, 'worker': item.worker, 'attempts': item.attempts,
+        'expires_in': round(item.lease_expires - now, 1) if item.state == 'leased' else None, 'error': item.error,
+    } for item in request.app.ctx.lease_queue.items()])
+
+
+def _log_given_back(item: LeaseItem, reason: str):
+    if item.state == 'queued':
+        logger.warning('%s job %s, queued again.', item.kind.capitalize(), reason, extra={'room_id': item.room_id})
+        return
+    logger.error('%s job %s, given up after %d attempts.', item.kind.capitalize(), reason, item.attempts,
+                 extra={'room_id': item.room_id})
+    if item.kind == 'session':
+        app.ctx.job_journal.fail(item.session_id, reason)
+
+
+async def reclaim_leases():
+    """ give expired leases back to the queue, workers that stopped heartbeating are assumed dead """
+    pruned = app.ctx.lease_queue.prune()
+    if pruned:
+        logger.debug('Pruned %d finished remote jobs.', pruned)
+    while True:
+        await asyncio.sleep(max(1.0, app.ctx.bot_config.lease_seconds / 3))
+        for item in app.ctx.lease_queue.reclaim(MAX_ATTEMPTS):
+            LEASES.inc(outcome='expired')
+            _log_given_back(item, f'lease of {item.worker} expired')
@@ -0,0 +1,280 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Coroutine, Optional
+
+from metrics import PROCESS_JOBS
+from storage import JobCost, JobCostLog
+from utils import FlvUtils
+
+logger = logging.getLogger('bililive-uploader')
+
+# resolution assumed when a record has no metadata
+DEFAULT_MEGAPIXELS = 1920 * 1080 / 1e6
+
+
+@dataclass
+class JobFeatures:
+    """ what a processing job costs depends on
+
+    Attributes:
+        media_seconds: 视频时长(秒)
+        megapixels: 分辨率(百万像素)
+        danmaku_bytes: 弹幕文件大小
+    """
+    media_seconds: float = 0
+    megapixels: float = DEFAULT_MEGAPIXELS
+    danmaku_bytes: int = 0
+
+
+def job_features(videos: list[str], danmakus: list[str]) -> JobFeatures:
+    """ features of records, only flv headers and file sizes are read """
+    features = JobFeatures()
+    videos = [video for video in videos if os.path.exists(video)]
+    for video in videos:
+        try:
+            features.media_seconds += FlvUtils.getDuration(video)
+        except (OSError, ValueError):
+            continue
+    if videos:
+        try:
+            metadata = FlvUtils.readMetadata(videos[0])
+            if metadata.get('width') and metadata.get('height'):
+                features.megapixels = float(metadata['width']) * float(metadata['height']) / 1e6
+        except (OSError, ValueError):
+            pass
+    features.danmaku_bytes = sum(os.path.getsize(danmaku) for danmaku in danmakus if os.path.exists(danmaku))
+    return features
+
+
+class CostModel:
+    """ estimates processing time as a * media seconds * megapixels + b * danmaku MB
+
+    The coefficients are fitted by least squares on the recent finished jobs,
+    defaults are used until enough jobs have finished.
+    """
+    SAMPLES = 50
+    MIN_SAMPLES = 3
+    DEFAULT = (0.5, 1.0)
+
+    def __init__(self, costs: JobCostLog):
+        self.costs = costs
+        self.coefficients = self.DEFAULT
+        self.fit()
+
+    @staticmethod
+    def _terms(media_seconds: float, megapixels: float, danmaku_bytes: int) -> tuple[float, float]:
+        return media_seconds * megapixels, danmaku_bytes / 2 ** 20
+
+    def fit(self):
+        samples = self.costs.recent(self.SAMPLES)
+        if len(samples) < self.MIN_SAMPLES:
+            return
+        terms = [self._terms(sample.media_seconds, sample.megapixels, sample.danmaku_bytes) for sample in samples]
+        s11 = sum(x1 * x1 for x1, _ in terms)
+        s12 = sum(x1 * x2 for x1, x2 in terms)
+        s22 = sum(x2 * x2 for _, x2 in terms)
+        s1y = sum(x1 * sample.seconds for (x1, _), sample in zip(terms, samples))
+        s2y = sum(x2 * sample.seconds for (_, x2), sample in zip(terms, samples))
+        det = s11 * s22 - s12 * s12
+        a = (s1y * s22 - s2y * s12) / det if det > 1e-9 else -1
+        b = (s2y * s11 - s1y * s12) / det if det > 1e-9 else -1
+        if a < 0 or b < 0:
+            # danmaku sizes don't vary enough(or danmaku is disabled), fit the video term alone
+            a, b = (s1y / s11 if s11 else self.DEFAULT[0]), 0
+        self.coefficients = (a, b)
+
+    def estimate(self, features: JobFeatures) -> float:
+        x1, x2 = self._terms(features.media_seconds, features.megapixels, features.danmaku_bytes)
+        return self.coefficients[0] * x1 + self.coefficients[1] * x2
+
+    def learn(self, room_id: int, kind: str, features: JobFeatures, seconds: float):
+        self.costs.record(JobCost(room_id=room_id, kind=kind, media_seconds=features.media_seconds,
+                                  megapixels=features.megapixels, danmaku_bytes=features.danmaku_bytes,
+                                  seconds=seconds))
+        self.fit()
+
+
+@dataclass
+class ProcessJob:
+    """ a coroutine waiting for or running in the process pool
+
+    Attributes:
+        id: 任务id
+        session_id: 会话id
+        room_id: 直播间长号
+        kind: 任务类型(session/segment/resumed)
+        features: 成本特征
+        estimate: 预计耗时(秒)
+        submitted_at: 提交时间
+        started_at: 开始时间
+        future: 任务结果
+    """
+    id: int
+    session_id: str
+    room_id: int
+    kind: str
+    features: JobFeatures
+    estimate: float
+    submitted_at: float
+    started_at: Optional[float] = None
+    future: Future = field(default_factory=Future)
+    coroutine: Coroutine = None
+    task: asyncio.Task = None
+    loop: asyncio.AbstractEventLoop = None
+    cancel_requested: bool = False
+
+    state = property(lambda self: 'queued' if self.started_at is None else 'running')
+
+
+def _priority(job: ProcessJob, now: float) -> float:
+    """ smaller starts first """
+    return job.estimate - (now - job.submitted_at)
+
+
+class ProcessScheduler:
+    """ runs processing jobs in the process pool
+
+    At most one job of a room runs at a time and jobs of a room start in the order submitted,
+    so segments of a session are always done before the session itself. At most `slots` jobs run at
+    the same time, among rooms ready to run the job with the smallest estimated cost starts first,
+    so short sessions don't wait behind a long one. Waiting counts against the estimate,
+    so a long job is not starved by short ones.
+
+    Attributes:
+        pool: 处理线程池
+        slots: 同时运行的任务数
+        model: 成本模型
+    """
+    pool: ThreadPoolExecutor
+    slots: int
+    model: CostModel
+
+    def __init__(self, pool: ThreadPoolExecutor, slots: int, model: CostModel):
+        self.pool = pool
+        self.slots = max(1, slots)
+        self.model = model
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._queued: dict[int, ProcessJob] = {}
+        self._running: dict[int, ProcessJob] = {}
+
+    def submit(self, session_id: str, room_id: int, kind: str, coroutine: Coroutine,
+               features: JobFeatures) -> Future:
+        """ queue a coroutine, safe to call from any thread """
+        job = ProcessJob(id=next(self._ids), session_id=session_id, room_id=room_id, kind=kind, features=features,
+                         estimate=self.model.estimate(features), submitted_at=time.time(), coroutine=coroutine)
+        job.future.add_done_callback(lambda future: future.cancelled() and self._drop(job))
+        logger.debug('Queued %s job %d, estimated %.0fs.', kind, job.id, job.estimate, extra={'room_id': room_id})
+        with self._lock:
+            self._queued[job.id] = job
+            self._start_ready()
+        return job.future
+
+    def cancel(self, job_id: int) -> Optional[ProcessJob]:
+        """ drop a queued job or stop a running one
+
+        :return: the job, None if it is not found
+        """
+        with self._lock:
+            job = self._queued.get(job_id) or self._running.get(job_id)
+        if job is None:
+            return None
+        if job.future.cancel():  # still queued
+            return job
+        job.cancel_requested = True
+        if job.loop is not None:
+            with contextlib.suppress(RuntimeError):  # the job has just finished
+                job.loop.call_soon_threadsafe(job.task.cancel)
+        return job
+
+    def cancel_session(self, session_id: str) -> list[Future]:
+        """ drop queued jobs and stop running jobs of a session
+
+        :return: futures of the jobs, all done once the running ones have stopped
+        """
+        with self._lock:
+            jobs = [job for job in [*self._queued.values(), *self._running.values()] if job.session_id == session_id]
+        for job in jobs:
+            self.cancel(job.id)
+        return [job.future for job in jobs]
+
+    def jobs(self) -> list[ProcessJob]:
+        """ running jobs, then queued jobs in the order they will start """
+        with self._lock:
+            return list(self._running.values()) + self._order(list(self._queued.values()))
+
+    def queued_since(self) -> list[float]:
+        """ submit time of queued jobs """
+        with self._lock:
+            return [job.submitted_at for job in self._queued.values()]
+
+    @staticmethod
+    def _order(jobs: list[ProcessJob]) -> list[ProcessJob]:
+        """ jobs of a room in submit order, rooms by the estimate of their next job """
+        rooms: dict[int, list[ProcessJob]] = {}
+        for job in sorted(jobs, key=lambda item: item.id):
+            rooms.setdefault(job.room_id, []).append(job)
+        now = time.time()
+        queues = sorted(rooms.values(), key=lambda queue: (_priority(queue[0], now), queue[0].id))
+        return [job for queue in queues for job in queue]
+
+    def _next(self) -> Optional[ProcessJob]:
+        busy = {job.room_id for job in self._running.values()}
+        heads: dict[int, ProcessJob] = {}
+        for job in self._queued.values():
+            if job.room_id not in busy and (job.room_id not in heads or job.id < heads[job.room_id].id):
+                heads[job.room_id] = job
+        now = time.time()
+        return min(heads.values(), key=lambda job: (_priority(job, now), job.id), default=None)
+
+    def _start_ready(self):
+        """ start jobs while there are free slots, the lock must be held """
+        while len(self._running) < self.slots:
+            job = self._next()
+            if job is None:
+                return
+            del self._queued[job.id]
+            if not job.future.set_running_or_notify_cancel():
+                job.coroutine.close()
+                continue
+            job.started_at = time.time()
+            self._running[job.id] = job
+            self.pool.submit(self._run, job)
+
+    def _drop(self, job: ProcessJob):
+        """ a queued job was cancelled """
+        with self._lock:
+            if self._queued.pop(job.id, None) is None:
+                return
+        job.coroutine.close()
+        logger.info('Cancelled queued %s job %d.', job.kind, job.id, extra={'room_id': job.room_id})
+
+    def _run(self, job: ProcessJob):
+        async def main():
+            job.loop, job.task = asyncio.get_running_loop(), asyncio.current_task()
+            if job.cancel_requested:  # cancelled before the loop was known
+                job.coroutine.close()
+                raise asyncio.CancelledError
+            return await job.coroutine
+
+        PROCESS_JOBS.inc(state='running')
+        try:
+            result = asyncio.run(main())
+        except BaseException as e:  # pylint: disable=broad-except
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+            if job.kind != 'resumed':  # stages done before the restart would skew the model
+                self.model.learn(job.room_id, job.kind, job.features, time.time() - job.started_at)
+        finally:
+            PROCESS_JOBS.dec(state='running')
+            with self._lock:
+                self._running.pop(job.id, None)
+                self._start_ready()
@@ -1,52 +1,116 @@
 import asyncio
 import logging
 import os
+import time
+from concurrent.futures import Future
 from datetime import datetime
 
-import requests
 from sanic import Sanic
 
-from entity import RoomConfig, BotConfig
+from entity import RoomConfig, UploadJob
 from utils import FileUtils
 from .handler import Process
-from ..process import bp
+from .scheduler import JobFeatures, job_features
+from ..upload import submit_upload
+from ..webhook import send_webhooks
+from ..process import bp, reencoded_fraction
 
 app = Sanic.get_app()
 logger = logging.getLogger('bililive-uploader')
 
 
+def submit_job(processor: Process, coroutine, kind: str, features: JobFeatures) -> Future:
+    """ queue a coroutine for the process pool, jobs of a room run one at a time
+
+    :param processor: the job's session
+    :param coroutine:
+    :param kind: session/segment/resumed
+    :param features: what the job's cost is estimated from
+    """
+    return app.ctx.process_scheduler.submit(processor.live_info.session_id, processor.live_info.room_id, kind,
+                                            coroutine, features)
+
+
+def push_remote_job(processor: Process, kind: str, index: int = -1):
+    """ queue a job for remote workers, a job pushed before is not queued again
+
+    :param processor: the job's session
+    :param kind: session/segment
+    :param index: index of the segment
+    """
+    if app.ctx.lease_queue.push(processor.live_info.session_id, processor.live_info.room_id, kind, index,
+                                processor.snapshot()):
+        logger.debug('Queued %s job for workers.', kind, extra={'room_id': processor.live_info.room_id})
+
+
+def _features(processor: Process, segments: range) -> JobFeatures:
+    """ cost features of some segments of a session """
+    return job_features([processor.origin_video(index) for index in segments],
+                        [os.path.join(processor.folder, processor.origins[index] + '.xml') for index in segments])
+
+
+def queued_jobs() -> list[float]:
+    """ submit time of jobs waiting in the process pool """
+    return app.ctx.process_scheduler.queued_since()
+
+
 @bp.signal('session.start.<room_id:int>')
-def session_start(room_id: int, start_time: datetime):
+def session_start(room_id: int, session_id: str, start_time: datetime):
     """record session start time"""
     logger.info('Recording session started at %s',
                 start_time.isoformat(), extra={'room_id': room_id})
-    rooms = FileUtils.readJson(app.config.TIME_CACHE_PATH)
-    rooms[str(room_id)] = start_time.isoformat()
-    FileUtils.writeDict(app.config.TIME_CACHE_PATH, rooms)
+    app.ctx.session_store.start(session_id, room_id, start_time)
 
 
 @bp.signal('file.open.<room_id:int>')
-def file_open(room_id: int, file_path: str):
+def file_open(room_id: int, session_id: str, file_path: str, event_data: dict):
     """record livestream file name"""
     logger.debug('Writing record data to "%s"...', file_path, extra={'room_id': room_id})
     relative_folder, name = os.path.split(file_path)
     folder = os.path.join(app.ctx.bot_config.rec_dir, relative_folder)  # relative -> absolute
     name = os.path.splitext(name)[0]
+    session = app.ctx.session_store.get(session_id)
+    if session is not None and name in session.filenames:
+        # an event applied again after an interrupted run
+        logger.debug('%s has been recorded before.', name, extra={'room_id': room_id})
+        return
     extensions = ['.flv', '.xml'] if app.ctx.bot_config.danmaku else ['.flv']
     for extension in extensions:  # check if file exists
         if not os.path.exists(os.path.join(folder, name + extension)):
             logger.warning('%s should exist in %s, but not found',
                            name + extension, folder)
 
-    rooms = FileUtils.readJson(app.config.VIDEO_CACHE_PATH)
-    if str(room_id) not in rooms:
-        rooms[str(room_id)] = {
-            'folder': folder,
-            'filenames': [],
-            'extensions': extensions
-        }
-    rooms[str(room_id)]['filenames'].append(name)
-    FileUtils.writeDict(app.config.VIDEO_CACHE_PATH, rooms)
+    app.ctx.session_store.add_file(session_id, room_id, folder, name, extensions)
+    if app.ctx.bot_config.incremental:
+        _queue_finished_segment(room_id, session_id, event_data)
+
+
+def _queue_finished_segment(room_id: int, session_id: str, event_data: dict):
+    """ a new file opening means the previous one is finished, process it while recording """
+    session = app.ctx.session_store.get(session_id)
+    if session is None or len(session.filenames) < 2:
+        return
+    if session.start_time is None:
+        logger.debug('Session start time not recorded, skip processing while recording.', extra={'room_id': room_id})
+        return
+    room_config = RoomConfig.init(app.ctx.bot_config.work_dir, room_id, int(event_data['ShortId']))
+    processor = Process(event_data, room_config)
+    processor.load_session(session)
+    if not processor.room_allowed:
+        return
+    index = len(session.filenames) - 2
+    if app.ctx.bot_config.remote:
+        push_remote_job(processor, 'segment', index)
+        return
+
+    def log_failure(future):
+        if not future.cancelled() and future.exception():
+            logger.error('Processing segment %d failed: %r', index, future.exception(), extra={'room_id': room_id})
+
+    future = submit_job(processor, processor.process_segment(index), 'segment',
+                        _features(processor, range(index, index + 1)))
+    future.add_done_callback(log_failure)
+    app.ctx.segment_jobs.setdefault(session_id, []).append(future)
 
 
 @bp.signal('session.end.<room_id:int>')
@@ -61,54 +125,82 @@ async def session_end(room_id: int, event_data: dict, room_config: RoomConfig):
     """
     logger.info('Recording session ended.', extra={'room_id': room_id})
     processor = Process(event_data, room_config)
-    processor.live_end()
-    if processor.need_process:
+    # reading the session and probing every segment blocks, keep it off the event loop
+    if await asyncio.to_thread(_evaluate, processor):
         logger.info('Processing...', extra={'room_id': room_id})
-        bp.ctx.process_pool.sumbit(asyncio.run, _process, args=(processor, event_data, room_id))
+        if app.ctx.bot_config.remote:
+            push_remote_job(processor, 'session')
+            return
+        # segments processed while recording are not counted
+        segments = range(len(app.ctx.segment_jobs.get(processor.live_info.session_id, [])), len(processor.origins))
+        features = await asyncio.to_thread(_features, processor, segments)
+        submit_job(processor, _process(processor, event_data, room_id), 'session', features)
     else:
         logger.info('No need to process.', extra={'room_id': room_id})
+        if app.ctx.bot_config.incremental:
+            # drop segments processed while recording, running ones must stop writing before cleaning up
+            app.ctx.segment_jobs.pop(processor.live_info.session_id, None)
+            futures = app.ctx.process_scheduler.cancel_session(processor.live_info.session_id)
+            if futures:
+                await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+            app.ctx.lease_queue.cancel(processor.live_info.session_id)
+            if app.ctx.job_journal.get(processor.live_info.session_id):
+                await asyncio.to_thread(FileUtils.deleteFolder, processor.process_dir)
+                app.ctx.job_journal.finish(processor.live_info.session_id)
+
+
+def _evaluate(processor: Process) -> bool:
+    """ end the session and decide whether to process it """
+    processor.live_end()
+    return processor.need_process
+
+
+def resume_jobs():
+    """ resume jobs interrupted by last shutdown """
+    for job in app.ctx.job_journal.claim_interrupted():
+        logger.info('Resuming interrupted job from stage %s.', job.stage, extra={'room_id': job.room_id})
+        processor = Process.resume(job)
+        if app.ctx.bot_config.remote:
+            # still queued or leased unless it was processed locally before
+            push_remote_job(processor, 'session')
+            continue
+        submit_job(processor, _process(processor, processor.event_data, job.room_id), 'resumed',
+                   _features(processor, range(len(processor.origins))))
 
 
 async def _process(processor: Process, event_data: dict, room_id: int):
-    await processor.process()
-    # webhook
-    loop = asyncio.get_event_loop()
-    tasks = []
-    for url in app.ctx.bot_config.webhooks:
-        tasks += loop.create_task(send_webhook(url, event_data, processor.processes))
-    loop.run_until_complete(tasks)
+    # segments of the room run before this job, they may have failed or been cancelled
+    futures = app.ctx.segment_jobs.pop(processor.live_info.session_id, [])
+    if futures:
+        await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+    try:
+        await processor.process()
+    except asyncio.CancelledError:
+        logger.info('Processing cancelled.', extra={'room_id': room_id})
+        app.ctx.job_journal.fail(processor.live_info.session_id, 'cancelled')
+        raise
+    except Exception as e:
+        logger.exception('Processing failed.', extra={'room_id': room_id})
+        app.ctx.job_journal.fail(processor.live_info.session_id, repr(e))
+        raise
+    finish_job(processor, event_data, room_id)
+
+
+def finish_job(processor: Process, event_data: dict, room_id: int):
+    """ send webhooks and queue the upload of a processed session """
+    if processor.ended_at:
+        logger.info('Processing finished %.1fs after the session ended.', time.time() - processor.ended_at,
+                    extra={'room_id': room_id})
+    fraction = reencoded_fraction(processor.reencoded)
+    if fraction is not None:
+        logger.info('Re-encoded %.1f%% of the session.', fraction * 100, extra={'room_id': room_id})
+    videos = [processor.result(item) for item in processor.processes]
+    send_webhooks(event_data, videos)
     # upload
-    videos = [os.path.join(processor.process_dir, item) + '.flv' for item in processor.processes]
     if app.ctx.bot_config.auto_upload:
-        body = {
-            'origins': processor.origins,
-            'videos': videos,
-            'live_info': processor.live_info,
-            'folder': processor.process_dir
-        }
-        requests.post(f'http://localhost:{app.ctx.bot_config.port}/upload', json=body, timeout=100)
+        submit_upload(UploadJob(live_info=processor.live_info, videos=videos,
+                                origins=[os.path.join(processor.folder, origin) for origin in processor.origins],
+                                folder=processor.process_dir))
         logger.debug('Upload process triggered.', extra={'room_id': room_id})
+    app.ctx.job_journal.finish(processor.live_info.session_id)
 
-
-async def send_webhook(url: str, event_data: dict, videos: list[str]):
-    logger.info('Sending webhook to %s...', url)
-    bot_config: BotConfig = app.ctx.bot_config
-    body = {
-        'EventType': 'ProcessFinished',
-        'TimeStamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'BililiveData': event_data,
-        'ProceedVideos': [video.replace(bot_config.work_dir, '') for video in videos],
-        'WorkDirectory': bot_config.work_dir
-    }
-    headers = {
-        'User-Agent': 'Bililive Uploader',
-        'content-type': 'application/json'
-    }
-    for _ in range(3):
-        with requests.post(url, json=body, headers=headers, timeout=100) as response:
-            if response.status_code == 200:
-                logger.debug('Webhook sent.')
-                return
-            logger.warning('Webhook sent failed. Status code: %d', response.status_code)
-            await asyncio.sleep(0.5)
-    logger.error('Webhook sent failed. Status code: %d', response.status_code)
@@ -1,35 +1,150 @@
+import asyncio
 import logging
+import multiprocessing
 import os
-import subprocess
-from typing import Tuple
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
 
 from sanic import Sanic
 
-from exceptions import UnknownError
-from utils import FileUtils
+from entity import DanmakuConfig, EncodingProfile
+from exceptions import UnknownError, ProcessFailedException
+from metrics import COMMAND_FAILURES, ENCODED_SECONDS, ENCODED_BYTES, ENCODE_SPEED, REENCODED_FRACTION
+from utils import FileUtils, FlvUtils, DanmakuUtils
 
 app = Sanic.get_app()
 logger = logging.getLogger('bililive-uploader')
 
+# chunks of parallel encoding are at least this long(seconds)
+MIN_CHUNK_SECONDS = 300
+# smart combine copies quiet stretches at least this long(seconds), shorter ones are encoded with their neighbours
+MIN_COPY_SECONDS = 30
+# smart combine encodes the whole video when more than this fraction has danmaku on screen
+SMART_MAX_FRACTION = 0.8
+# h264 profile_idc of records libx264 can encode matching pieces for, by its profile name
+X264_PROFILES = {66: 'baseline', 77: 'main', 100: 'high'}
+
+# seconds between attempts to take a command slot
+SLOT_POLL_INTERVAL = 0.05
+
+_SLOTS: dict[str, threading.BoundedSemaphore] = {}
+_SLOTS_LOCK = threading.Lock()
+
+
+@dataclass
+class CommandResult:
+    """ result of an external command
+
+    Attributes:
+        argv: 命令参数
+        returncode: 返回值, 超时或取消时为None
+        stdout: 标准输出
+        stderr: 标准错误
+        duration: 运行时间(秒)
+    """
+    argv: list[str]
+    returncode: Optional[int]
+    stdout: str
+    stderr: str
+    duration: float
+
+    ok = property(lambda self: self.returncode == 0)
+
+
+def ffmpeg_threads() -> int:
+    """ threads used by each ffmpeg encode """
+    cpu_count = multiprocessing.cpu_count() or 1
+    return app.ctx.bot_config.ffmpeg_threads or min(cpu_count, 8)
 
-def run_shell(command: str, executable: str) -> (str, str):
-    """ Run command and return output."""
-    assert executable in ('ffmpeg', 'danmaku factory'), UnknownError(f'Unknown executable application: {executable}')
-    if executable == 'ffmpeg':
-        app_path = app.config.FFMPEG_PATH
-    else:
-        app_path = app.config.DANMAKU_FACTORY_PATH
 
-    command = command.replace('%APPLICATION', app_path)
-    logger.debug('Running shell command: \n%s', command)
-    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True) as proc:
-        stdout, stderr = proc.communicate()
-    logger.debug('stdout:\n%s\n------------\nstderr:\n%s', stdout, stderr)
+def command_slots(executable: str) -> int:
+    """ number of commands allowed to run at the same time """
+    assert executable == 'ffmpeg', UnknownError(f'Unknown executable application: {executable}')
+    cpu_count = multiprocessing.cpu_count() or 1
+    return app.ctx.bot_config.concurrency or max(1, cpu_count // ffmpeg_threads())
+
+
+def _slots(executable: str) -> threading.BoundedSemaphore:
+    """ process-wide limit of running commands, shared by all event loops of the process pool """
+    with _SLOTS_LOCK:
+        if executable not in _SLOTS:
+            size = command_slots(executable)
+            logger.debug('At most %d %s commands run at the same time.', size, executable)
+            _SLOTS[executable] = threading.BoundedSemaphore(size)
+        return _SLOTS[executable]
+
+
+async def _acquire(slots: threading.BoundedSemaphore):
+    """ wait for a slot without blocking a thread, the slots are shared by event loops of several threads """
+    while not slots.acquire(blocking=False):
+        await asyncio.sleep(SLOT_POLL_INTERVAL)
+
+
+async def run_command(argv: list[str], executable: str, timeout: float = None) -> CommandResult:
+    """ Run command without shell, waiting for a free slot first.
+
+    :param argv: arguments, without the application path
+    :param executable: ffmpeg
+    :param timeout: seconds, the process is killed when exceeded
+    :return:
+    """
+    assert executable == 'ffmpeg', UnknownError(f'Unknown executable application: {executable}')
+    app_path = app.config.FFMPEG_PATH
+    timeout = timeout or app.ctx.bot_config.command_timeout or None
 
-    return stdout.decode(), stderr.decode()
+    slots = _slots(executable)
+    await _acquire(slots)
+    start = time.monotonic()
+    try:
+        logger.debug('Running command: \n%s %s', app_path, ' '.join(argv))
+        proc = await asyncio.create_subprocess_exec(app_path, *argv, stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            proc.kill()
+            await proc.wait()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logger.error('Command timed out after %ss: %s', timeout, ' '.join(argv))
+            return CommandResult(argv, None, '', '', time.monotonic() - start)
+    finally:
+        slots.release()
+    result = CommandResult(argv, proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace'),
+                           time.monotonic() - start)
+    logger.debug('Exit code: %d, %.1fs\nstderr:\n%s', result.returncode, result.duration, result.stderr[-2000:])
+    return result
 
 
-def merge_videos(input_files: list, output_folder: str, output_file: str):
+async def run_commands(commands: list[Tuple[str, list[str]]], executable: str) -> dict[str, CommandResult]:
+    """ Run commands concurrently and report failures per file.
+
+    :param commands: [(file, argv)], file is only used to identify the command
+    :param executable: ffmpeg
+    :exception ProcessFailedException: any command failed
+    :return: {file: result}
+    """
+    results = await asyncio.gather(*[run_command(argv, executable) for _, argv in commands])
+    results = {file: result for (file, _), result in zip(commands, results)}
+    failed = {file: f'exit code: {result.returncode}' for file, result in results.items() if not result.ok}
+    for file, result in results.items():
+        if not result.ok:
+            COMMAND_FAILURES.inc(executable=executable)
+            logger.error('%s failed on %s, exit code: %s\n%s', executable, file,
+                         result.returncode, result.stderr[-2000:])
+    if failed:
+        raise ProcessFailedException(executable, failed)
+    return results
+
+
+def _filter_path(path: str) -> str:
+    """ escape a path used as a filter argument """
+    return path.replace('\\', '/').replace(':', '\\:')
+
+
+async def merge_videos(input_files: list, output_folder: str, output_file: str):
     """ Merge videos.
 
     :param input_files: input files(full path)
@@ -42,51 +157,319 @@ def merge_videos(input_files: list, output_folder: str, output_file: str):
         lines = [f"file '{input_file}'" for input_file in input_files]
         f.write('\n'.join(lines))
     output = os.path.join(output_folder, output_file)
-    command = f'%APPLICATION -f concat -safe 0 -i "{inputs}" -c copy "{output}"'
-    run_shell(command, 'ffmpeg')
+    await run_commands([(output, ['-y', '-f', 'concat', '-safe', '0', '-i', inputs, '-c', 'copy',
+                                  *_container_args(output), output])], 'ffmpeg')
 
 
-async def merge_danmaku(input_files: list, output_folder: str, output_file: str):
-    """ Merge danmaku
+async def merge_danmaku(files: list[Tuple[str, str]], output_folder: str, output_file: str):
+    """ Merge danmaku, comments of each file are shifted by the duration of the videos before it
 
-    :param input_files: input files(full path)
+    :param files: [(danmaku, video)] in order, full path
     :param output_folder: output dir
     :param output_file: output file(only name)
     :return:
     """
-    inputs = ' '.join([f'"{input_file}"' for input_file in input_files])
+    sources, offset = [], 0
+    for danmaku, video in files:
+        if os.path.exists(danmaku):
+            sources.append((danmaku, offset))
+        else:
+            logger.warning('Cannot find danmaku file: %s, skip it.', danmaku)
+        offset += FlvUtils.getDuration(video)
     output = os.path.join(output_folder, output_file)
-    command = f'%APPLICATION -o "{output}" -i {inputs} -d 50 -S 55 --ignore-warnings'
-    await run_shell(command, 'danmaku factory')
+    start = time.monotonic()
+    count = await asyncio.to_thread(DanmakuUtils.mergeXml, sources, output)
+    logger.debug('Merged %d danmakus into %s in %.1fs.', count, output, time.monotonic() - start)
+
+
+def _ass_style(config: DanmakuConfig, video: str) -> DanmakuUtils.AssStyle:
+    style = DanmakuUtils.AssStyle(font=config.font, fontsize=config.fontsize, density=config.density,
+                                  duration=config.duration, fixed_duration=config.fixed_duration,
+                                  opacity=config.opacity)
+    if os.path.exists(video):
+        metadata = FlvUtils.readMetadata(video)
+        if metadata.get('width') and metadata.get('height'):
+            style.width, style.height = int(metadata['width']), int(metadata['height'])
+    return style
 
 
-def convert_danmakus(files: list[Tuple[str, str]]):
+async def convert_danmakus(files: list[Tuple[str, str, str]], config: DanmakuConfig) -> dict[str, int]:
     """ Convert damaku files
 
-    :param files: [(input, output)]
+    :param files: [(input, output, video)], video is used to get the resolution
+    :param config: danmaku style
+    :return: {output: danmakus written}, missing inputs are left out
+    """
+
+    async def convert(input_file: str, output_file: str, video: str) -> int:
+        start = time.monotonic()
+        count = await asyncio.to_thread(DanmakuUtils.convertXml2Ass, input_file, output_file,
+                                        _ass_style(config, video))
+        logger.debug('Converted %s, %d danmakus in %.1fs.', input_file, count, time.monotonic() - start)
+        return count
+
+    existing = []
+    for file in files:
+        if os.path.exists(file[0]):
+            existing.append(file)
+        else:
+            logger.warning('Cannot find danmaku file: %s, skip it.', file[0])
+    files = existing
+    results = await asyncio.gather(*[convert(*file) for file in files], return_exceptions=True)
+    failed = {file[0]: repr(result) for file, result in zip(files, results) if isinstance(result, Exception)}
+    if failed:
+        COMMAND_FAILURES.inc(len(failed), executable='danmaku converter')
+        raise ProcessFailedException('danmaku converter', failed)
+    return {file[1]: count for file, count in zip(files, results)}
+
+
+def _container_args(output: str) -> list[str]:
+    return ['-movflags', '+faststart'] if output.endswith('.mp4') else []
+
+
+def encode_args(profile: EncodingProfile, filters: list[str]) -> list[str]:
+    """ ffmpeg output arguments of an encoding profile
+
+    :param profile:
+    :param filters: video filters applied before scaling
     :return:
     """
-    commands = []
-    for input_file, output_file in files:
-        input_file, output_file = input_file.replace('\\', '/'), output_file.replace('\\', '/')
-        commands.append(f'%APPLICATION -o "{output_file}" -i "{input_file}" -d 50 -S 55 --ignore-warnings')
-    command = ' & '.join(commands)
-    run_shell(command, 'danmaku factory')
+    if profile.max_height:
+        filters = filters + [f"scale=-2:'min(ih,{profile.max_height})'"]
+    args = ['-vf', ','.join(filters)] if filters else []
+    args += ['-c:v', profile.codec, '-preset', profile.preset]
+    if profile.bitrate:
+        args += ['-b:v', profile.bitrate, '-maxrate', profile.bitrate, '-bufsize', profile.bitrate]
+    else:
+        args += ['-crf', str(profile.crf)]
+    if profile.tune:
+        args += ['-tune', profile.tune]
+    args += ['-threads', str(profile.threads or ffmpeg_threads())]
+    args += ['-c:a', 'copy'] if profile.audio_copy else ['-c:a', 'aac', '-b:a', '192k']
+    return args
 
 
-def combine_videos_and_danmakus(files: list[Tuple[str, str, str]]):
-    """ Combine videos and danmakus
+async def encode_videos(files: list[Tuple[str, str]], profile: EncodingProfile):
+    """ Encode videos without danmaku, so they can be joined with results encoded by the same profile
+
+    :param files: [(video, output)], video may be in any container
+    :param profile: encoding profile
+    """
+    await run_commands([(output, ['-y', '-i', video, *encode_args(profile, []), *_container_args(output), output])
+                        for video, output in files], 'ffmpeg')
+
+
+def _log_encoding(video: str, output: str, seconds: float, profile_name: str):
+    duration = FlvUtils.getDuration(video)
+    if not duration or not seconds or not os.path.exists(output):
+        return
+    size = os.path.getsize(output)
+    logger.info('Encoded %s with profile %s: %.2fx realtime, %.0f kbps.', os.path.basename(output), profile_name,
+                duration / seconds, size * 8 / duration / 1000)
+    ENCODED_SECONDS.inc(duration)
+    ENCODED_BYTES.inc(size)
+    ENCODE_SPEED.observe(duration / seconds)
 
-    :param files: [(video, danmaku, output)]
+
+def _chunk_count(video: str) -> int:
+    """ chunks a video is split into for parallel encoding, 1 if it's not worth it """
+    return max(1, min(command_slots('ffmpeg'), int(FlvUtils.getDuration(video) // MIN_CHUNK_SECONDS)))
+
+
+async def combine_parallel(video: str, danmaku: str, output: str, profile: EncodingProfile, chunks: int):
+    """ Split video at keyframes, burn danmaku into chunks in parallel and join them.
+
+    :param video: source video
+    :param danmaku: ass file of the whole video
+    :param output: output file
+    :param profile: encoding profile
+    :param chunks: number of chunks
     :return:
     """
-    commands = []
+    folder = os.path.join(os.path.dirname(output), os.path.basename(output) + '.chunks')
+    FileUtils.deleteFolder(folder)
+    os.makedirs(folder)
+    try:
+        # stream copy can only cut at keyframes, the segment muxer cuts at the first keyframe after each time
+        duration = FlvUtils.getDuration(video)
+        times = ','.join(f'{duration * i / chunks:.3f}' for i in range(1, chunks))
+        chunk_list = os.path.join(folder, 'chunks.csv')
+        source_ext = os.path.splitext(video)[1]
+        await run_commands([(video, ['-y', '-i', video, '-map', '0', '-c', 'copy', '-f', 'segment',
+                                     '-segment_times', times, '-reset_timestamps', '1',
+                                     '-segment_list', chunk_list, '-segment_list_type', 'csv',
+                                     os.path.join(folder, f'source%03d{source_ext}')])], 'ffmpeg')
+        with open(chunk_list, 'r', encoding='utf-8') as f:
+            sources = [line.rsplit(',', 2)[:2] for line in f.read().splitlines() if line]
+        first = float(sources[0][1])
+        sources = [(os.path.join(folder, name), float(start) - first) for name, start in sources]
+        logger.debug('Split %s into %d chunks at %s.', video, len(sources), [start for _, start in sources])
+
+        asses = [os.path.join(folder, f'danmaku{i:03d}.ass') for i in range(len(sources))]
+        await asyncio.to_thread(DanmakuUtils.splitAss, danmaku,
+                                [(ass, start) for ass, (_, start) in zip(asses, sources)])
+        extension = os.path.splitext(output)[1]
+        outputs = [os.path.join(folder, f'result{i:03d}{extension}') for i in range(len(sources))]
+        await run_commands([(chunk_output, ['-y', '-i', source,
+                                            *encode_args(profile, [f"subtitles='{_filter_path(ass)}'"]),
+                                            chunk_output])
+                            for (source, _), ass, chunk_output in zip(sources, asses, outputs)], 'ffmpeg')
+        await merge_videos(outputs, folder, os.path.basename(output))
+        FileUtils.renameFile(os.path.join(folder, os.path.basename(output)), output)
+    finally:
+        FileUtils.deleteFolder(folder)
+
+
+def _smart_index(video: str, profile: EncodingProfile) -> Optional[FlvUtils.FlvIndex]:
+    """ index of the video if encoded pieces can be joined with copied ones, None otherwise
+
+    Encoded pieces must have the source's codec, profile, level, resolution and audio, so only h264 sources
+    of a profile libx264 can encode, with a profile that neither scales them nor converts audio, qualify.
+    """
+    if profile.codec != 'libx264' or not profile.audio_copy:
+        return None
+    index = FlvUtils.scan(video)
+    if index.video_codec != 'h264' or index.avc_profile not in X264_PROFILES or len(index.keyframe_times) < 2:
+        return None
+    if profile.max_height and not 0 < index.height <= profile.max_height:
+        return None
+    return index
+
+
+def smart_ranges(index: FlvUtils.FlvIndex, danmaku: str) -> list[tuple[float, float]]:
+    """ ranges of the video to encode, danmaku on screen widened to keyframes """
+    ranges = []
+    for start, end in DanmakuUtils.assIntervals(danmaku, MIN_COPY_SECONDS):
+        start, end = index.keyframe_before(start), index.keyframe_after(min(end, index.duration))
+        if ranges and start - ranges[-1][1] < MIN_COPY_SECONDS:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        elif end > start:
+            ranges.append((start, end))
+    # quiet stretches at both ends are copied only when long enough
+    if ranges and ranges[0][0] < MIN_COPY_SECONDS:
+        ranges[0] = (0, ranges[0][1])
+    if ranges and index.duration - ranges[-1][1] < MIN_COPY_SECONDS:
+        ranges[-1] = (ranges[-1][0], index.duration)
+    return ranges
+
+
+async def combine_smart(video: str, danmaku: str, output: str, profile: EncodingProfile,
+                        index: FlvUtils.FlvIndex, ranges: list[tuple[float, float]]) -> float:
+    """ Burn danmaku only into the ranges with danmaku on screen, copy the rest and join them.
+
+    Pieces are cut at keyframes and kept in mpeg-ts. Encoded pieces keep the source's resolution and audio
+    and take its h264 profile and level, but their SPS/PPS still differ from the source's, while the output
+    has a single sequence header(avcC). So every keyframe carries its parameter sets in-band: x264 repeats
+    its headers and copied pieces get the source's from h264_mp4toannexb. Decoders honouring in-band
+    parameter sets, like ffmpeg, play the joins, see pipeline_benchmark --verify.
+
+    :param video: source video
+    :param danmaku: ass file of the whole video
+    :param output: output file
+    :param profile: encoding profile, see _smart_index
+    :param index: index of the source video
+    :param ranges: ranges to encode, from smart_ranges
+    :return: seconds encoded
+    """
+    folder = os.path.join(os.path.dirname(output), os.path.basename(output) + '.pieces')
+    FileUtils.deleteFolder(folder)
+    os.makedirs(folder)
+    try:
+        # cut just before each keyframe, the segment muxer cuts at the first keyframe after each time
+        cuts = sorted({time for range_ in ranges for time in range_} - {0, index.duration})
+        piece_list = os.path.join(folder, 'pieces.csv')
+        times = ['-segment_times', ','.join(f'{max(cut - 0.001, 0):.3f}' for cut in cuts)] if cuts else []
+        await run_commands([(video, ['-y', '-i', video, '-map', '0', '-c', 'copy', '-bsf:v', 'h264_mp4toannexb',
+                                     '-f', 'segment', '-segment_format', 'mpegts', *times, '-reset_timestamps', '1',
+                                     '-segment_list', piece_list, '-segment_list_type', 'csv',
+                                     os.path.join(folder, 'source%03d.ts')])], 'ffmpeg')
+        with open(piece_list, 'r', encoding='utf-8') as f:
+            pieces = [line.rsplit(',', 2) for line in f.read().splitlines() if line]
+        first = float(pieces[0][1])
+        pieces = [(os.path.join(folder, name), float(start) - first, float(end) - first) for name, start, end in pieces]
+
+        def active(start: float, end: float) -> bool:
+            middle = (start + end) / 2
+            return any(range_start <= middle < range_end for range_start, range_end in ranges)
+
+        encode = [i for i, (_, start, end) in enumerate(pieces) if active(start, end)]
+        asses = {i: os.path.join(folder, f'danmaku{i:03d}.ass') for i in encode}
+        # _smart_index made sure scaling would be a no-op and audio is copied
+        args = [*encode_args(EncodingProfile({'max-height': 0}, profile), []),
+                '-profile:v', X264_PROFILES[index.avc_profile], '-level:v', f'{index.avc_level / 10:g}',
+                '-x264-params', 'repeat-headers=1', '-pix_fmt', 'yuv420p']
+        await asyncio.to_thread(DanmakuUtils.splitAss, danmaku, [(asses[i], pieces[i][1]) for i in encode])
+        outputs = [os.path.join(folder, f'result{i:03d}.ts') if i in asses else source
+                   for i, (source, _, _) in enumerate(pieces)]
+        await run_commands([(outputs[i], ['-y', '-i', pieces[i][0], '-map', '0', '-vf',
+                                          f"subtitles='{_filter_path(asses[i])}'", *args, outputs[i]])
+                            for i in encode], 'ffmpeg')
+        await merge_videos(outputs, folder, os.path.basename(output))
+        FileUtils.renameFile(os.path.join(folder, os.path.basename(output)), output)
+        return sum(pieces[i][2] - pieces[i][1] for i in encode)
+    finally:
+        FileUtils.deleteFolder(folder)
+
+
+async def combine_videos_and_danmakus(files: list[Tuple[str, str, str]], profile: EncodingProfile,
+                                      profile_name: str = '', parallel: bool = False,
+                                      smart_combine: bool = False) -> dict[str, tuple[float, float]]:
+    """ Combine videos and danmakus
+
+    :param files: [(video, danmaku, output)], container of output follows profile,
+        danmaku is None when the video should only be remuxed
+    :param profile: encoding profile
+    :param profile_name: only used in logs
+    :param parallel: split long videos into chunks encoded in parallel
+    :param smart_combine: encode only the ranges with danmaku when possible
+    :return: {output: (seconds encoded, duration)}
+    """
+    commands, encoded, tasks, result = [], {}, [], {}
     for video, danmaku, output in files:
-        if os.path.exists(danmaku):
-            video, danmaku, output = video.replace('\\', '/'), danmaku.replace('\\', '/'), output.replace('\\', '/')
-            commands.append(rf'%APPLICATION -i "{video}" -vf "subtitles=\'{danmaku}\'" "{output}"')
+        duration = FlvUtils.getDuration(video) if os.path.exists(video) else 0
+        result[output] = (duration, duration)
+        burn = danmaku is not None and os.path.exists(danmaku)
+        index = _smart_index(video, profile) if burn and smart_combine else None
+        ranges = smart_ranges(index, danmaku) if index else None
+        if ranges is not None and sum(end - start for start, end in ranges) <= duration * SMART_MAX_FRACTION:
+            tasks.append((video, output, combine_smart(video, danmaku, output, profile, index, ranges)))
+            continue
+        chunks = _chunk_count(video) if burn and parallel else 1
+        if chunks > 1:
+            tasks.append((video, output, combine_parallel(video, danmaku, output, profile, chunks)))
+        elif burn:
+            commands.append((output, ['-y', '-i', video,
+                                      *encode_args(profile, [f"subtitles='{_filter_path(danmaku)}'"]),
+                                      *_container_args(output), output]))
+            encoded[output] = video
         else:
-            logger.warning('Cannot find danmaku file: %s, skip it.', danmaku)
-            FileUtils.renameFile(video, output)
-    command = ' & '.join(commands)
-    run_shell(command, 'ffmpeg')
+            if danmaku is not None:
+                logger.warning('Cannot find danmaku file: %s, skip it.', danmaku)
+            if os.path.splitext(video)[1] == os.path.splitext(output)[1]:
+                FileUtils.renameFile(video, output)
+            else:  # remux only
+                commands.append((output, ['-y', '-i', video, '-c', 'copy', *_container_args(output), output]))
+            result[output] = (0, duration)
+
+    async def timed(task) -> tuple[float, Optional[float]]:
+        start = time.monotonic()
+        seconds_encoded = await task
+        return time.monotonic() - start, seconds_encoded
+
+    results, *timings = await asyncio.gather(run_commands(commands, 'ffmpeg'),
+                                             *[timed(task) for _, _, task in tasks])
+    for output, video in encoded.items():
+        _log_encoding(video, output, results[output].duration, profile_name)
+    for (video, output, _), (elapsed, seconds_encoded) in zip(tasks, timings):
+        if seconds_encoded is None:  # parallel
+            _log_encoding(video, output, elapsed, profile_name)
+            continue
+        duration = result[output][1]
+        result[output] = (seconds_encoded, duration)
+        logger.info('Encoded %.0f%% of %s with danmaku, copied the rest in %.1fs.',
+                    seconds_encoded / duration * 100 if duration else 0, os.path.basename(output), elapsed)
+        ENCODED_SECONDS.inc(seconds_encoded)
+    for output, (seconds_encoded, duration) in result.items():
+        if duration:
+            REENCODED_FRACTION.observe(seconds_encoded / duration)
+    return result
@@ -0,0 +1,250 @@
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Optional
+
+from sanic import Sanic
+
+from entity import BotConfig, EncodingProfile, RoomConfig
+from storage import JobRecord
+from .handler import Process
+
+app = Sanic.get_app()
+logger = logging.getLogger('bililive-uploader')
+
+# seconds between claims while the coordinator has no job
+POLL_INTERVAL = 5
+
+
+class PathMap:
+    """ translates paths between the coordinator and this machine
+
+    Attributes:
+        mapping: {协调端路径前缀: 本机路径前缀}
+    """
+    mapping: dict[str, str]
+
+    def __init__(self, mapping: dict[str, str]):
+        self.mapping = mapping
+
+    def to_local(self, value):
+        return self._map(value, self.mapping)
+
+    def to_remote(self, value):
+        return self._map(value, {local: remote for remote, local in self.mapping.items()})
+
+    @classmethod
+    def _map(cls, value, mapping: dict[str, str]):
+        """ map strings in nested dicts and lists, the longest matching prefix wins """
+        if isinstance(value, dict):
+            return {key: cls._map(item, mapping) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls._map(item, mapping) for item in value]
+        if isinstance(value, str):
+            for source in sorted(mapping, key=len, reverse=True):
+                if value == source or value.startswith(source.rstrip('/\\') + '/') \
+                        or value.startswith(source.rstrip('/\\') + '\\'):
+                    return mapping[source].rstrip('/\\') + value[len(source.rstrip('/\\')):]
+        return value
+
+
+def _request(url: str, token: str, body: dict = None, timeout: float = 60) -> Optional[bytes]:
+    """ POST json to the coordinator with the shared remote-token, None for 204 """
+    request = urllib.request.Request(url, data=json.dumps(body or {}).encode('utf-8'), method='POST',
+                                     headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return None if response.status == 204 else response.read()
+
+
+class RemoteJournal:
+    """ job journal of the coordinator, calls for a session are made with the lease of the session """
+
+    def __init__(self, url: str, token: str, path_map: PathMap):
+        self.url = url
+        self.token = token
+        self.path_map = path_map
+        self._leases: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, session_id: str, lease_id: str):
+        with self._lock:
+            self._leases[session_id] = lease_id
+
+    def detach(self, session_id: str):
+        with self._lock:
+            self._leases.pop(session_id, None)
+
+    def _call(self, method: str, session_id: str, *args):
+        with self._lock:
+            lease_id = self._leases[session_id]
+        body = {'method': method, 'args': [session_id, *self.path_map.to_remote(list(args))]}
+        response = _request(f'{self.url}/process/leases/{lease_id}/journal', self.token, body)
+        return self.path_map.to_local(json.loads(response)['result'])
+
+    def get(self, session_id: str) -> Optional[JobRecord]:
+        record = self._call('get', session_id)
+        return JobRecord(**record) if record else None
+
+    def ensure(self, session_id: str, room_id: int, data: dict):
+        self._call('ensure', session_id, room_id, data)
+
+    def segment_done(self, session_id: str, index: int, output: str, duration: float = None):
+        self._call('segment_done', session_id, index, output, duration)
+
+    def segments(self, session_id: str) -> dict[int, str]:
+        return {int(index): output for index, output in self._call('segments', session_id).items()}
+
+    def checkpoint(self, session_id: str, stage: str, data: dict, artifacts: list[str]):
+        self._call('checkpoint', session_id, stage, data, artifacts)
+
+    def merge_data(self, session_id: str, values: dict[str, dict]):
+        self._call('merge_data', session_id, values)
+
+
+class Worker:
+    """ runs processing jobs leased from a coordinator
+
+    Every slot claims a job, runs it and reports the result, then claims the next one. Leases are extended
+    from a separate thread, so stages blocking their event loop don't lose them. A job whose lease is lost
+    (expired or cancelled on the coordinator) is stopped, the coordinator gives it to another worker.
+    Jobs are processed with the settings of the coordinator sent in their lease, only settings of this
+    machine(paths, path-map, workers, concurrency, ffmpeg-threads, timeout) come from the local config.
+    Every job keeps the config of its own lease, app.ctx.bot_config stays the local one.
+
+    Attributes:
+        url: 协调端地址
+        name: worker名称
+        slots: 同时处理的任务数
+        journal: 协调端的任务日志
+    """
+    url: str
+    name: str
+    slots: int
+    journal: RemoteJournal
+
+    def __init__(self, url: str, name: str, slots: int, journal: RemoteJournal):
+        self.url = url.rstrip('/')
+        self.name = name
+        self.slots = max(1, slots)
+        self.journal = journal
+        self._lock = threading.Lock()
+        # {lease id: (event loop, task, lease seconds, last heartbeat)}
+        self._active: dict[str, tuple[asyncio.AbstractEventLoop, asyncio.Task, float, float]] = {}
+
+    def run(self):
+        """ block until interrupted, leases still held then expire on the coordinator """
+        logger.info('Worker %s started with %d slots, coordinator: %s', self.name, self.slots, self.url)
+        threading.Thread(target=self._heartbeats, name='worker-heartbeat', daemon=True).start()
+        threads = [threading.Thread(target=self._slot, name=f'worker-{i}', daemon=True) for i in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _slot(self):
+        while True:
+            try:
+                response = _request(f'{self.url}/process/leases', self.journal.token, {'worker': self.name})
+            except OSError as e:
+                logger.warning('Claiming a job failed: %r', e)
+                response = None
+            if response is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            self._run(json.loads(response))
+
+    def _run(self, lease: dict):
+        url = f'{self.url}/process/leases/{lease["lease_id"]}'
+        room = {'room_id': lease['room_id']}
+        self.journal.attach(lease['session_id'], lease['lease_id'])
+        logger.info('Processing %s job...', lease['kind'], extra=room)
+        try:
+            processor = asyncio.run(self._process(lease))
+        except asyncio.CancelledError:
+            logger.warning('Lease lost, %s job stopped.', lease['kind'], extra=room)
+            return
+        except Exception as e:
+            logger.exception('Processing failed.', extra=room)
+            self._report(url + '/fail', {'error': repr(e)}, room)
+            return
+        finally:
+            self.journal.detach(lease['session_id'])
+            with self._lock:
+                self._active.pop(lease['lease_id'], None)
+        self._report(url + '/complete', {'data': self.journal.path_map.to_remote(processor.snapshot())}, room)
+        logger.info('%s job done.', lease['kind'].capitalize(), extra=room)
+
+    async def _process(self, lease: dict) -> Process:
+        with self._lock:
+            self._active[lease['lease_id']] = (asyncio.get_running_loop(), asyncio.current_task(),
+                                               lease['lease_seconds'], time.time())
+        processor = Process.from_snapshot(self.journal.path_map.to_local(lease['data']),
+                                          RoomConfig({'id': lease['room_id'], **lease['room']}),
+                                          self.config(lease['settings']))
+        processor.stage = lease['stage']
+        if lease['kind'] == 'segment':
+            await processor.process_segment(lease['index'])
+        else:
+            await processor.process()
+        return processor
+
+    @staticmethod
+    def config(settings: dict) -> BotConfig:
+        """ local config overridden by the processing settings of a lease, see remote._settings """
+        bot_config = copy.copy(BotConfig.load(app.config.WORK_DIR))
+        settings = dict(settings)
+        bot_config.profiles = {name: EncodingProfile(profile) for name, profile in settings.pop('profiles').items()}
+        vars(bot_config).update(settings)
+        return bot_config
+
+    def _report(self, url: str, body: dict, room: dict):
+        """ the lease expires if the report is lost, the job then runs again from its last checkpoint """
+        try:
+            _request(url, self.journal.token, body)
+        except urllib.error.HTTPError as e:
+            logger.warning('Result rejected by the coordinator(%d), the lease has been lost.', e.code, extra=room)
+        except OSError as e:
+            logger.warning('Reporting the result failed: %r', e, extra=room)
+
+    def _heartbeats(self):
+        """ extend leases every third of their length """
+        while True:
+            time.sleep(1)
+            with self._lock:
+                due = [(lease_id, loop, task) for lease_id, (loop, task, seconds, last) in self._active.items()
+                       if time.time() - last >= seconds / 3]
+            for lease_id, loop, task in due:
+                try:
+                    _request(f'{self.url}/process/leases/{lease_id}/heartbeat', self.journal.token, timeout=10)
+                except urllib.error.HTTPError as e:
+                    if e.code != 409:
+                        logger.warning('Heartbeat failed: %r', e)
+                        continue
+                    with contextlib.suppress(RuntimeError):  # the job has just finished
+                        loop.call_soon_threadsafe(task.cancel)
+                except OSError as e:
+                    # keep working, the coordinator decides when the lease expires
+                    logger.warning('Heartbeat failed: %r', e)
+                    continue
+                with self._lock:
+                    if lease_id in self._active:
+                        loop, task, seconds, _ = self._active[lease_id]
+                        self._active[lease_id] = (loop, task, seconds, time.time())
+
+
+def init_worker(url: str, name: str) -> Worker:
+    """ set up the app context a job needs without the server, journal calls go to the coordinator """
+    bot_config = BotConfig.load(app.config.WORK_DIR)
+    app.ctx.bot_config = bot_config
+    if not bot_config.remote_token:
+        logger.warning('remote-token is not set, the coordinator will refuse this worker.')
+    app.ctx.job_journal = RemoteJournal(url.rstrip('/'), bot_config.remote_token, PathMap(bot_config.path_map))
+    slots = min(os.cpu_count() or 1, bot_config.workers)
+    return Worker(url, name, slots, app.ctx.job_journal)
@@ -1,76 +1,57 @@
-import asyncio
 import logging
-import queue
-import threading
-import time
 
-import schedule
-from sanic import Sanic, text, Blueprint
+from sanic import Sanic, text, json, Blueprint
 
-from entity import RoomConfig, LiveInfo, BotConfig
+from entity import UploadJob
+from .scheduler import UploadScheduler
 
 logger = logging.getLogger('bililive-uploader')
 bp = Blueprint('upload', url_prefix='/upload')
-UPLOAD_LOCK = threading.Lock()
 
 
-@bp.route('/')
-async def add_upload_video(request):
-    """add video to upload queue"""
-    data = request.json
-    if not data:
-        return text('No data received.')
+def submit_upload(job: UploadJob) -> bool:
+    """ hand a processed session to the uploader, safe to call from any thread
+
+    :return: False if the session has been queued before
+    """
     app = Sanic.get_app()
-    app.ctx.upload_queue.put(data)
-    logger.info('Received video to upload.', extra={'room_id': data['live_info'].room_id})
-    logger.debug('Details:\n %s', data)
-    _upload_videos(app.ctx.upload_queue, app.ctx.bot_config)
+    logger.info('Received video to upload.', extra={'room_id': job.room_id})
+    logger.debug('Details:\n %s', job)
+    return app.ctx.upload_scheduler.submit(job)
+
+
+@bp.route('/', methods=['POST'])
+async def add_upload_video(request):
+    """add video to upload queue, body is UploadJob.to_dict()"""
+    if not request.json:
+        return text('No data received.', status=400)
+    try:
+        job = UploadJob.from_dict(request.json)
+    except (KeyError, ValueError, TypeError) as e:
+        return text(f'Invalid upload job: {e!r}', status=400)
+    if not submit_upload(job):
+        return text('Already queued.')
     return text('Received.')
 
 
 @bp.route('/start')
 async def upload_video(_):
-    """trigger upload process manually"""
+    """trigger upload process manually, including uploads waiting for retry or failed"""
     app = Sanic.get_app()
-    _upload_videos(app.ctx.upload_queue, app.ctx.bot_config)
+    app.ctx.upload_scheduler.retry_now()
     return text('Start uploading...')
 
 
-def init_upload_thread(app: Sanic):
-    """this function will start a new thread to upload videos every day at 06:00"""
-
-    def upload_schedule(app: Sanic):
-        schedule.every().day.at('06:00').do(_upload_videos,
-                                            app.ctx.upload_queue, app.ctx.bot_config)
-        schedule.run_all()
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
-
-    # start a new thread to upload videos
-    upload_thread = threading.Thread(target=upload_schedule, args=(app,))
-    upload_thread.start()
-
-
-def _upload_videos(upload_queue: queue.Queue, bot_config: BotConfig):
-    with UPLOAD_LOCK:
-        upload_list = []
-        while not upload_queue.empty():
-            upload_list.append(upload_queue.get())
-        logger.info('Got %d videos to upload.', len(upload_list))
-        logger.debug('Details:\n %s', upload_list)
-
-        loop = asyncio.new_event_loop()
-        upload_tasks = [_dispatch(f'record.upload.{item["live_info"].room_id}',
-                                  credential=bot_config.credential,
-                                  info=item,
-                                  room_config=RoomConfig.init(bot_config.work_dir,
-                                                              item['live_info'].room_id,
-                                                              item['live_info'].short_id)
-                                  ) for item in upload_list]
-        loop.run_until_complete(asyncio.wait(upload_tasks))
-        loop.close()
+@bp.route('/status')
+async def upload_status(_):
+    """running, pending and given up uploads"""
+    app = Sanic.get_app()
+    return json(app.ctx.upload_scheduler.status())
 
 
-async def _dispatch(route: str, **kwargs):
-    await bp.dispatch(route, context=kwargs)
+def init_upload_scheduler(app: Sanic):
+    """ create the upload scheduler and run it on the server event loop """
+    bot_config = app.ctx.bot_config
+    app.ctx.upload_scheduler = UploadScheduler(app.ctx.upload_queue, bot_config.upload_concurrency,
+                                               bot_config.upload_attempts, bot_config.retry_delay)
+    app.add_task(app.ctx.upload_scheduler.run())
@@ -1,20 +1,18 @@
+import asyncio
 import logging
 import os
 
 from bilibili_api import Credential
-from bilibili_api.video_uploader import VideoUploaderPage, VideoUploader
+from bilibili_api.video_uploader import VideoUploaderPage
 from sanic import Sanic
 
-from entity import LiveInfo, UploadInfo, RoomConfig, BotConfig
+from entity import LiveInfo, UploadInfo, RoomConfig
 from exceptions import ChannelNotFoundException, UploadVideosNotFoundException
-from utils import FileUtils
+from .uploader import ResumableVideoUploader
 
 app = Sanic.get_app()
 logger = logging.getLogger('bililive-uploader')
 
-VIDEO_CHANNEL_PATH = './resources/channel.json'
-LIVE2VIDEO_MAP_PATH = 'live2video.json'
-
 
 class Upload:
     """ upload videos
@@ -30,52 +28,23 @@ class Upload:
     upload_info: UploadInfo
     room_config: RoomConfig
 
-    def __init__(self, credential: Credential, room_config: RoomConfig,
-                 live_info: LiveInfo, videos: list[str], **_):
+    def __init__(self, credential: Credential, room_config: RoomConfig, live_info: LiveInfo, videos: list[str]):
         self.credential = credential
         self.live_info = live_info
         self.upload_info = UploadInfo(room_config, videos)
         self.room_config = room_config
 
-    @staticmethod
-    def get_tid_by_channel(parent_area: str, child_area: str) -> int:
-        """ get channel tid from channel.json
-
-        :exception ChannelNotFoundException
-        """
-        channel = FileUtils.readJson(VIDEO_CHANNEL_PATH)
-        for main in channel:
-            if main['name'] == parent_area:
-                for sub in main['sub']:
-                    if sub['name'] == child_area:
-                        return sub['tid']
-        raise ChannelNotFoundException('Cannot find channel in channel.json.',
-                                       parent_area, child_area)
-
     def set_tags_and_channel(self):
         """ set tags and video channel tid
 
         :exception ChannelNotFoundException
         """
-        bot_config: BotConfig = app.ctx.bot_config
         # from room config
         self.upload_info.channel = self.room_config.channel
-        self.upload_info.tags = self.room_config.tags
+        self.upload_info.tags = list(self.room_config.tags)
 
         # from live2video.json
-        def find_channel() -> (str, str):
-            live2video = FileUtils.readJson(bot_config.path2absolute(os.path.join('resources', LIVE2VIDEO_MAP_PATH)))
-            for parent_area in live2video:
-                if parent_area.get('name') == self.live_info.parent_area:
-                    if parent_area.get('channel'):
-                        return parent_area['channel']
-                    if parent_area.get('sub'):
-                        for child_area in parent_area['sub']:
-                            if child_area.get('name') == self.live_info.child_area:
-                                return child_area['channel']
-            return None
-
-        result = find_channel()
+        result = app.ctx.channels.video_channel(self.live_info.parent_area, self.live_info.child_area)
         if result:
             self.upload_info.channel = result
 
@@ -120,7 +89,7 @@ class Upload:
         self.upload_info.title = self.live_info.fill_module_string(self.upload_info.title)
         self.upload_info.description = self.live_info.fill_module_string(self.upload_info.description)
         self.set_tags_and_channel()
-        tid = self.get_tid_by_channel(*self.upload_info.channel)
+        tid = app.ctx.channels.tid(*self.upload_info.channel)
         meta = {
             'act_reserve_create': 0,
             'copyright': 2,  # 转载
@@ -146,8 +115,12 @@ class Upload:
         pages = self.set_pages(self.upload_info.videos)
         if len(pages) == 0:
             raise UploadVideosNotFoundException('Cannot find videos to upload.')
-        uploader = VideoUploader(pages=pages, meta=meta, credential=self.credential)
+        uploader = ResumableVideoUploader(pages=pages, meta=meta, credential=self.credential,
+                                          store=app.ctx.upload_sessions)
         logger.info('Uploading videos...', extra={'room_id': self.live_info.room_id})
         ids = await uploader.start()
+        if ids is None:
+            raise asyncio.CancelledError()
+        app.ctx.upload_sessions.clear([page.path for page in pages])
         logger.info('Upload videos success. bvid=%s, aid=%s', ids['bvid'], ids['aid'],
                     extra={'room_id': self.live_info.room_id})
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+from sanic import Sanic
+
+from entity import RoomConfig, UploadJob
+from metrics import STAGE_SECONDS, UPLOADS
+from storage import UploadQueue, QueueItem
+
+logger = logging.getLogger('bililive-uploader')
+
+MAX_RETRY_DELAY = 6 * 3600
+# uploads pushed by other workers are noticed within this time(seconds)
+POLL_INTERVAL = 30
+
+
+class UploadScheduler:
+    """ runs uploads from the upload queue on the server event loop
+
+    At most `concurrency` uploads run at the same time, due items are claimed oldest session first.
+    A failed upload is retried with exponential backoff and jitter, and is marked failed
+    after `max_attempts` failures.
+
+    Attributes:
+        queue: 上传队列
+        concurrency: 同时上传数
+        max_attempts: 最大尝试次数
+        retry_delay: 首次重试间隔(秒)
+    """
+    queue: UploadQueue
+    concurrency: int
+    max_attempts: int
+    retry_delay: float
+
+    def __init__(self, queue: UploadQueue, concurrency: int, max_attempts: int, retry_delay: float):
+        self.queue = queue
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self._running: dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._loop = None
+
+    def submit(self, job: UploadJob) -> bool:
+        """ queue an upload, safe to call from any thread
+
+        :return: False if the session has been queued before
+        """
+        start_time = job.live_info.start_time.timestamp() if job.live_info.start_time else time.time()
+        size = sum(os.path.getsize(video) for video in job.videos if os.path.exists(video))
+        if not self.queue.push(job.session_id, job.room_id, job.to_dict(), start_time, size):
+            logger.info('Session %s has been queued before.', job.session_id, extra={'room_id': job.room_id})
+            return False
+        self._wake()
+        return True
+
+    def retry_now(self):
+        """ start waiting and failed uploads now """
+        self.queue.retry_all()
+        self._wake()
+
+    def _wake(self):
+        """ wake the scheduling loop, which may be running in another thread """
+        if self._loop is None:
+            return
+        try:
+            same_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            same_loop = False
+        if same_loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def status(self) -> dict:
+        def describe(item: QueueItem) -> dict:
+            return {'session_id': item.session_id, 'room_id': item.room_id, 'state': item.state,
+                    'attempts': item.attempts, 'next_attempt': item.next_attempt, 'error': item.error}
+        return {'running': list(self._running),
+                'queue': [describe(item) for item in self.queue.items(('pending', 'in_progress', 'failed'))]}
+
+    async def run(self):
+        """ scheduling loop, sleeps until an upload is submitted, finished or due """
+        self._loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            timeout = POLL_INTERVAL
+            if len(self._running) < self.concurrency:
+                self._start_ready()
+                due = self.queue.next_due()
+                if due is not None:
+                    timeout = min(max(due - time.time(), 0), POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_ready(self):
+        while len(self._running) < self.concurrency:
+            item = self.queue.claim()
+            if item is None:
+                return
+            self._running[item.session_id] = asyncio.create_task(self._upload(item))
+
+    async def _upload(self, item: QueueItem):
+        app = Sanic.get_app()
+        bot_config = app.ctx.bot_config
+        try:
+            job = UploadJob.from_dict(item.payload)
+            logger.info('Uploading session %s, attempt %d.', item.session_id, item.attempts + 1,
+                        extra={'room_id': item.room_id})
+            room_config = RoomConfig.init(bot_config.work_dir, job.room_id, job.live_info.short_id)
+            with STAGE_SECONDS.time(stage='upload'):
+                await app.dispatch(f'record.upload.{job.room_id}', inline=True,
+                                   context={'job': job, 'room_config': room_config,
+                                            'credential': bot_config.credential})
+            self.queue.ack(item.session_id)
+            UPLOADS.inc(outcome='done')
+        except Exception as e:
+            attempts = item.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error('Uploading failed %d times, giving up: %r', attempts, e, extra={'room_id': item.room_id})
+                self.queue.nack(item.session_id, repr(e), None)
+                UPLOADS.inc(outcome='failed')
+            else:
+                delay = min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+                logger.warning('Uploading failed: %r, retry in %.0fs.', e, delay, extra={'room_id': item.room_id})
+                self.queue.nack(item.session_id, repr(e), time.time() + delay)
+                UPLOADS.inc(outcome='retry')
+        finally:
+            self._running.pop(item.session_id, None)
+            self._wakeup.set()
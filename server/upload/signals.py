@@ -3,8 +3,8 @@ import logging
 from bilibili_api import Credential
 from sanic import Sanic
 
-from entity import BotConfig, RoomConfig
-from exceptions import ChannelNotFoundException, UploadVideosNotFoundException
+from entity import BotConfig, RoomConfig, UploadJob
+from exceptions import UnknownError
 from utils import FileUtils
 from .handler import Upload
 from ..upload import bp
@@ -13,28 +13,25 @@ logger = logging.getLogger('bililive-uploader')
 
 
 @bp.signal('record.upload.<room_id:int>')
-async def start_upload(room_id: int, room_config: RoomConfig, credential: Credential, info: dict):
+async def start_upload(room_id: int, room_config: RoomConfig, credential: Credential, job: UploadJob):
     """ 开始上传
-    从上传队列中取出视频并上传
+    由上传调度器调用
 
     :param room_id
     :param room_config
     :param credential
-    :param info: {videos, live_info, folder}
+    :param job
+    :exception: any exception means the upload failed, the scheduler retries it
     :return:
     """
     app = Sanic.get_app()
     bot_config: BotConfig = app.ctx.bot_config
-    uploader = Upload(room_config=room_config, credential=credential, **info)
-    origins = info['origins']
-    folder = info['folder']
-    try:
-        await uploader.upload()
-        logger.info('Uploaded successfully.', extra={'room_id': room_id})
-        FileUtils.deleteFolder(folder)
-        if bot_config.delete:
-            files = [origin + extension for origin in origins for extension in ('.flv', '.xml')]
-            FileUtils.deleteFiles(files)
-    except (ChannelNotFoundException, UploadVideosNotFoundException) as _:
-        logger.error('Uploading failed.', extra={'room_id': room_id})
-        app.ctx.upload_queue.put(info)
+    if room_config is None:
+        raise UnknownError(f'Room {room_id} not found in config.')
+    uploader = Upload(room_config=room_config, credential=credential, live_info=job.live_info, videos=job.videos)
+    await uploader.upload()
+    logger.info('Uploaded successfully.', extra={'room_id': room_id})
+    FileUtils.deleteFolder(job.folder)
+    if bot_config.delete:
+        files = [origin + extension for origin in job.origins for extension in ('.flv', '.xml')]
+        FileUtils.deleteFiles(files)
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import random
+
+from bilibili_api import Credential
+from bilibili_api.exceptions import ApiException, NetworkException
+from bilibili_api.video_uploader import VideoUploader, VideoUploaderPage
+
+from storage import UploadPage, UploadSessionStore
+
+logger = logging.getLogger('bililive-uploader')
+
+CHUNK_RETRIES = 5
+RETRY_DELAY = 2
+
+
+class ResumableVideoUploader(VideoUploader):
+    """ VideoUploader that saves the progress of each page
+
+    Uploaded chunks and submitted pages are recorded in the store, a retry after a failure or
+    a restart continues from the last acknowledged chunk instead of uploading the page again.
+
+    Attributes:
+        store: 上传进度存储
+    """
+    store: UploadSessionStore
+
+    def __init__(self, pages: list[VideoUploaderPage], meta: dict, credential: Credential,
+                 store: UploadSessionStore, **kwargs):
+        super().__init__(pages=pages, meta=meta, credential=credential, **kwargs)
+        self.store = store
+
+    async def _upload_page(self, page: VideoUploaderPage) -> dict:
+        state = self.store.get(page.path)
+        if state is not None and state.result is not None:
+            logger.info('%s has been uploaded before, skip it.', page.path)
+            return state.result
+        if state is not None:
+            logger.info('Resuming %s from chunk %d/%d.', page.path, len(state.chunks), state.total_chunks)
+            try:
+                return await self._upload_chunks(page, state)
+            except ApiException as e:
+                # the upload session may have expired
+                logger.warning('Resuming %s failed: %s, start over.', page.path, e)
+        state = self.store.start(page.path, await self._preupload(page))
+        return await self._upload_chunks(page, state)
+
+    async def _upload_chunks(self, page: VideoUploaderPage, state: UploadPage) -> dict:
+        total = state.total_chunks
+        pending = [chunk for chunk in range(total) if chunk not in state.chunks]
+        semaphore = asyncio.Semaphore(state.preupload.get('threads') or 3)
+
+        async def upload(chunk: int):
+            async with semaphore:
+                for attempt in range(CHUNK_RETRIES):
+                    result = await self._upload_chunk(page, chunk * state.chunk_size, chunk, total, state.preupload)
+                    if result['ok']:
+                        self.store.chunk_done(page.path, chunk)
+                        return
+                    await asyncio.sleep(RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+                raise NetworkException(-1, f'Uploading chunk {chunk} of {page.path} failed.')
+
+        tasks = [asyncio.create_task(upload(chunk)) for chunk in pending]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        result = await self._complete_page(page, total, state.preupload, state.preupload['upload_id'])
+        self.store.page_done(page.path, result)
+        return result
@@ -0,0 +1,44 @@
+import logging
+from datetime import datetime
+
+from sanic import Sanic, json, Blueprint
+
+from .sender import WebhookSender
+
+logger = logging.getLogger('bililive-uploader')
+bp = Blueprint('webhook', url_prefix='/webhook')
+
+
+def send_webhooks(event_data: dict, videos: list[str]):
+    """ queue a ProcessFinished webhook for every configured url, safe to call from any thread
+
+    :param event_data: 录播姬事件数据
+    :param videos: 处理后的视频(完整路径)
+    """
+    app = Sanic.get_app()
+    bot_config = app.ctx.bot_config
+    body = {
+        'EventType': 'ProcessFinished',
+        'TimeStamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'BililiveData': event_data,
+        'ProceedVideos': [video.replace(bot_config.work_dir, '') for video in videos],
+        'WorkDirectory': bot_config.work_dir
+    }
+    for url in bot_config.webhooks:
+        logger.info('Sending webhook to %s...', url)
+        app.ctx.webhook_sender.submit(url, body)
+
+
+@bp.route('/status')
+async def webhook_status(_):
+    """outbox size and delivery counters of each url"""
+    app = Sanic.get_app()
+    return json(app.ctx.webhook_sender.status())
+
+
+def init_webhook_sender(app: Sanic):
+    """ create the webhook sender and run it on the server event loop """
+    bot_config = app.ctx.bot_config
+    app.ctx.webhook_sender = WebhookSender(app.ctx.webhook_outbox, bot_config.webhook_concurrency,
+                                           bot_config.webhook_attempts)
+    app.add_task(app.ctx.webhook_sender.run())
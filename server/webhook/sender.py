@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, asdict
+
+import aiohttp
+
+from metrics import WEBHOOKS
+from storage import WebhookOutbox, OutboxItem
+
+logger = logging.getLogger('bililive-uploader')
+
+HEADERS = {'User-Agent': 'Bililive Uploader'}
+TIMEOUT = 30
+# webhooks sent at the same time, across all endpoints
+MAX_IN_FLIGHT = 32
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 3600
+POLL_INTERVAL = 30
+
+
+@dataclass
+class EndpointStats:
+    """ delivery counters of one endpoint
+
+    Attributes:
+        sent: 发送成功次数
+        failed: 发送失败次数
+        given_up: 放弃发送的webhook数
+        latency_total: 请求总耗时(秒)
+        latency_max: 最长请求耗时(秒)
+        last_error: 最近一次失败原因
+    """
+    sent: int = 0
+    failed: int = 0
+    given_up: int = 0
+    latency_total: float = 0
+    latency_max: float = 0
+    last_error: str = None
+
+    def observe(self, latency: float):
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def to_dict(self) -> dict:
+        requests = self.sent + self.failed
+        return {**asdict(self), 'latency_avg': self.latency_total / requests if requests else 0}
+
+
+class WebhookSender:
+    """ delivers webhooks from the outbox on the server event loop
+
+    All requests share one pooled client session. Each endpoint gets at most `concurrency` requests at
+    the same time, a failed delivery is retried with exponential backoff and jitter, and is marked failed
+    after `max_attempts` failures.
+
+    Attributes:
+        outbox: webhook发件箱
+        concurrency: 每个地址的同时请求数
+        max_attempts: 最大尝试次数
+        stats: {url: 发送统计}
+    """
+    outbox: WebhookOutbox
+    concurrency: int
+    max_attempts: int
+    stats: dict[str, EndpointStats]
+
+    def __init__(self, outbox: WebhookOutbox, concurrency: int, max_attempts: int):
+        self.outbox = outbox
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.stats = {}
+        self._limits: dict[str, asyncio.Semaphore] = {}
+        self._running: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._loop = None
+
+    def submit(self, url: str, body: dict):
+        """ queue a webhook, safe to call from any thread """
+        self.outbox.push(url, body)
+        self._wake()
+
+    def _wake(self):
+        """ wake the sending loop, which may be running in another thread """
+        if self._loop is None:
+            return
+        try:
+            same_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            same_loop = False
+        if same_loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def status(self) -> dict:
+        return {'outbox': self.outbox.counts(), 'in_flight': len(self._running),
+                'endpoints': {url: stats.to_dict() for url, stats in self.stats.items()}}
+
+    async def run(self):
+        """ sending loop, sleeps until a webhook is submitted, finished or due """
+        self._loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(limit=MAX_IN_FLIGHT)
+        async with aiohttp.ClientSession(connector=connector, headers=HEADERS,
+                                         timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as session:
+            while True:
+                self._wakeup.clear()
+                timeout = POLL_INTERVAL
+                if len(self._running) < MAX_IN_FLIGHT:
+                    for item in self.outbox.claim(MAX_IN_FLIGHT - len(self._running)):
+                        task = asyncio.create_task(self._deliver(session, item))
+                        self._running.add(task)
+                        task.add_done_callback(self._finished)
+                    due = self.outbox.next_due()
+                    if due is not None:
+                        timeout = min(max(due - time.time(), 0), POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _finished(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def _deliver(self, session: aiohttp.ClientSession, item: OutboxItem):
+        stats = self.stats.setdefault(item.url, EndpointStats())
+        limit = self._limits.setdefault(item.url, asyncio.Semaphore(self.concurrency))
+        async with limit:
+            start = time.monotonic()
+            try:
+                async with session.post(item.url, json=item.body) as response:
+                    if response.status // 100 != 2:
+                        raise aiohttp.ClientError(f'status code: {response.status}')
+            except Exception as e:
+                stats.observe(time.monotonic() - start)
+                stats.failed += 1
+                stats.last_error = repr(e)
+                WEBHOOKS.inc(url=item.url, outcome='failed')
+                self._retry(item, stats, e)
+                return
+            stats.observe(time.monotonic() - start)
+        stats.sent += 1
+        WEBHOOKS.inc(url=item.url, outcome='sent')
+        self.outbox.ack(item.id)
+        logger.debug('Webhook sent to %s.', item.url)
+
+    def _retry(self, item: OutboxItem, stats: EndpointStats, error: Exception):
+        attempts = item.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error('Sending webhook to %s failed %d times, giving up: %r', item.url, attempts, error)
+            stats.given_up += 1
+            WEBHOOKS.inc(url=item.url, outcome='given_up')
+            self.outbox.nack(item.id, repr(error), None)
+            return
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+        logger.warning('Sending webhook to %s failed: %r, retry in %.0fs.', item.url, error, delay)
+        self.outbox.nack(item.id, repr(error), time.time() + delay)
@@ -0,0 +1,8 @@
+from .database import *
+from .session import *
+from .job import *
+from .upload import *
+from .queue import *
+from .outbox import *
+from .event import *
+from .lease import *
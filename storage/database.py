@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+__all__ = ['Database']
+
+
+class Database:
+    """ sqlite database shared by workers
+
+    Each thread (and each forked worker process) gets its own connection,
+    the database runs in WAL mode so readers never block the writer.
+
+    Attributes:
+        path: 数据库文件路径
+    """
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._schemas: list[str] = []
+
+    def register(self, schema: str):
+        """ register a schema script, executed once per connection """
+        self._schemas.append(schema)
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.executescript(schema)
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        for schema in self._schemas:
+            conn.executescript(schema)
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """ write transaction, the write lock is taken up front to avoid deadlocks between workers """
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.connect().execute(sql, parameters)
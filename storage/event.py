@@ -0,0 +1,108 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+
+__all__ = ['EventRecord', 'EventLog']
+
+
+@dataclass
+class EventRecord:
+    """ a BililiveRecorder webhook waiting to be applied
+
+    Attributes:
+        id: 自增id, 即接收顺序
+        room_id: 直播间长号
+        session_id: 会话id
+        event_type: 事件类型
+        body: 请求体
+        received_at: 接收时间(time.time())
+    """
+    id: int
+    room_id: int
+    session_id: str
+    event_type: str
+    body: dict
+    received_at: float
+
+
+class EventLog:
+    """ persistent log of received webhooks
+
+    Events are appended as they arrive and applied later by a consumer. Claiming only returns the oldest
+    pending event of rooms without an event in progress, so events of a room are applied one by one
+    in the order received, even with several workers consuming.
+    Applied events are kept for RETENTION seconds.
+    """
+    RETENTION = 7 * 24 * 3600
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room_id INTEGER NOT NULL,
+        session_id TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        body TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        received_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS events_state ON events (state, room_id, id);
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def append(self, room_id: int, session_id: str, event_type: str, body: dict) -> int:
+        now = time.time()
+        cursor = self.database.execute(
+            'INSERT INTO events (room_id, session_id, event_type, body, received_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (room_id, session_id, event_type, json.dumps(body), now, now))
+        return cursor.lastrowid
+
+    def claim(self, limit: int) -> list[EventRecord]:
+        """ take the oldest pending event of up to `limit` idle rooms """
+        with self.database.transaction() as conn:
+            rows = conn.execute(
+                "SELECT * FROM events WHERE id IN (SELECT MIN(id) FROM events WHERE state = 'pending' "
+                "AND room_id NOT IN (SELECT room_id FROM events WHERE state = 'in_progress') GROUP BY room_id) "
+                'ORDER BY id LIMIT ?', (limit,)).fetchall()
+            conn.executemany("UPDATE events SET state = 'in_progress', updated_at = ? WHERE id = ?",
+                             [(time.time(), row['id']) for row in rows])
+        return [EventRecord(id=row['id'], room_id=row['room_id'], session_id=row['session_id'],
+                            event_type=row['event_type'], body=json.loads(row['body']),
+                            received_at=row['received_at']) for row in rows]
+
+    def done(self, event_id: int):
+        self.database.execute("UPDATE events SET state = 'done', updated_at = ? WHERE id = ?",
+                              (time.time(), event_id))
+
+    def fail(self, event_id: int, error: str):
+        """ failed events are kept, later events of the room are still applied """
+        self.database.execute("UPDATE events SET state = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                              (error, time.time(), event_id))
+
+    def recover(self) -> int:
+        """ give back events left in progress by a previous run, called once on startup """
+        cursor = self.database.execute("UPDATE events SET state = 'pending' WHERE state = 'in_progress'")
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """ delete applied events older than RETENTION """
+        cursor = self.database.execute("DELETE FROM events WHERE state = 'done' AND updated_at < ?",
+                                       (time.time() - self.RETENTION,))
+        return cursor.rowcount
+
+    def oldest_pending(self) -> Optional[float]:
+        """ receive time of the oldest event not applied yet """
+        row = self.database.execute("SELECT MIN(received_at) AS received_at FROM events "
+                                    "WHERE state IN ('pending', 'in_progress')").fetchone()
+        return row['received_at']
+
+    def counts(self) -> dict[str, int]:
+        """ number of events in each state """
+        rows = self.database.execute('SELECT state, COUNT(*) AS count FROM events GROUP BY state')
+        return {row['state']: row['count'] for row in rows}
@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from utils import FileUtils
+from .database import Database
+
+logger = logging.getLogger('bililive-uploader')
+__all__ = ['STAGES', 'JobRecord', 'JobJournal', 'JobCost', 'JobCostLog']
+
+STAGES = ('created', 'staged', 'merged', 'danmaku', 'combined')
+
+
+@dataclass
+class JobRecord:
+    """ a processing job
+
+    Attributes:
+        session_id: 会话id
+        room_id: 直播间长号
+        stage: 已完成的阶段
+        state: 任务状态(running/interrupted/finished/failed)
+        data: 恢复任务所需的数据
+    """
+    session_id: str
+    room_id: int
+    stage: str
+    state: str
+    data: dict
+
+
+class JobJournal:
+    """ persistent journal of processing jobs
+
+    Records the last completed stage of each job and the artifacts it produced,
+    so that an interrupted job can resume from its last checkpoint.
+    Finished jobs are kept for RETENTION seconds.
+    """
+    RETENTION = 7 * 24 * 3600
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        session_id TEXT PRIMARY KEY,
+        room_id INTEGER NOT NULL,
+        stage TEXT NOT NULL,
+        state TEXT NOT NULL,
+        data TEXT NOT NULL,
+        error TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS job_artifacts (
+        session_id TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (session_id, path)
+    );
+    CREATE TABLE IF NOT EXISTS job_segments (
+        session_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        output TEXT NOT NULL,
+        duration REAL,
+        PRIMARY KEY (session_id, idx)
+    );
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def get(self, session_id: str) -> Optional[JobRecord]:
+        row = self.database.execute('SELECT * FROM jobs WHERE session_id = ?', (session_id,)).fetchone()
+        return self._to_record(row) if row else None
+
+    def ensure(self, session_id: str, room_id: int, data: dict):
+        """ create the job if it doesn't exist, a job interrupted while recording is running again """
+        self.database.execute('INSERT INTO jobs (session_id, room_id, stage, state, data, updated_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?) '
+                              "ON CONFLICT (session_id) DO UPDATE SET state = 'running' WHERE state = 'interrupted'",
+                              (session_id, room_id, STAGES[0], 'running', json.dumps(data), time.time()))
+
+    def segment_done(self, session_id: str, index: int, output: str, duration: float = None):
+        """ record a segment processed while recording
+
+        :param duration: seconds of the original video
+        """
+        self.database.execute('INSERT OR REPLACE INTO job_segments (session_id, idx, output, duration) '
+                              'VALUES (?, ?, ?, ?)', (session_id, index, output, duration))
+
+    def segments(self, session_id: str) -> dict[int, str]:
+        """ processed segments, {index: output} """
+        rows = self.database.execute('SELECT idx, output FROM job_segments WHERE session_id = ?', (session_id,))
+        return {row['idx']: row['output'] for row in rows}
+
+    def segment_durations(self, session_id: str) -> dict[int, float]:
+        """ original video duration of processed segments, {index: seconds} """
+        rows = self.database.execute('SELECT idx, duration FROM job_segments '
+                                     'WHERE session_id = ? AND duration IS NOT NULL', (session_id,))
+        return {row['idx']: row['duration'] for row in rows}
+
+    def checkpoint(self, session_id: str, stage: str, data: dict, artifacts: list[str]):
+        """ mark stage as completed, artifacts are the files the next stage starts from """
+        assert stage in STAGES, f'Unknown stage: {stage}'
+        fingerprints = [(session_id, path, *self._fingerprint(path)) for path in artifacts if os.path.exists(path)]
+        with self.database.transaction() as conn:
+            conn.execute('UPDATE jobs SET stage = ?, data = ?, updated_at = ? WHERE session_id = ?',
+                         (stage, json.dumps(data), time.time(), session_id))
+            conn.execute('DELETE FROM job_artifacts WHERE session_id = ?', (session_id,))
+            conn.executemany('INSERT INTO job_artifacts (session_id, path, size, mtime, hash) '
+                             'VALUES (?, ?, ?, ?, ?)', fingerprints)
+
+    def merge_data(self, session_id: str, values: dict[str, dict]):
+        """ merge values into dicts of the job data, for results of segments processed beside the job """
+        with self.database.transaction() as conn:
+            row = conn.execute('SELECT data FROM jobs WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return
+            data = json.loads(row['data'])
+            for key, value in values.items():
+                data.setdefault(key, {}).update(value)
+            conn.execute('UPDATE jobs SET data = ?, updated_at = ? WHERE session_id = ?',
+                         (json.dumps(data), time.time(), session_id))
+
+    def finish(self, session_id: str):
+        self._set_state(session_id, 'finished')
+        self.database.execute('DELETE FROM job_artifacts WHERE session_id = ?', (session_id,))
+        self.database.execute('DELETE FROM job_segments WHERE session_id = ?', (session_id,))
+
+    def fail(self, session_id: str, error: str):
+        self._set_state(session_id, 'failed', error)
+
+    def interrupt_running(self) -> int:
+        """ mark jobs left running by a previous run as interrupted, called once on startup """
+        cursor = self.database.execute("UPDATE jobs SET state = 'interrupted' WHERE state = 'running'")
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """ delete finished jobs older than RETENTION """
+        cursor = self.database.execute("DELETE FROM jobs WHERE state = 'finished' AND updated_at < ?",
+                                       (time.time() - self.RETENTION,))
+        return cursor.rowcount
+
+    def claim_interrupted(self) -> list[JobRecord]:
+        """ take over interrupted jobs, each job is claimed by only one worker
+
+        Jobs of sessions still recording are left interrupted, they are processed when the session ends.
+        """
+        with self.database.transaction() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE state = 'interrupted' ORDER BY updated_at").fetchall()
+            records = [record for record in map(self._to_record, rows)
+                       if record.data.get('ended_at', 0) is not None]
+            conn.executemany("UPDATE jobs SET state = 'running' WHERE session_id = ? AND state = 'interrupted'",
+                             [(record.session_id,) for record in records])
+        return records
+
+    def verify(self, session_id: str) -> bool:
+        """ check whether artifacts of the last checkpoint are still intact """
+        rows = self.database.execute('SELECT * FROM job_artifacts WHERE session_id = ?', (session_id,)).fetchall()
+        for row in rows:
+            if not os.path.exists(row['path']):
+                logger.warning('Artifact %s is missing.', row['path'])
+                return False
+            size, mtime, _ = self._fingerprint(row['path'], with_hash=False)
+            if size != row['size']:
+                logger.warning('Artifact %s has changed.', row['path'])
+                return False
+            if mtime != row['mtime'] and FileUtils.sampleHash(row['path']) != row['hash']:
+                logger.warning('Artifact %s has changed.', row['path'])
+                return False
+        return True
+
+    def jobs(self, states: tuple[str, ...] = None, limit: int = -1) -> list[JobRecord]:
+        """ the `limit` latest updated jobs in given states, all states if states is None, all jobs if limit < 0 """
+        where = f'WHERE state IN ({",".join("?" * len(states))}) ' if states is not None else ''
+        rows = self.database.execute(f'SELECT * FROM (SELECT * FROM jobs {where}ORDER BY updated_at DESC LIMIT ?) '
+                                     'ORDER BY updated_at', (*(states or ()), limit)).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def _set_state(self, session_id: str, state: str, error: str = None):
+        self.database.execute('UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE session_id = ?',
+                              (state, error, time.time(), session_id))
+
+    @staticmethod
+    def _fingerprint(path: str, with_hash=True) -> (int, float, str):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime, FileUtils.sampleHash(path) if with_hash else ''
+
+    @staticmethod
+    def _to_record(row) -> JobRecord:
+        return JobRecord(session_id=row['session_id'], room_id=row['room_id'], stage=row['stage'],
+                         state=row['state'], data=json.loads(row['data']))
+
+
+@dataclass
+class JobCost:
+    """ resources and time spent by a finished processing job
+
+    Attributes:
+        room_id: 直播间长号
+        kind: 任务类型(session/segment)
+        media_seconds: 视频时长(秒)
+        megapixels: 分辨率(百万像素)
+        danmaku_bytes: 弹幕文件大小
+        seconds: 处理耗时(秒)
+    """
+    room_id: int
+    kind: str
+    media_seconds: float
+    megapixels: float
+    danmaku_bytes: int
+    seconds: float
+
+
+class JobCostLog:
+    """ recent processing costs, for estimating how long a queued job will take """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS job_costs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        media_seconds REAL NOT NULL,
+        megapixels REAL NOT NULL,
+        danmaku_bytes INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        finished_at REAL NOT NULL
+    );
+    '''
+    # costs kept in the table
+    KEEP = 1000
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def record(self, cost: JobCost):
+        with self.database.transaction() as conn:
+            conn.execute('INSERT INTO job_costs (room_id, kind, media_seconds, megapixels, danmaku_bytes, seconds, '
+                         'finished_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (cost.room_id, cost.kind, cost.media_seconds, cost.megapixels, cost.danmaku_bytes,
+                          cost.seconds, time.time()))
+            conn.execute('DELETE FROM job_costs WHERE id <= (SELECT MAX(id) FROM job_costs) - ?', (self.KEEP,))
+
+    def recent(self, limit: int) -> list[JobCost]:
+        rows = self.database.execute('SELECT * FROM job_costs ORDER BY id DESC LIMIT ?', (limit,))
+        return [JobCost(room_id=row['room_id'], kind=row['kind'], media_seconds=row['media_seconds'],
+                        megapixels=row['megapixels'], danmaku_bytes=row['danmaku_bytes'], seconds=row['seconds'])
+                for row in rows]
@@ -0,0 +1,182 @@
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+
+__all__ = ['LeaseItem', 'LeaseQueue']
+
+
+@dataclass
+class LeaseItem:
+    """ a processing job for remote workers
+
+    Attributes:
+        id: 自增id
+        session_id: 会话id
+        room_id: 直播间长号
+        kind: 任务类型(session/segment)
+        index: 分段序号, 整场任务为-1
+        payload: 处理所需的数据
+        state: 状态(queued/leased/done/failed/cancelled)
+        worker: 租用的worker
+        lease_id: 租约id
+        lease_expires: 租约到期时间(time.time())
+        attempts: 租约失效或失败的次数
+        error: 最近一次失败原因
+    """
+    id: int
+    session_id: str
+    room_id: int
+    kind: str
+    index: int
+    payload: dict
+    state: str
+    worker: Optional[str]
+    lease_id: Optional[str]
+    lease_expires: Optional[float]
+    attempts: int
+    error: Optional[str]
+
+
+class LeaseQueue:
+    """ persistent queue of processing jobs leased to remote workers
+
+    A worker claims a job for a while and keeps extending the lease while working on it, jobs whose lease
+    expired are given back to the queue. Jobs of a room are leased one at a time in the order pushed,
+    so segments of a session are done before the session itself.
+    Finished jobs are kept for RETENTION seconds.
+    """
+    RETENTION = 7 * 24 * 3600
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS remote_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        room_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        idx INTEGER NOT NULL DEFAULT -1,
+        payload TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'queued',
+        worker TEXT,
+        lease_id TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated_at REAL NOT NULL,
+        UNIQUE (session_id, kind, idx)
+    );
+    CREATE INDEX IF NOT EXISTS remote_jobs_state ON remote_jobs (state, room_id, id);
+    CREATE INDEX IF NOT EXISTS remote_jobs_lease ON remote_jobs (lease_id);
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def push(self, session_id: str, room_id: int, kind: str, index: int, payload: dict) -> bool:
+        """ :return: False if the job has been pushed before """
+        cursor = self.database.execute(
+            'INSERT OR IGNORE INTO remote_jobs (session_id, room_id, kind, idx, payload, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (session_id, room_id, kind, index, json.dumps(payload), time.time()))
+        return cursor.rowcount == 1
+
+    def claim(self, worker: str, seconds: float) -> Optional[LeaseItem]:
+        """ lease the oldest job of a room without a leased job """
+        with self.database.transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM remote_jobs WHERE id IN (SELECT MIN(id) FROM remote_jobs WHERE state = 'queued' "
+                "AND room_id NOT IN (SELECT room_id FROM remote_jobs WHERE state = 'leased') GROUP BY room_id) "
+                'ORDER BY id LIMIT 1').fetchone()
+            if row is None:
+                return None
+            lease_id, expires = uuid.uuid4().hex, time.time() + seconds
+            conn.execute("UPDATE remote_jobs SET state = 'leased', worker = ?, lease_id = ?, lease_expires = ?, "
+                         'updated_at = ? WHERE id = ?', (worker, lease_id, expires, time.time(), row['id']))
+        item = self._to_item(row)
+        item.state, item.worker, item.lease_id, item.lease_expires = 'leased', worker, lease_id, expires
+        return item
+
+    def get(self, lease_id: str) -> Optional[LeaseItem]:
+        """ the job of a lease still held """
+        row = self.database.execute("SELECT * FROM remote_jobs WHERE lease_id = ? AND state = 'leased'",
+                                    (lease_id,)).fetchone()
+        return self._to_item(row) if row else None
+
+    def heartbeat(self, lease_id: str, seconds: float) -> bool:
+        """ extend a lease, False if it has been lost """
+        cursor = self.database.execute("UPDATE remote_jobs SET lease_expires = ?, updated_at = ? "
+                                       "WHERE lease_id = ? AND state = 'leased'",
+                                       (time.time() + seconds, time.time(), lease_id))
+        return cursor.rowcount == 1
+
+    def complete(self, lease_id: str) -> bool:
+        cursor = self.database.execute("UPDATE remote_jobs SET state = 'done', lease_id = NULL, updated_at = ? "
+                                       "WHERE lease_id = ? AND state = 'leased'", (time.time(), lease_id))
+        return cursor.rowcount == 1
+
+    def fail(self, lease_id: str, error: str, max_attempts: int) -> Optional[LeaseItem]:
+        """ give the job back to the queue, or mark it failed after max_attempts
+
+        :return: the job, None if the lease has been lost
+        """
+        with self.database.transaction() as conn:
+            row = conn.execute("SELECT * FROM remote_jobs WHERE lease_id = ? AND state = 'leased'",
+                               (lease_id,)).fetchone()
+            if row is None:
+                return None
+            state = 'failed' if row['attempts'] + 1 >= max_attempts else 'queued'
+            conn.execute('UPDATE remote_jobs SET state = ?, attempts = attempts + 1, error = ?, lease_id = NULL, '
+                         'updated_at = ? WHERE id = ?', (state, error, time.time(), row['id']))
+        item = self._to_item(row)
+        item.state, item.attempts, item.error = state, item.attempts + 1, error
+        return item
+
+    def reclaim(self, max_attempts: int) -> list[LeaseItem]:
+        """ give back jobs whose lease expired
+
+        :return: the jobs, in their new state
+        """
+        with self.database.transaction() as conn:
+            rows = conn.execute("SELECT * FROM remote_jobs WHERE state = 'leased' AND lease_expires < ?",
+                                (time.time(),)).fetchall()
+            for row in rows:
+                state = 'failed' if row['attempts'] + 1 >= max_attempts else 'queued'
+                conn.execute("UPDATE remote_jobs SET state = ?, attempts = attempts + 1, error = 'lease expired', "
+                             'lease_id = NULL, updated_at = ? WHERE id = ?', (state, time.time(), row['id']))
+        items = [self._to_item(row) for row in rows]
+        for item in items:
+            item.attempts += 1
+            item.state = 'failed' if item.attempts >= max_attempts else 'queued'
+        return items
+
+    def cancel(self, session_id: str) -> int:
+        """ drop queued and leased jobs of a session, workers notice at the next heartbeat """
+        cursor = self.database.execute("UPDATE remote_jobs SET state = 'cancelled', lease_id = NULL, updated_at = ? "
+                                       "WHERE session_id = ? AND state IN ('queued', 'leased')",
+                                       (time.time(), session_id))
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """ delete finished jobs older than RETENTION """
+        cursor = self.database.execute("DELETE FROM remote_jobs WHERE state IN ('done', 'cancelled') "
+                                       'AND updated_at < ?', (time.time() - self.RETENTION,))
+        return cursor.rowcount
+
+    def items(self, states: tuple[str, ...] = ('queued', 'leased', 'failed')) -> list[LeaseItem]:
+        rows = self.database.execute(f'SELECT * FROM remote_jobs WHERE state IN ({",".join("?" * len(states))}) '
+                                     'ORDER BY id', states)
+        return [self._to_item(row) for row in rows]
+
+    def counts(self) -> dict[str, int]:
+        """ number of jobs in each state """
+        rows = self.database.execute('SELECT state, COUNT(*) AS count FROM remote_jobs GROUP BY state')
+        return {row['state']: row['count'] for row in rows}
+
+    @staticmethod
+    def _to_item(row) -> LeaseItem:
+        return LeaseItem(id=row['id'], session_id=row['session_id'], room_id=row['room_id'], kind=row['kind'],
+                         index=row['idx'], payload=json.loads(row['payload']), state=row['state'],
+                         worker=row['worker'], lease_id=row['lease_id'], lease_expires=row['lease_expires'],
+                         attempts=row['attempts'], error=row['error'])
@@ -0,0 +1,94 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+
+__all__ = ['OutboxItem', 'WebhookOutbox']
+
+
+@dataclass
+class OutboxItem:
+    """ a webhook waiting for delivery
+
+    Attributes:
+        id: 自增id
+        url: 发送地址
+        body: 请求体
+        attempts: 已失败次数
+    """
+    id: int
+    url: str
+    body: dict
+    attempts: int
+
+
+class WebhookOutbox:
+    """ persistent webhook outbox
+
+    Delivered webhooks are deleted, webhooks failing too many times are kept as failed.
+    Claiming moves due items to in_progress in one transaction, so each worker sends different items.
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS webhook_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        body TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS webhook_outbox_ready ON webhook_outbox (state, next_attempt);
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def push(self, url: str, body: dict) -> int:
+        cursor = self.database.execute('INSERT INTO webhook_outbox (url, body, created_at) VALUES (?, ?, ?)',
+                                       (url, json.dumps(body), time.time()))
+        return cursor.lastrowid
+
+    def claim(self, limit: int) -> list[OutboxItem]:
+        """ take up to `limit` due items, oldest first """
+        with self.database.transaction() as conn:
+            rows = conn.execute("SELECT * FROM webhook_outbox WHERE state = 'pending' AND next_attempt <= ? "
+                                'ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+            conn.executemany("UPDATE webhook_outbox SET state = 'in_progress' WHERE id = ?",
+                             [(row['id'],) for row in rows])
+        return [OutboxItem(id=row['id'], url=row['url'], body=json.loads(row['body']), attempts=row['attempts'])
+                for row in rows]
+
+    def ack(self, item_id: int):
+        """ delivered """
+        self.database.execute('DELETE FROM webhook_outbox WHERE id = ?', (item_id,))
+
+    def nack(self, item_id: int, error: str, retry_at: Optional[float]):
+        """ record a failure
+
+        :param item_id:
+        :param error:
+        :param retry_at: when to retry, None to give up
+        """
+        self.database.execute("UPDATE webhook_outbox SET state = ?, attempts = attempts + 1, error = ?, "
+                              'next_attempt = ? WHERE id = ?',
+                              ('failed' if retry_at is None else 'pending', error, retry_at or 0, item_id))
+
+    def recover(self) -> int:
+        """ give back items left in progress by a previous run, called once on startup """
+        cursor = self.database.execute("UPDATE webhook_outbox SET state = 'pending' WHERE state = 'in_progress'")
+        return cursor.rowcount
+
+    def next_due(self) -> Optional[float]:
+        row = self.database.execute("SELECT MIN(next_attempt) AS due FROM webhook_outbox "
+                                    "WHERE state = 'pending'").fetchone()
+        return row['due']
+
+    def counts(self) -> dict[str, int]:
+        """ number of items in each state """
+        rows = self.database.execute('SELECT state, COUNT(*) AS count FROM webhook_outbox GROUP BY state')
+        return {row['state']: row['count'] for row in rows}
@@ -0,0 +1,145 @@
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+
+logger = logging.getLogger('bililive-uploader')
+__all__ = ['QUEUE_STATES', 'QueueItem', 'UploadQueue']
+
+QUEUE_STATES = ('pending', 'in_progress', 'done', 'failed')
+
+
+@dataclass
+class QueueItem:
+    """ a queued upload
+
+    Attributes:
+        session_id: 会话id
+        room_id: 直播间长号
+        state: 状态(pending/in_progress/done/failed)
+        payload: 上传所需的数据
+        attempts: 已失败次数
+        next_attempt: 下次尝试的时间(time.time())
+        error: 最近一次失败原因
+    """
+    session_id: str
+    room_id: int
+    state: str
+    payload: dict
+    attempts: int
+    next_attempt: float
+    error: Optional[str]
+
+
+class UploadQueue:
+    """ persistent upload queue keyed by session id
+
+    A session is queued at most once, whoever pushes it. Claiming moves a pending item to in_progress
+    in one transaction, so concurrent consumers never get the same item.
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS upload_queue (
+        session_id TEXT PRIMARY KEY,
+        room_id INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        start_time REAL NOT NULL,
+        size INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        error TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS upload_queue_ready ON upload_queue (state, next_attempt);
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def push(self, session_id: str, room_id: int, payload: dict, start_time: float, size: int) -> bool:
+        """ queue an upload, older sessions and then smaller ones are claimed first
+
+        :return: False if the session has been queued before
+        """
+        cursor = self.database.execute(
+            'INSERT OR IGNORE INTO upload_queue (session_id, room_id, state, payload, start_time, size, updated_at) '
+            "VALUES (?, ?, 'pending', ?, ?, ?, ?)",
+            (session_id, room_id, json.dumps(payload), start_time, size, time.time()))
+        return cursor.rowcount == 1
+
+    def claim(self) -> Optional[QueueItem]:
+        """ take the next due item, None if nothing is due """
+        with self.database.transaction() as conn:
+            row = conn.execute("SELECT * FROM upload_queue WHERE state = 'pending' AND next_attempt <= ? "
+                               'ORDER BY start_time, size LIMIT 1', (time.time(),)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE upload_queue SET state = 'in_progress', updated_at = ? WHERE session_id = ?",
+                         (time.time(), row['session_id']))
+        item = self._to_item(row)
+        item.state = 'in_progress'
+        return item
+
+    def ack(self, session_id: str):
+        """ mark the upload as done """
+        self._update(session_id, "state = 'done', error = NULL")
+
+    def nack(self, session_id: str, error: str, retry_at: Optional[float]):
+        """ record a failure
+
+        :param session_id:
+        :param error:
+        :param retry_at: when to retry, None to give up
+        """
+        if retry_at is None:
+            self._update(session_id, "state = 'failed', attempts = attempts + 1, error = ?", error)
+        else:
+            self._update(session_id, "state = 'pending', attempts = attempts + 1, error = ?, next_attempt = ?",
+                         error, retry_at)
+
+    def recover(self) -> int:
+        """ give back items left in progress by a previous run, called once on startup """
+        cursor = self.database.execute("UPDATE upload_queue SET state = 'pending' WHERE state = 'in_progress'")
+        return cursor.rowcount
+
+    def retry_all(self):
+        """ make pending items due now and requeue failed ones """
+        self.database.execute("UPDATE upload_queue SET state = 'pending', attempts = 0, next_attempt = 0 "
+                              "WHERE state = 'failed'")
+        self.database.execute("UPDATE upload_queue SET next_attempt = 0 WHERE state = 'pending'")
+
+    def next_due(self) -> Optional[float]:
+        """ time when the next pending item is due """
+        row = self.database.execute("SELECT MIN(next_attempt) AS due FROM upload_queue "
+                                    "WHERE state = 'pending'").fetchone()
+        return row['due']
+
+    def counts(self) -> dict[str, int]:
+        """ number of items in each state """
+        rows = self.database.execute('SELECT state, COUNT(*) AS count FROM upload_queue GROUP BY state')
+        return {row['state']: row['count'] for row in rows}
+
+    def oldest_pending(self) -> Optional[float]:
+        """ when the oldest pending item was queued or last failed """
+        row = self.database.execute("SELECT MIN(updated_at) AS since FROM upload_queue "
+                                    "WHERE state = 'pending'").fetchone()
+        return row['since']
+
+    def items(self, states: tuple[str, ...] = QUEUE_STATES) -> list[QueueItem]:
+        rows = self.database.execute(f'SELECT * FROM upload_queue WHERE state IN ({",".join("?" * len(states))}) '
+                                     'ORDER BY start_time, size', states)
+        return [self._to_item(row) for row in rows]
+
+    def _update(self, session_id: str, assignments: str, *parameters):
+        self.database.execute(f'UPDATE upload_queue SET {assignments}, updated_at = ? WHERE session_id = ?',
+                              (*parameters, time.time(), session_id))
+
+    @staticmethod
+    def _to_item(row) -> QueueItem:
+        return QueueItem(session_id=row['session_id'], room_id=row['room_id'], state=row['state'],
+                         payload=json.loads(row['payload']), attempts=row['attempts'],
+                         next_attempt=row['next_attempt'], error=row['error'])
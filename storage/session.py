@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from utils import FileUtils
+from .database import Database
+
+logger = logging.getLogger('bililive-uploader')
+__all__ = ['SessionRecord', 'SessionStore', 'SqliteSessionStore', 'JsonSessionStore', 'create_session_store']
+
+
+@dataclass
+class SessionRecord:
+    """ a recording session
+
+    Attributes:
+        session_id: 会话id
+        room_id: 直播间长号
+        start_time: 开始时间
+        folder: 录播文件所属文件夹
+        filenames: 录播文件名（不带后缀）
+        extensions: 后缀名
+    """
+    session_id: str
+    room_id: int
+    start_time: Optional[datetime] = None
+    folder: str = ''
+    filenames: list[str] = field(default_factory=list)
+    extensions: list[str] = field(default_factory=list)
+
+
+class SessionStore(ABC):
+    """ session state backend, keyed by session id """
+
+    @abstractmethod
+    def start(self, session_id: str, room_id: int, start_time: datetime):
+        """ record session start time """
+
+    @abstractmethod
+    def add_file(self, session_id: str, room_id: int, folder: str, filename: str, extensions: list[str]):
+        """ append a record file to the session """
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        """ get the session, None if not found """
+
+    @abstractmethod
+    def end(self, session_id: str) -> Optional[SessionRecord]:
+        """ remove the session and return it, None if not found """
+
+    @abstractmethod
+    def sessions(self) -> list[SessionRecord]:
+        """ list sessions still recording """
+
+
+class SqliteSessionStore(SessionStore):
+    """ session store backed by sqlite, every event is a single row write """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        room_id INTEGER NOT NULL,
+        start_time TEXT,
+        folder TEXT NOT NULL DEFAULT '',
+        extensions TEXT NOT NULL DEFAULT '[]'
+    );
+    CREATE TABLE IF NOT EXISTS session_files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        filename TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS session_files_session ON session_files (session_id);
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def start(self, session_id: str, room_id: int, start_time: datetime):
+        self.database.execute('INSERT INTO sessions (session_id, room_id, start_time) VALUES (?, ?, ?) '
+                              'ON CONFLICT (session_id) DO UPDATE SET start_time = excluded.start_time',
+                              (session_id, room_id, start_time.isoformat()))
+
+    def add_file(self, session_id: str, room_id: int, folder: str, filename: str, extensions: list[str]):
+        with self.database.transaction() as conn:
+            conn.execute('INSERT INTO sessions (session_id, room_id, folder, extensions) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT (session_id) DO UPDATE SET folder = excluded.folder, '
+                         'extensions = excluded.extensions',
+                         (session_id, room_id, folder, json.dumps(extensions)))
+            conn.execute('INSERT INTO session_files (session_id, filename) VALUES (?, ?)', (session_id, filename))
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        conn = self.database.connect()
+        row = conn.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return self._to_record(conn, row) if row else None
+
+    def end(self, session_id: str) -> Optional[SessionRecord]:
+        with self.database.transaction() as conn:
+            row = conn.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return None
+            record = self._to_record(conn, row)
+            conn.execute('DELETE FROM session_files WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        return record
+
+    def sessions(self) -> list[SessionRecord]:
+        conn = self.database.connect()
+        return [self._to_record(conn, row) for row in conn.execute('SELECT * FROM sessions ORDER BY room_id')]
+
+    @staticmethod
+    def _to_record(conn, row) -> SessionRecord:
+        files = conn.execute('SELECT filename FROM session_files WHERE session_id = ? ORDER BY id',
+                             (row['session_id'],)).fetchall()
+        return SessionRecord(session_id=row['session_id'], room_id=row['room_id'],
+                             start_time=datetime.fromisoformat(row['start_time']) if row['start_time'] else None,
+                             folder=row['folder'], filenames=[file['filename'] for file in files],
+                             extensions=json.loads(row['extensions']))
+
+
+class JsonSessionStore(SessionStore):
+    """ legacy session store, rewrites the whole json file on every event
+
+    Only safe inside a single process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def start(self, session_id: str, room_id: int, start_time: datetime):
+        with self._lock:
+            sessions = FileUtils.readJson(self.path)
+            session = sessions.setdefault(session_id, self._empty(room_id))
+            session['start_time'] = start_time.isoformat()
+            FileUtils.writeDict(self.path, sessions)
+
+    def add_file(self, session_id: str, room_id: int, folder: str, filename: str, extensions: list[str]):
+        with self._lock:
+            sessions = FileUtils.readJson(self.path)
+            session = sessions.setdefault(session_id, self._empty(room_id))
+            session['folder'], session['extensions'] = folder, extensions
+            session['filenames'].append(filename)
+            FileUtils.writeDict(self.path, sessions)
+
+    def get(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            sessions = FileUtils.readJson(self.path)
+        return self._to_record(session_id, sessions[session_id]) if session_id in sessions else None
+
+    def end(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            sessions = FileUtils.readJson(self.path)
+            if session_id not in sessions:
+                return None
+            session = sessions.pop(session_id)
+            FileUtils.writeDict(self.path, sessions)
+        return self._to_record(session_id, session)
+
+    def sessions(self) -> list[SessionRecord]:
+        with self._lock:
+            sessions = FileUtils.readJson(self.path)
+        return [self._to_record(session_id, session) for session_id, session in sessions.items()]
+
+    @staticmethod
+    def _empty(room_id: int) -> dict:
+        return {'room_id': room_id, 'start_time': None, 'folder': '', 'filenames': [], 'extensions': []}
+
+    @staticmethod
+    def _to_record(session_id: str, session: dict) -> SessionRecord:
+        start_time = session['start_time']
+        return SessionRecord(session_id=session_id, room_id=session['room_id'],
+                             start_time=datetime.fromisoformat(start_time) if start_time else None,
+                             folder=session['folder'], filenames=session['filenames'],
+                             extensions=session['extensions'])
+
+
+def create_session_store(backend: str, cache_dir: str, database: Database = None) -> SessionStore:
+    """ create session store by config
+
+    :param backend: sqlite or json
+    :param cache_dir: folder for json cache
+    :param database: shared sqlite database
+    :return:
+    """
+    if backend == 'json':
+        return JsonSessionStore(os.path.join(cache_dir, 'sessions.json'))
+    if backend != 'sqlite':
+        logger.warning('Unknown session store: %s, use sqlite instead.', backend)
+    return SqliteSessionStore(database or Database(os.path.join(cache_dir, 'bot.db')))
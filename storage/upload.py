@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .database import Database
+
+logger = logging.getLogger('bililive-uploader')
+__all__ = ['UploadPage', 'UploadSessionStore']
+
+
+@dataclass
+class UploadPage:
+    """ upload progress of a video page
+
+    Attributes:
+        path: 视频路径
+        size: 文件大小
+        mtime: 修改时间
+        preupload: 预上传信息(upload id, 分块大小, 上传地址等)
+        chunks: 已完成的分块序号
+        result: 分P提交结果(filename, cid), 未提交时为None
+    """
+    path: str
+    size: int
+    mtime: float
+    preupload: dict
+    chunks: set[int] = field(default_factory=set)
+    result: Optional[dict] = None
+
+    chunk_size = property(lambda self: self.preupload['chunk_size'])
+    total_chunks = property(lambda self: (self.size + self.chunk_size - 1) // self.chunk_size)
+
+
+class UploadSessionStore:
+    """ persistent upload sessions of video pages, keyed by file path
+
+    A page is resumed only while the file is unchanged (same size and mtime).
+    """
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS upload_pages (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        preupload TEXT NOT NULL,
+        result TEXT,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        path TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        PRIMARY KEY (path, chunk)
+    );
+    '''
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(self.SCHEMA)
+
+    def get(self, path: str) -> Optional[UploadPage]:
+        """ get the upload session of a page, None if not started or the file has changed """
+        row = self.database.execute('SELECT * FROM upload_pages WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        stat = os.stat(path)
+        if (row['size'], row['mtime']) != (stat.st_size, stat.st_mtime):
+            logger.warning('%s has changed since the last upload, start over.', path)
+            self.clear([path])
+            return None
+        chunks = self.database.execute('SELECT chunk FROM upload_chunks WHERE path = ?', (path,))
+        return UploadPage(path=path, size=row['size'], mtime=row['mtime'], preupload=json.loads(row['preupload']),
+                          chunks={chunk['chunk'] for chunk in chunks},
+                          result=json.loads(row['result']) if row['result'] else None)
+
+    def start(self, path: str, preupload: dict) -> UploadPage:
+        """ start a new upload session, replacing the old one """
+        stat = os.stat(path)
+        with self.database.transaction() as conn:
+            conn.execute('DELETE FROM upload_chunks WHERE path = ?', (path,))
+            conn.execute('INSERT OR REPLACE INTO upload_pages (path, size, mtime, preupload, result, updated_at) '
+                         'VALUES (?, ?, ?, ?, NULL, ?)',
+                         (path, stat.st_size, stat.st_mtime, json.dumps(preupload), time.time()))
+        return UploadPage(path=path, size=stat.st_size, mtime=stat.st_mtime, preupload=preupload)
+
+    def chunk_done(self, path: str, chunk: int):
+        self.database.execute('INSERT OR IGNORE INTO upload_chunks (path, chunk) VALUES (?, ?)', (path, chunk))
+
+    def page_done(self, path: str, result: dict):
+        self.database.execute('UPDATE upload_pages SET result = ?, updated_at = ? WHERE path = ?',
+                              (json.dumps(result), time.time(), path))
+
+    def clear(self, paths: list[str]):
+        """ forget pages, called once the video is submitted """
+        with self.database.transaction() as conn:
+            conn.executemany('DELETE FROM upload_chunks WHERE path = ?', [(path,) for path in paths])
+            conn.executemany('DELETE FROM upload_pages WHERE path = ?', [(path,) for path in paths])
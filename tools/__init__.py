@@ -0,0 +1 @@
+""" Development tools, run from the repository root, e.g. `python -m tools.danmaku_benchmark` """
@@ -0,0 +1,83 @@
+""" Benchmark the built-in danmaku converter against DanmakuFactory.
+
+Each converter runs in its own child process so peak RSS can be read from its rusage (linux/macos only).
+The figure includes the few MB the child inherits from the forked benchmark process.
+
+    python -m tools.danmaku_benchmark --counts 10000 100000 1000000 --danmaku-factory ./DanmakuFactory
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from tools.synthetic import makeDanmakuXml
+
+
+def _run(argv: list[str]) -> dict:
+    """ run a command, return wall time and peak RSS of the child """
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.monotonic() - start
+    stderr = proc.stderr.read().decode(errors='replace')
+    proc.stderr.close()
+    # ru_maxrss is in KiB on linux and in bytes on macos
+    peak = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'seconds': round(seconds, 3), 'peak_rss_mb': round(peak / 2 ** 20, 1),
+            'ok': os.waitstatus_to_exitcode(status) == 0, 'stderr': stderr[-500:]}
+
+
+def _builtin(xml: str, ass: str) -> list[str]:
+    code = ('import sys; from utils import DanmakuUtils; '
+            'print(DanmakuUtils.convertXml2Ass(sys.argv[1], sys.argv[2], DanmakuUtils.AssStyle()))')
+    return [sys.executable, '-c', code, xml, ass]
+
+
+def _danmaku_factory(path: str):
+    def argv(xml: str, ass: str) -> list[str]:
+        return [path, '-o', ass, '-i', xml, '-d', '50', '-S', '55', '--ignore-warnings']
+    return argv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='number of comments of each synthetic file')
+    parser.add_argument('--duration', type=float, default=3 * 3600, help='length of each file in seconds')
+    parser.add_argument('--danmaku-factory', help='path of DanmakuFactory, skipped if not given')
+    parser.add_argument('--output', help='write results as json to this file instead of stdout')
+    args = parser.parse_args()
+
+    converters = {'builtin': _builtin}
+    if args.danmaku_factory:
+        converters['danmaku factory'] = _danmaku_factory(args.danmaku_factory)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for count in args.counts:
+            xml = os.path.join(folder, f'{count}.xml')
+            makeDanmakuXml(xml, count, args.duration)
+            size = os.path.getsize(xml)
+            for name, argv in converters.items():
+                ass = os.path.join(folder, f'{count}-{name}.ass')
+                result = _run(argv(xml, ass))
+                result.update(converter=name, danmakus=count, xml_mb=round(size / 2 ** 20, 1),
+                              danmakus_per_second=round(count / result['seconds']) if result['ok'] else None,
+                              ass_mb=round(os.path.getsize(ass) / 2 ** 20, 1) if os.path.exists(ass) else None)
+                if result['ok']:
+                    result.pop('stderr')
+                results.append(result)
+                print(f'{name:>16} {count:>9} danmakus: {result["seconds"]:>7.2f}s '
+                      f'{result["peak_rss_mb"]:>7.1f}MB', file=sys.stderr)
+    report = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
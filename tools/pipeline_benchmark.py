@@ -0,0 +1,320 @@
+""" End-to-end benchmark of the processing pipeline.
+
+Generates synthetic recordings for several rooms, starts the bot in a scratch directory, sends the
+BililiveRecorder webhooks of every room at the same time and waits for the ProcessFinished webhooks.
+Stage timings come from the bot's /metrics, peak RSS from the bot's process tree(linux only).
+
+By default ffmpeg is replaced by tools/stub_ffmpeg.py, so the figures show the orchestration overhead alone.
+Pass --ffmpeg to use a real one, recordings are then encoded with the testsrc filter.
+Pass --remote-workers to leave processing to that many `run.pyw --worker` processes on this machine.
+Pass --verify with --ffmpeg to decode every result afterwards and report the errors ffmpeg finds, e.g. at the
+joins of encoded and copied pieces with --smart-combine.
+
+    python -m tools.pipeline_benchmark --rooms 4 --segments 3 --duration 600 --density 300 --output result.json
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tools.synthetic import makeDanmakuXml, makeEvent, makeFlv, ffmpegTestsrcArgs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_ROOM_ID = 1000
+
+
+class _Receiver:
+    """ collects ProcessFinished webhooks sent by the bot
+
+    Attributes:
+        finished: {session id: time received}
+    """
+
+    def __init__(self):
+        self.finished: dict[str, float] = {}
+        self.condition = threading.Condition()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                with receiver.condition:
+                    receiver.finished[body['BililiveData']['SessionId']] = time.monotonic()
+                    receiver.condition.notify_all()
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    url = property(lambda self: f'http://127.0.0.1:{self.server.server_address[1]}/')
+
+    def wait(self, sessions: set[str], timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: sessions <= set(self.finished), timeout)
+
+
+def _writeConfig(work_dir: str, rec_dir: str, args, webhook: str):
+    os.makedirs(os.path.join(work_dir, 'config'), exist_ok=True)
+    with open(os.path.join(work_dir, 'config', 'bot-config.yml'), 'w', encoding='utf-8') as f:
+        json.dump({'bot': {'rec-dir': rec_dir, 'workers': args.workers,
+                           'process': {'danmaku': True, 'parallel': args.parallel, 'incremental': args.incremental,
+                                       'smart-combine': args.smart_combine,
+                                       'remote': args.remote_workers > 0, 'lease-seconds': args.lease_seconds,
+                                       'remote-token': 'benchmark'},
+                           'upload': {'auto-upload': False, 'delete-after-upload': True},
+                           'server': {'port': args.port, 'webhooks': [webhook]}}}, f)
+    with open(os.path.join(work_dir, 'config', 'room-config.yml'), 'w', encoding='utf-8') as f:
+        json.dump({'rooms': [{'id': FIRST_ROOM_ID + i, 'channel': '生活 日常'} for i in range(args.rooms)]}, f)
+
+
+def _makeRecordings(rec_dir: str, args) -> dict[int, list[str]]:
+    """ :return: {room id: [record file relative to rec dir, without extension]} """
+    def make(room_id: int, index: int) -> str:
+        name = os.path.join(str(room_id), f'record-{index:03d}')
+        path = os.path.join(rec_dir, name)
+        if args.ffmpeg:
+            subprocess.run([args.ffmpeg, '-loglevel', 'error', *ffmpegTestsrcArgs(path + '.flv', args.duration)],
+                           check=True)
+        else:
+            makeFlv(path + '.flv', args.duration)
+        density = 0 if args.quiet_segments and index % 2 else args.density
+        makeDanmakuXml(path + '.xml', int(density * args.duration / 60), args.duration, seed=room_id * 100 + index)
+        return name
+
+    rooms = {FIRST_ROOM_ID + i: [] for i in range(args.rooms)}
+    for room_id in rooms:
+        os.makedirs(os.path.join(rec_dir, str(room_id)), exist_ok=True)
+    with ThreadPoolExecutor() as pool:
+        for room_id, files in rooms.items():
+            files.extend(pool.map(lambda index, room=room_id: make(room, index), range(args.segments)))
+    return rooms
+
+
+def _stubFfmpeg(folder: str) -> str:
+    path = os.path.join(folder, 'ffmpeg')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(ROOT, "tools", "stub_ffmpeg.py")}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _post(url: str, body: dict) -> float:
+    """ :return: seconds until the bot answered """
+    request = urllib.request.Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+    start = time.monotonic()
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+    return time.monotonic() - start
+
+
+def _waitReady(url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'bot exited with {server.returncode}')
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError('bot did not start')
+
+
+def _processTree(pid: int) -> list[int]:
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', encoding='utf-8') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _peakRss(pid: int) -> dict[str, float]:
+    """ {pid: peak RSS in MB} of the bot's processes still alive """
+    result = {}
+    for current in _processTree(pid):
+        try:
+            with open(f'/proc/{current}/status', encoding='utf-8') as f:
+                match = re.search(r'VmHWM:\s+(\d+) kB', f.read())
+        except OSError:
+            continue
+        if match:
+            result[str(current)] = round(int(match[1]) / 1024, 1)
+    return result
+
+
+def _scrapeMetrics(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=10) as response:
+        text = response.read().decode()
+    stages, totals = {}, {}
+    for line in text.splitlines():
+        match = re.match(r'bililive_stage_duration_seconds_(sum|count)\{stage="([^"]+)"} (\S+)', line)
+        if match:
+            stages.setdefault(match[2], {})[match[1]] = float(match[3])
+            continue
+        match = re.match(r'(bililive_\w+_total)(?:\{(.*)})? (\S+)', line)
+        if match:
+            totals[match[1] + (f'{{{match[2]}}}' if match[2] else '')] = float(match[3])
+    return {'stages': {name: {'seconds': round(value.get('sum', 0), 3), 'count': int(value.get('count', 0))}
+                       for name, value in stages.items()},
+            'totals': totals}
+
+
+def _verify(ffmpeg: str, work_dir: str) -> dict[str, int]:
+    """ decode every result, {result relative to work dir: lines of errors reported} """
+    errors = {}
+    for folder, _, files in os.walk(work_dir):
+        for name in sorted(files):
+            if name.startswith('result') and os.path.splitext(name)[1] in ('.flv', '.mp4'):
+                path = os.path.join(folder, name)
+                stderr = subprocess.run([ffmpeg, '-v', 'error', '-i', path, '-f', 'null', '-'],
+                                        capture_output=True, text=True).stderr
+                errors[os.path.relpath(path, work_dir)] = len(stderr.splitlines())
+    return errors
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))] if values else 0
+
+
+def _gitCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(args) -> dict:
+    receiver = _Receiver()
+    with tempfile.TemporaryDirectory() as scratch:
+        folder = tempfile.mkdtemp(prefix='pipeline-benchmark-') if args.keep else scratch
+        rec_dir, work_dir, cwd = (os.path.join(folder, name) for name in ('record', 'work', 'cwd'))
+        os.makedirs(cwd)
+        # the bot reads ./resources and writes ./cache relative to its working directory
+        os.symlink(os.path.join(ROOT, 'resources'), os.path.join(cwd, 'resources'))
+        _writeConfig(work_dir, rec_dir, args, receiver.url)
+        start = time.monotonic()
+        rooms = _makeRecordings(rec_dir, args)
+        generate_seconds = time.monotonic() - start
+
+        env = {**os.environ, 'SANIC_FFMPEG_PATH': args.ffmpeg or _stubFfmpeg(folder),
+               'STUB_FFMPEG_SPEED': str(args.stub_speed)}
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'run.pyw'), '-w', work_dir], cwd=cwd, env=env,
+                                  stdout=subprocess.DEVNULL if not args.verbose else None,
+                                  stderr=subprocess.DEVNULL if not args.verbose else None)
+        base = f'http://127.0.0.1:{args.port}'
+        workers = [subprocess.Popen([sys.executable, os.path.join(ROOT, 'run.pyw'), '-w', work_dir, '--worker', base,
+                                     '--name', f'worker-{i}'], cwd=cwd, env=env,
+                                    stdout=subprocess.DEVNULL if not args.verbose else None,
+                                    stderr=subprocess.DEVNULL if not args.verbose else None)
+                   for i in range(args.remote_workers)]
+        try:
+            _waitReady(base + '/', server)
+            sessions = {room_id: str(uuid.uuid4()) for room_id in rooms}
+            ended_at, latencies = {}, []
+
+            def send(room_id: int):
+                session_id = sessions[room_id]
+                latencies.append(_post(base + '/process', makeEvent('SessionStarted', room_id, session_id)))
+                for name in rooms[room_id]:
+                    latencies.append(_post(base + '/process',
+                                           makeEvent('FileOpening', room_id, session_id, name + '.flv')))
+                latencies.append(_post(base + '/process', makeEvent('SessionEnded', room_id, session_id)))
+                ended_at[session_id] = time.monotonic()
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=len(rooms)) as pool:
+                list(pool.map(send, rooms))
+            finished = receiver.wait(set(sessions.values()), args.timeout)
+            wall = time.monotonic() - start
+            ready = [receiver.finished[session_id] - ended for session_id, ended in ended_at.items()
+                     if session_id in receiver.finished]
+            metrics = _scrapeMetrics(base + '/metrics')
+            peak_rss = _peakRss(server.pid)
+            decode_errors = _verify(args.ffmpeg, work_dir) if args.verify else None
+        finally:
+            for process in [server, *workers]:
+                process.send_signal(signal.SIGINT)
+            for process in [server, *workers]:
+                try:
+                    process.wait(30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    media_seconds = args.rooms * args.segments * args.duration
+    return {
+        'commit': _gitCommit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'verbose', 'keep')},
+        'ffmpeg': 'real' if args.ffmpeg else 'stub',
+        'generate_seconds': round(generate_seconds, 3),
+        'completed': finished,
+        'sessions_finished': len(ready),
+        'wall_seconds': round(wall, 3),
+        'throughput_media_seconds_per_second': round(media_seconds / wall, 2) if wall else 0,
+        'time_to_upload_ready': {'p50': round(_percentile(ready, .5), 3), 'max': round(max(ready, default=0), 3)},
+        'ack_latency': {'p50': round(_percentile(latencies, .5), 4), 'p99': round(_percentile(latencies, .99), 4)},
+        'peak_rss_mb': peak_rss,
+        **({'decode_errors': decode_errors} if decode_errors is not None else {}),
+        **metrics,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=2, help='rooms recording at the same time')
+    parser.add_argument('--segments', type=int, default=2, help='record files per session')
+    parser.add_argument('--duration', type=float, default=300, help='seconds of each record file')
+    parser.add_argument('--density', type=float, default=200, help='comments per minute')
+    parser.add_argument('--quiet-segments', action='store_true',
+                        help='no comments in every other record file, so remuxed and encoded results are mixed')
+    parser.add_argument('--workers', type=int, default=4, help='bot/workers of the bot')
+    parser.add_argument('--parallel', action='store_true', help='enable bot/process/parallel')
+    parser.add_argument('--incremental', action='store_true', help='enable bot/process/incremental')
+    parser.add_argument('--smart-combine', action='store_true', help='enable bot/process/smart-combine')
+    parser.add_argument('--remote-workers', type=int, default=0,
+                        help='worker processes to leave processing to, 0 to process in the bot')
+    parser.add_argument('--lease-seconds', type=float, default=60, help='bot/process/lease-seconds of the bot')
+    parser.add_argument('--ffmpeg', help='real ffmpeg to use instead of the stub')
+    parser.add_argument('--stub-speed', type=float, default=0,
+                        help='media seconds the stub encodes per second, 0 for no delay')
+    parser.add_argument('--verify', action='store_true', help='decode results with --ffmpeg and count errors')
+    parser.add_argument('--port', type=int, default=18866)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for all sessions')
+    parser.add_argument('--output', help='write results as json to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show the bot output')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory for inspection')
+    args = parser.parse_args()
+    if args.verify and not args.ffmpeg:
+        parser.error('--verify needs --ffmpeg')
+
+    result = json.dumps(run(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
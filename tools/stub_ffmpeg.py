@@ -0,0 +1,56 @@
+""" Stand-in for ffmpeg that only produces files the pipeline can read back, to time the orchestration alone.
+
+Outputs are synthetic flv files(see tools.synthetic.makeFlv) as long as the input, whatever the container.
+Set STUB_FFMPEG_SPEED to sleep as if encoding at that many media seconds per second, 0 for no delay.
+
+    python -m tools.stub_ffmpeg -y -i input.flv ... output.mp4
+"""
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.synthetic import makeFlv  # noqa: E402 pylint: disable=wrong-import-position
+from utils import FlvUtils  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def _option(argv: list[str], name: str, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+
+def _concatInputs(path: str) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip()[len("file '"):-1] for line in f if line.startswith('file ')]
+
+
+def main(argv: list[str]) -> int:
+    inputs = [argv[i + 1] for i, arg in enumerate(argv) if arg == '-i']
+    output = argv[-1]
+    if not inputs or not all(os.path.exists(file) for file in inputs):
+        print(f'stub ffmpeg: missing input {inputs}', file=sys.stderr)
+        return 1
+    if _option(argv, '-f') == 'concat':
+        inputs = _concatInputs(inputs[0])
+    duration = sum(FlvUtils.getDuration(file) for file in inputs)
+    speed = float(os.environ.get('STUB_FFMPEG_SPEED', 0))
+    if speed > 0 and '-c' not in argv:  # stream copies are fast anyway
+        time.sleep(duration / speed)
+    if _option(argv, '-f') == 'segment':
+        times = [0.0] + [float(t) for t in _option(argv, '-segment_times', '').split(',') if t] + [duration]
+        with open(_option(argv, '-segment_list'), 'w', encoding='utf-8') as f:
+            for i, (start, end) in enumerate(zip(times, times[1:])):
+                name = output % i
+                makeFlv(name, end - start)
+                f.write(f'{os.path.basename(name)},{start:.3f},{end:.3f}\n')
+        return 0
+    if len(inputs) == 1 and _option(argv, '-c') == 'copy':
+        shutil.copyfile(inputs[0], output)
+    else:
+        makeFlv(output, duration)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,102 @@
+""" Synthetic inputs for benchmarks """
+import random
+import struct
+import uuid
+from datetime import datetime, timezone
+
+XML_HEADER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              '<?xml-stylesheet type="text/xsl" href="#s"?>\n'
+              '<i><chatserver>chat.bilibili.com</chatserver>'
+              '<BililiveRecorderRecordInfo roomid="1" shortid="0" name="benchmark" '
+              'start_time="2022-01-01T00:00:00+08:00" />\n')
+
+
+def makeDanmakuXml(path: str, count: int, duration: float = 3600, seed: int = 0):
+    """ write a BililiveRecorder style xml file
+
+    :param path: output file
+    :param count: number of comments, spread evenly over duration
+    :param duration: seconds
+    :param seed: random seed, same seed gives the same file
+    """
+    rand = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(XML_HEADER)
+        for i in range(count):
+            time = i * duration / count
+            mode = rand.choice((1, 1, 1, 1, 4, 5))
+            color = rand.choice((16777215, 16777215, 16711680, 65280))
+            uid = rand.randint(1, 10 ** 8)
+            text = '弹幕' + '哈' * rand.randint(0, 15) + f' test {i}'
+            f.write(f'<d p="{time:.3f},{mode},25,{color},{1640966400000 + int(time * 1000)},0,{uid},0" '
+                    f'uid="{uid}" user="user{uid}">{text}</d>\n')
+            if i % 100 == 0:
+                f.write(f'<gift ts="{time:.3f}" user="user{uid}" uid="{uid}" giftname="辣条" giftcount="1" />\n')
+        f.write('</i>')
+
+
+def _amfString(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack('>H', len(data)) + data
+
+
+def _flvTag(tag_type: int, timestamp: int, payload: bytes) -> bytes:
+    header = bytes([tag_type]) + len(payload).to_bytes(3, 'big') + (timestamp & 0xffffff).to_bytes(3, 'big') + \
+        bytes([timestamp >> 24 & 0xff]) + b'\0\0\0'
+    return header + payload + struct.pack('>I', len(header) + len(payload))
+
+
+def makeFlv(path: str, duration: float, fps: int = 30, gop: int = 60, width: int = 1920, height: int = 1080,
+            frame_size: int = 200):
+    """ write a flv file with valid tag structure and dummy payloads, enough for FlvUtils but not for decoding
+
+    :param path: output file
+    :param duration: seconds
+    :param fps: video frames per second
+    :param gop: frames between keyframes
+    :param width: width in metadata
+    :param height: height in metadata
+    :param frame_size: bytes of each video frame
+    """
+    properties = {'duration': duration, 'width': width, 'height': height, 'framerate': fps}
+    metadata = b'\x02' + _amfString('onMetaData') + b'\x08' + struct.pack('>I', len(properties))
+    for key, value in properties.items():
+        metadata += _amfString(key) + b'\x00' + struct.pack('>d', value)
+    metadata += b'\x00\x00\x09'
+    frame, audio = b'x' * frame_size, b'\xaf\x01' + b'a' * 50
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(b'FLV\x01\x05\x00\x00\x00\x09\0\0\0\0')
+        f.write(_flvTag(18, 0, metadata))
+        # AVC sequence header, high profile level 4.0
+        f.write(_flvTag(9, 0, bytes([0x17, 0, 0, 0, 0, 1, 100, 0, 40])))
+        for i in range(int(duration * fps)):
+            timestamp = int(i * 1000 / fps)
+            f.write(_flvTag(9, timestamp, bytes([0x17 if i % gop == 0 else 0x27, 1]) + frame))
+            f.write(_flvTag(8, timestamp, audio))
+
+
+def ffmpegTestsrcArgs(path: str, duration: float, fps: int = 30, gop: int = 60, width: int = 1920,
+                      height: int = 1080) -> list[str]:
+    """ ffmpeg arguments to encode a real test pattern recording """
+    return ['-y', '-f', 'lavfi', '-i', f'testsrc=size={width}x{height}:rate={fps}', '-f', 'lavfi',
+            '-i', 'sine=frequency=440', '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast',
+            '-g', str(gop), '-c:a', 'aac', path]
+
+
+def makeEvent(event_type: str, room_id: int, session_id: str, relative_path: str = None,
+              title: str = 'benchmark') -> dict:
+    """ a BililiveRecorder webhook v2 body
+
+    :param event_type: SessionStarted, FileOpening, FileClosed or SessionEnded
+    :param room_id: used as short id too
+    :param session_id:
+    :param relative_path: record file relative to the recorder work dir, FileOpening/FileClosed only
+    :param title: live title
+    """
+    data = {'RoomId': room_id, 'ShortId': 0, 'Name': f'room{room_id}', 'Title': title,
+            'AreaNameParent': '生活', 'AreaNameChild': '日常', 'SessionId': session_id,
+            'Recording': True, 'Streaming': True, 'DanmakuConnected': True}
+    if relative_path is not None:
+        data['RelativePath'] = relative_path
+    return {'EventType': event_type, 'EventTimestamp': datetime.now(timezone.utc).astimezone().isoformat(),
+            'EventId': str(uuid.uuid4()), 'EventData': data}
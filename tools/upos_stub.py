@@ -0,0 +1,192 @@
+""" Local stand-in for the bilibili chunked upload(upos) protocol, with failure injection.
+
+Serve only, point a client at http://127.0.0.1:<port>:
+
+    python -m tools.upos_stub serve --port 8901 --fail-rate 0.1
+
+Check that an interrupted upload resumes from the last acknowledged chunk:
+
+    python -m tools.upos_stub resume-test --size 64 --chunk-size 1 --interrupt-after 20 --fail-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class UposState:
+    """ what the stub server has received
+
+    Attributes:
+        chunk_size: 分块大小
+        fail_rate: 分块上传失败概率
+        uploads: {upload_id: {chunk: size}}
+        puts: 分块上传请求数
+        submitted: 已投稿的视频
+    """
+
+    def __init__(self, chunk_size: int, fail_rate: float):
+        self.chunk_size = chunk_size
+        self.fail_rate = fail_rate
+        self.uploads: dict[str, dict[int, int]] = {}
+        self.puts = 0
+        self.submitted: list[dict] = []
+        self.lock = threading.Lock()
+
+
+def make_handler(state: UposState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def _reply(self, status: int, body, content_type='application/json'):
+            data = (json.dumps(body) if not isinstance(body, str) else body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/preupload':
+                return self._reply(404, {'OK': 0})
+            name = parse_qs(url.query)['name'][0]
+            host = f'//{self.server.server_address[0]}:{self.server.server_address[1]}'
+            self._reply(200, {'OK': 1, 'endpoint': host, 'upos_uri': f'upos://ugcfx/{int(time.time() * 1000)}-{name}',
+                              'auth': 'stub', 'biz_id': random.randint(1, 10 ** 8),
+                              'chunk_size': state.chunk_size, 'threads': 3})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query, keep_blank_values=True)
+            body = self._body()
+            if url.path == '/x/vu/web/add':
+                meta = json.loads(body)
+                with state.lock:
+                    state.submitted.append(meta)
+                return self._reply(200, {'code': 0, 'data': {'aid': len(state.submitted), 'bvid': 'BVstub'}})
+            if 'uploads' in query:  # new upload id
+                upload_id = f'{random.getrandbits(64):016x}'
+                with state.lock:
+                    state.uploads[upload_id] = {}
+                return self._reply(200, {'OK': 1, 'upload_id': upload_id})
+            upload_id = query.get('uploadId', [''])[0]
+            parts = json.loads(body)['parts']
+            with state.lock:
+                received = state.uploads.get(upload_id)
+                if received is None:
+                    return self._reply(404, {'OK': 0, 'message': 'upload id not found'})
+                missing = [part['partNumber'] for part in parts if part['partNumber'] - 1 not in received]
+            if missing:
+                return self._reply(200, {'OK': 0, 'message': f'missing parts {missing}'})
+            self._reply(200, {'OK': 1, 'key': '/' + url.path.rsplit('/', 1)[-1]})
+
+        def do_PUT(self):
+            query = parse_qs(urlparse(self.path).query)
+            body = self._body()
+            with state.lock:
+                state.puts += 1
+                received = state.uploads.get(query['uploadId'][0])
+            if received is None:
+                return self._reply(404, 'upload id not found', 'text/plain')
+            if random.random() < state.fail_rate:
+                return self._reply(500, 'injected failure', 'text/plain')
+            if len(body) != int(query['size'][0]):
+                return self._reply(400, 'size mismatch', 'text/plain')
+            with state.lock:
+                received[int(query['chunk'][0])] = len(body)
+            self._reply(200, 'MULTIPART_PUT_SUCCESS', 'text/plain')
+
+    return Handler
+
+
+def serve(port: int, state: UposState) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def resume_test(args) -> dict:
+    """ upload a file, interrupt it, upload again and count the chunks sent twice """
+    from bilibili_api import Credential, video_uploader
+    from storage import Database, UploadSessionStore
+    from server.upload import uploader
+
+    state = UposState(args.chunk_size << 20, args.fail_rate)
+    server = serve(0, state)
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    video_uploader._API['preupload']['url'] = base + '/preupload'
+    video_uploader._API['submit']['url'] = base + '/x/vu/web/add'
+    uploader.RETRY_DELAY = 0.01
+
+    class StubUploader(uploader.ResumableVideoUploader):
+        @staticmethod
+        def _get_upload_url(preupload: dict) -> str:
+            return 'http:' + preupload['endpoint'] + '/' + preupload['upos_uri'].removeprefix('upos://')
+
+    with tempfile.TemporaryDirectory() as folder:
+        video = os.path.join(folder, 'video.flv')
+        with open(video, 'wb') as f:
+            f.write(os.urandom(args.size << 20))
+        store = UploadSessionStore(Database(os.path.join(folder, 'upload.db')))
+        meta = {'title': 'stub', 'tid': 1}
+        credential = Credential(sessdata='stub', bili_jct='stub')
+
+        def upload():
+            page = video_uploader.VideoUploaderPage(path=video, title='part1')
+            return StubUploader([page], meta, credential, store=store)
+
+        async def interrupted():
+            task = asyncio.create_task(upload()._main())
+            while len(store.get(video).chunks if store.get(video) else ()) < args.interrupt_after:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        start = time.monotonic()
+        asyncio.run(interrupted())
+        done_before = len(store.get(video).chunks)
+        puts_before = state.puts
+        result = asyncio.run(upload()._main())
+        total = store.get(video).total_chunks
+    server.shutdown()
+    return {'chunks': total, 'acknowledged_before_interrupt': done_before,
+            'puts_before_interrupt': puts_before, 'puts_after_resume': state.puts - puts_before,
+            'uploads_started': len(state.uploads), 'submitted': result,
+            'seconds': round(time.monotonic() - start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_parser = sub.add_parser('serve', help='run the stub server')
+    serve_parser.add_argument('--port', type=int, default=8901)
+    test_parser = sub.add_parser('resume-test', help='interrupt an upload and resume it')
+    test_parser.add_argument('--size', type=int, default=64, help='video size in MB')
+    test_parser.add_argument('--interrupt-after', type=int, default=20, help='chunks acknowledged before stopping')
+    for sub_parser in (serve_parser, test_parser):
+        sub_parser.add_argument('--chunk-size', type=int, default=1, help='chunk size in MB')
+        sub_parser.add_argument('--fail-rate', type=float, default=0, help='probability a chunk upload fails')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = serve(args.port, UposState(args.chunk_size << 20, args.fail_rate))
+        print(f'Serving on http://127.0.0.1:{server.server_address[1]}', file=sys.stderr)
+        threading.Event().wait()
+    else:
+        print(json.dumps(resume_test(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+""" Replay captured BililiveRecorder webhooks against a running bot and measure how fast it acknowledges them.
+
+Capture the webhooks of a real run by setting bot/server/capture in bot-config.yml, or generate a synthetic day:
+
+    python -m tools.webhook_replay generate --rooms 50 --segments 24 --segment-seconds 3600 --output day.jsonl
+
+Save the state of the instance that recorded the webhooks, for comparing later:
+
+    python -m tools.webhook_replay snapshot --url http://127.0.0.1:8866 --output state.json
+
+Replay them at original speed(1), scaled(e.g. 60) or as fast as possible(0):
+
+    python -m tools.webhook_replay replay day.jsonl --url http://127.0.0.1:8866 --speed 0 --expect state.json
+
+Events of a room are sent one by one in recorded order, rooms are sent concurrently,
+so rooms switching files at the same time hit the bot at the same time.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import urllib.request
+import uuid
+from collections import defaultdict
+
+import aiohttp
+
+from tools.synthetic import makeEvent
+
+
+def _readEvents(path: str) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return sorted(events, key=lambda event: event['ReceivedAt'])
+
+
+def _freshIds(events: list[dict]) -> dict[str, str]:
+    """ give every session a new id, so a log can be replayed against the same instance again """
+    mapping = defaultdict(lambda: str(uuid.uuid4()))
+    for event in events:
+        data = event['Body']['EventData']
+        data['SessionId'] = mapping[data['SessionId']]
+    return dict(mapping)
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))] if values else 0
+
+
+def _summary(latencies: list[float], errors: int) -> dict:
+    count = len(latencies) + errors
+    return {'count': count, 'errors': errors, 'error_rate': round(errors / count, 4) if count else 0,
+            'p50_ms': round(_percentile(latencies, .5) * 1000, 2),
+            'p99_ms': round(_percentile(latencies, .99) * 1000, 2),
+            'max_ms': round(max(latencies, default=0) * 1000, 2)}
+
+
+async def _replay(events: list[dict], url: str, speed: float, timeout: float) -> dict:
+    rooms = defaultdict(list)
+    for event in events:
+        rooms[event['Body']['EventData']['RoomId']].append(event)
+    first = events[0]['ReceivedAt'] if events else 0
+    latencies, errors, error_samples = defaultdict(list), defaultdict(int), []
+
+    async def room(session: aiohttp.ClientSession, room_events: list[dict]):
+        for event in room_events:
+            if speed > 0:
+                delay = (event['ReceivedAt'] - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            event_type = event['Body'].get('EventType', '')
+            sent = time.monotonic()
+            try:
+                async with session.post(url + '/process', json=event['Body']) as response:
+                    await response.read()
+                    if response.status // 100 != 2:
+                        raise aiohttp.ClientError(f'status code: {response.status}')
+            except Exception as e:
+                errors[event_type] += 1
+                if len(error_samples) < 10:
+                    error_samples.append(f'{event_type}: {e!r}')
+                continue
+            latencies[event_type].append(time.monotonic() - sent)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = time.monotonic()
+        await asyncio.gather(*[room(session, room_events) for room_events in rooms.values()])
+        seconds = time.monotonic() - start
+    types = set(latencies) | set(errors)
+    return {'seconds': round(seconds, 3), 'rooms': len(rooms),
+            'events_per_second': round(len(events) / seconds, 1) if seconds else 0,
+            'total': _summary([value for values in latencies.values() for value in values], sum(errors.values())),
+            'by_type': {event_type: _summary(latencies[event_type], errors[event_type]) for event_type in sorted(types)},
+            'error_samples': error_samples}
+
+
+def _fetchState(url: str, jobs: int = 1000) -> dict:
+    """ :param jobs: how many of the latest processing jobs to include """
+    with urllib.request.urlopen(f'{url}/process/state?jobs={jobs}', timeout=30) as response:
+        return json.loads(response.read())
+
+
+def _backlog(state: dict) -> int:
+    """ events received but not applied yet """
+    events = state.get('events', {})
+    return events.get('pending', 0) + events.get('in_progress', 0)
+
+
+def _expectedSessions(events: list[dict]) -> dict[str, int]:
+    """ sessions still recording after the events, {session id: files} """
+    sessions = {}
+    for event in events:
+        body = event['Body']
+        session_id = body['EventData']['SessionId']
+        if body['EventType'] == 'SessionStarted':
+            sessions.setdefault(session_id, 0)
+        elif body['EventType'] == 'FileOpening':
+            sessions[session_id] = sessions.get(session_id, 0) + 1
+        elif body['EventType'] == 'SessionEnded':
+            sessions.pop(session_id, None)
+    return sessions
+
+
+def _compare(events: list[dict], state: dict, expected_state: dict = None, ids: dict[str, str] = None) -> list[str]:
+    """ differences between the state after replaying and what the events(and the recorded state) imply """
+    replayed = {event['Body']['EventData']['SessionId'] for event in events}
+    problems = []
+    actual = {session['session_id']: session['files'] for session in state['sessions']
+              if session['session_id'] in replayed}
+    for session_id, files in _expectedSessions(events).items():
+        if actual.pop(session_id, None) != files:
+            problems.append(f'session {session_id} should be recording with {files} files')
+    problems += [f'session {session_id} should have ended' for session_id in actual]
+    if expected_state is None:
+        return problems
+    ids = ids or {}
+    for section, fields in (('sessions', ('room_id', 'files')), ('jobs', ('room_id', 'stage', 'state')),
+                            ('uploads', ('room_id', 'state'))):
+        expected = {ids.get(item['session_id'], item['session_id']): tuple(item[field] for field in fields)
+                    for item in expected_state[section]}
+        expected = {session_id: value for session_id, value in expected.items() if session_id in replayed}
+        got = {item['session_id']: tuple(item[field] for field in fields) for item in state[section]
+               if item['session_id'] in replayed}
+        for session_id in expected.keys() | got.keys():
+            if expected.get(session_id) != got.get(session_id):
+                problems.append(f'{section} {session_id}: expected {expected.get(session_id)}, '
+                                f'got {got.get(session_id)}')
+    return problems
+
+
+def replay(args) -> dict:
+    events = _readEvents(args.events)
+    ids = _freshIds(events) if args.fresh_ids else None
+    result = asyncio.run(_replay(events, args.url.rstrip('/'), args.speed, args.timeout))
+    # events are applied in the background, wait until the bot has caught up
+    deadline = time.monotonic() + args.settle
+    # the replayed sessions are the latest jobs
+    jobs = len({event['Body']['EventData']['SessionId'] for event in events})
+    state = _fetchState(args.url.rstrip('/'), jobs)
+    while _backlog(state) and time.monotonic() < deadline:
+        time.sleep(0.2)
+        state = _fetchState(args.url.rstrip('/'), jobs)
+    expected_state = None
+    if args.expect:
+        with open(args.expect, 'r', encoding='utf-8') as f:
+            expected_state = json.load(f)
+    problems = _compare(events, state, expected_state, ids)
+    return {**result, 'backlog': _backlog(state), 'state_matches': not problems, 'state_problems': problems[:50]}
+
+
+def generate(args) -> list[dict]:
+    """ rooms start together and switch files at the same time, the worst case for the /process endpoint """
+    events, start = [], time.time()
+    for room_id in range(args.first_room, args.first_room + args.rooms):
+        session_id = str(uuid.uuid4())
+        offset = (room_id - args.first_room) * args.stagger
+        events.append({'ReceivedAt': start + offset, 'Body': makeEvent('SessionStarted', room_id, session_id)})
+        for index in range(args.segments):
+            events.append({'ReceivedAt': start + offset + index * args.segment_seconds + 0.01,
+                           'Body': makeEvent('FileOpening', room_id, session_id,
+                                             f'{room_id}/record-{index:03d}.flv')})
+        if not args.keep_recording:
+            events.append({'ReceivedAt': start + offset + args.segments * args.segment_seconds,
+                           'Body': makeEvent('SessionEnded', room_id, session_id)})
+    return sorted(events, key=lambda event: event['ReceivedAt'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    replay_parser = sub.add_parser('replay', help='replay captured webhooks')
+    replay_parser.add_argument('events', help='JSONL file captured by the bot or generated')
+    replay_parser.add_argument('--speed', type=float, default=1, help='1 for original speed, 0 for as fast as possible')
+    replay_parser.add_argument('--fresh-ids', action='store_true', help='replace session ids with new ones')
+    replay_parser.add_argument('--expect', help='state saved by the snapshot command to compare with')
+    replay_parser.add_argument('--settle', type=float, default=30,
+                               help='seconds to wait for the bot to apply the events before reading the state')
+    replay_parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each request')
+    snapshot_parser = sub.add_parser('snapshot', help='save sessions, jobs and uploads of an instance')
+    snapshot_parser.add_argument('--jobs', type=int, default=1000, help='latest processing jobs to save')
+    for sub_parser in (replay_parser, snapshot_parser):
+        sub_parser.add_argument('--url', default='http://127.0.0.1:8866', help='address of the bot')
+        sub_parser.add_argument('--output', help='write json to this file instead of stdout')
+    generate_parser = sub.add_parser('generate', help='generate webhooks of a synthetic day')
+    generate_parser.add_argument('--rooms', type=int, default=20)
+    generate_parser.add_argument('--first-room', type=int, default=1000)
+    generate_parser.add_argument('--segments', type=int, default=4, help='files per session')
+    generate_parser.add_argument('--segment-seconds', type=float, default=3600)
+    generate_parser.add_argument('--stagger', type=float, default=0, help='seconds between rooms starting')
+    generate_parser.add_argument('--keep-recording', action='store_true', help='leave sessions unended')
+    generate_parser.add_argument('--output', help='write JSONL to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        lines = [json.dumps(event, ensure_ascii=False) for event in generate(args)]
+        output = '\n'.join(lines) + '\n'
+    elif args.command == 'snapshot':
+        output = json.dumps(_fetchState(args.url.rstrip('/'), args.jobs), indent=2, ensure_ascii=False)
+    else:
+        output = json.dumps(replay(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
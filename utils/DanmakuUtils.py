@@ -0,0 +1,419 @@
+""" Streaming danmaku converter for BililiveRecorder xml files.
+
+Comments are read with an incremental iterparse and written to ass one by one,
+so memory stays flat no matter how many comments a file has. Layout and merging need comments in time order,
+a file found out of order(e.g. after the recorder reconnected) is read again and sorted in memory.
+"""
+import heapq
+import logging
+import re
+import unicodedata
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional, TextIO
+from xml.sax.saxutils import escape, quoteattr
+
+from lxml import etree
+
+logger = logging.getLogger('bililive-uploader')
+
+MODE_SCROLL = (1, 2, 3)
+MODE_BOTTOM = 4
+MODE_TOP = 5
+
+# comments repeated in adjacent segments within this window(seconds) are dropped when merging
+DEDUP_WINDOW = 10
+
+
+@dataclass(slots=True)
+class Danmaku:
+    """ a comment
+
+    Attributes:
+        time: 出现时间(秒, 相对于视频开始)
+        mode: 弹幕类型(1滚动 4底部 5顶部)
+        size: 字号
+        color: 颜色(RGB)
+        timestamp: 发送时间(unix毫秒)
+        uid: 用户id
+        text: 内容
+        user: 用户名
+    """
+    time: float
+    mode: int
+    size: int
+    color: int
+    timestamp: int
+    uid: str
+    text: str
+    user: str = ''
+
+    def __lt__(self, other: 'Danmaku') -> bool:
+        return self.time < other.time
+
+
+@dataclass
+class AssStyle:
+    """ style of converted danmaku
+
+    Attributes:
+        font: 字体
+        fontsize: 字号
+        density: 同屏最大弹幕数, 0为不限制
+        duration: 滚动弹幕持续时间(秒)
+        fixed_duration: 顶部/底部弹幕持续时间(秒)
+        opacity: 不透明度(0-1)
+        width: 视频宽度
+        height: 视频高度
+    """
+    font: str = 'Microsoft YaHei'
+    fontsize: int = 55
+    density: int = 50
+    duration: float = 12
+    fixed_duration: float = 5
+    opacity: float = 0.8
+    width: int = 1920
+    height: int = 1080
+
+
+def readDanmakus(path: str, offset: float = 0) -> Iterator[Danmaku]:
+    """ read comments from a BililiveRecorder xml file
+
+    :param path: xml file
+    :param offset: seconds added to every comment
+    :return: comments in file order
+    """
+    context = etree.iterparse(path, events=('end',), tag='d', recover=True, huge_tree=True)
+    for _, element in context:
+        danmaku = _parse(element, offset)
+        # free parsed elements, otherwise the whole tree stays in memory
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if danmaku is not None:
+            yield danmaku
+    del context
+
+
+def _parse(element, offset: float) -> Optional[Danmaku]:
+    attributes = element.get('p', '').split(',')
+    if len(attributes) < 4 or not element.text:
+        return None
+    try:
+        return Danmaku(time=float(attributes[0]) + offset, mode=int(attributes[1]), size=int(attributes[2]),
+                       color=int(attributes[3]),
+                       timestamp=int(attributes[4]) if len(attributes) > 4 and attributes[4].isdigit() else 0,
+                       uid=element.get('uid') or (attributes[6] if len(attributes) > 6 else ''),
+                       text=element.text, user=element.get('user', ''))
+    except ValueError:
+        return None
+
+
+class _OutOfOrder(Exception):
+    """ comments of a file are not in time order """
+
+
+def _inOrder(danmakus: Iterator[Danmaku]) -> Iterator[Danmaku]:
+    """ pass comments through, raise _OutOfOrder at the first one earlier than the previous """
+    last = float('-inf')
+    for danmaku in danmakus:
+        if danmaku.time < last:
+            raise _OutOfOrder
+        last = danmaku.time
+        yield danmaku
+
+
+def _read(path: str, offset: float, sort: bool) -> Iterator[Danmaku]:
+    """ comments sorted by time, read into memory if sort is set, otherwise streamed and checked """
+    if sort:
+        return iter(sorted(readDanmakus(path, offset), key=lambda danmaku: danmaku.time))
+    return _inOrder(readDanmakus(path, offset))
+
+
+def mergeDanmakus(sources: list[tuple[str, float]], window: float = DEDUP_WINDOW,
+                  sort: bool = False) -> Iterator[Danmaku]:
+    """ k-way merge comments of several segments into one stream
+
+    Memory is bounded by the number of segments and the dedup window, not by file sizes.
+
+    :param sources: [(xml, offset)], offset is the start of the segment in the merged video(seconds)
+    :param window: comments sent again by an adjacent segment within this window are dropped
+    :param sort: sort every file in memory first, otherwise _OutOfOrder is raised for a file out of order
+    :return: comments sorted by rebased time
+    """
+    streams = [_tagged(_read(path, offset, sort), source) for source, (path, offset) in enumerate(sources)]
+    recent: dict[tuple, tuple[float, int]] = {}  # key: (time, source)
+    expiry: deque[tuple[float, tuple]] = deque()
+    dropped = 0
+    for danmaku, source in heapq.merge(*streams, key=lambda item: item[0].time):
+        while expiry and expiry[0][0] < danmaku.time - window:
+            time, key = expiry.popleft()
+            if recent.get(key, (None,))[0] == time:
+                del recent[key]
+        key = (danmaku.timestamp, danmaku.uid, danmaku.mode, danmaku.text)
+        if key in recent and recent[key][1] != source:
+            dropped += 1
+            continue
+        recent[key] = (danmaku.time, source)
+        expiry.append((danmaku.time, key))
+        yield danmaku
+    if dropped:
+        logger.debug('Dropped %d duplicated danmakus at segment boundaries.', dropped)
+
+
+def _tagged(danmakus: Iterator[Danmaku], source: int) -> Iterator[tuple[Danmaku, int]]:
+    for danmaku in danmakus:
+        yield danmaku, source
+
+
+def writeXml(danmakus: Iterable[Danmaku], output: TextIO) -> int:
+    """ write comments as a BililiveRecorder style xml file
+
+    :return: number of comments written
+    """
+    output.write('<?xml version="1.0" encoding="utf-8"?>\n<i>\n<chatserver>chat.bilibili.com</chatserver>\n')
+    count = 0
+    for danmaku in danmakus:
+        attributes = f'{danmaku.time:.3f},{danmaku.mode},{danmaku.size},{danmaku.color},{danmaku.timestamp},0,' \
+                     f'{danmaku.uid},0'
+        output.write(f'<d p="{attributes}" uid={quoteattr(danmaku.uid)} user={quoteattr(danmaku.user)}>'
+                     f'{escape(danmaku.text)}</d>\n')
+        count += 1
+    output.write('</i>\n')
+    return count
+
+
+def mergeXml(sources: list[tuple[str, float]], output: str) -> int:
+    """ merge xml files of several segments into one
+
+    :param sources: [(xml, offset)]
+    :param output: merged xml file
+    :return: number of comments written
+    """
+    with open(output, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        try:
+            return writeXml(mergeDanmakus(sources), f)
+        except _OutOfOrder:
+            logger.debug('Danmakus are out of order, sorting before merging.')
+            f.seek(0)
+            f.truncate()
+            return writeXml(mergeDanmakus(sources, sort=True), f)
+
+
+def textWidth(text: str, fontsize: int) -> float:
+    """ estimated rendered width, full-width characters take a whole em """
+    width = 0
+    for char in text:
+        width += 1 if unicodedata.east_asian_width(char) in ('W', 'F') else 0.55
+    return width * fontsize
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '＼').replace('{', '｛').replace('}', '｝').replace('\r', '').replace('\n', '\\N')
+
+
+def _time(seconds: float) -> str:
+    centiseconds = int(round(max(seconds, 0) * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f'{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}'
+
+
+class _Layout:
+    """ assigns each comment a row without overlapping those already on screen """
+
+    def __init__(self, style: AssStyle):
+        self.style = style
+        self.line_height = style.fontsize + 4
+        rows = max(1, style.height // self.line_height)
+        # scroll rows: (start time, width, speed) of the last comment
+        self.scroll: list[Optional[tuple[float, float, float]]] = [None] * rows
+        # fixed rows: time when the row is free again
+        self.top = [0.0] * rows
+        self.bottom = [0.0] * rows
+        self.on_screen: list[float] = []  # end times, min heap
+
+    def place(self, danmaku: Danmaku, width: float) -> Optional[int]:
+        """ find a row for the comment, None if it should be dropped """
+        now = danmaku.time
+        while self.on_screen and self.on_screen[0] <= now:
+            heapq.heappop(self.on_screen)
+        if self.style.density and len(self.on_screen) >= self.style.density:
+            return None
+        if danmaku.mode in MODE_SCROLL:
+            row, end = self._scroll_row(now, width), now + self.style.duration
+        elif danmaku.mode in (MODE_TOP, MODE_BOTTOM):
+            rows = self.top if danmaku.mode == MODE_TOP else self.bottom
+            row = next((i for i, free in enumerate(rows) if free <= now), None)
+            end = now + self.style.fixed_duration
+            if row is not None:
+                rows[row] = end
+        else:  # advanced and code comments are not supported
+            return None
+        if row is not None:
+            heapq.heappush(self.on_screen, end)
+        return row
+
+    def _scroll_row(self, now: float, width: float) -> Optional[int]:
+        screen, duration = self.style.width, self.style.duration
+        speed = (screen + width) / duration
+        for row, last in enumerate(self.scroll):
+            if last is not None:
+                start, last_width, last_speed = last
+                # the last comment must have fully entered the screen
+                if now < start + last_width / last_speed:
+                    continue
+                # and must not be caught up before it leaves
+                if speed > last_speed and now + screen / speed < start + duration:
+                    continue
+            self.scroll[row] = (now, width, speed)
+            return row
+        return None
+
+
+def _header(style: AssStyle) -> str:
+    alpha = f'{int(round((1 - style.opacity) * 255)):02X}'
+    return (
+        '[Script Info]\n'
+        'ScriptType: v4.00+\n'
+        'Collisions: Normal\n'
+        f'PlayResX: {style.width}\n'
+        f'PlayResY: {style.height}\n'
+        'WrapStyle: 2\n'
+        'ScaledBorderAndShadow: yes\n'
+        '\n'
+        '[V4+ Styles]\n'
+        'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, '
+        'Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, '
+        'MarginL, MarginR, MarginV, Encoding\n'
+        f'Style: Danmaku,{style.font},{style.fontsize},&H{alpha}FFFFFF,&H{alpha}FFFFFF,&H{alpha}000000,'
+        f'&H{alpha}000000,1,0,0,0,100,100,0,0,1,1,0,7,0,0,0,1\n'
+        '\n'
+        '[Events]\n'
+        'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n'
+    )
+
+
+def writeAss(danmakus: Iterable[Danmaku], output: TextIO, style: AssStyle) -> int:
+    """ lay out comments and write them as ass events
+
+    :param danmakus: comments sorted by time
+    :param output: text stream to write to
+    :param style:
+    :return: number of events written
+    """
+    layout = _Layout(style)
+    output.write(_header(style))
+    count = 0
+    for danmaku in danmakus:
+        width = textWidth(danmaku.text, style.fontsize)
+        row = layout.place(danmaku, width)
+        if row is None:
+            continue
+        y = row * layout.line_height
+        if danmaku.mode in MODE_SCROLL:
+            end = danmaku.time + style.duration
+            position = f'\\move({style.width},{y},{-int(width)},{y})'
+        elif danmaku.mode == MODE_TOP:
+            end = danmaku.time + style.fixed_duration
+            position = f'\\an8\\pos({style.width // 2},{y})'
+        else:
+            end = danmaku.time + style.fixed_duration
+            position = f'\\an2\\pos({style.width // 2},{style.height - y})'
+        color = danmaku.color & 0xFFFFFF
+        if color != 0xFFFFFF:
+            position += f'\\c&H{color & 0xFF:02X}{color >> 8 & 0xFF:02X}{color >> 16:02X}&'
+        output.write(f'Dialogue: 0,{_time(danmaku.time)},{_time(end)},Danmaku,,0,0,0,,'
+                     f'{{{position}}}{_escape(danmaku.text)}\n')
+        count += 1
+    return count
+
+
+def _parseTime(text: str) -> float:
+    hours, minutes, seconds = text.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+_MOVE = re.compile(r'\\move\((-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\)')
+
+
+def _rebase(line: str, start: float, end: float, offset: float) -> str:
+    """ shift a dialogue to start at offset, events already running at offset continue where they are """
+    fields = line.split(',', 9)
+    if start < offset:
+        progress = (offset - start) / (end - start)
+
+        def move(match: re.Match) -> str:
+            x1, y1, x2, y2 = (float(value) for value in match.groups())
+            return f'\\move({round(x1 + (x2 - x1) * progress)},{round(y1 + (y2 - y1) * progress)},' \
+                   f'{round(x2)},{round(y2)})'
+        fields[9] = _MOVE.sub(move, fields[9], count=1)
+    fields[1], fields[2] = _time(max(start - offset, 0)), _time(end - offset)
+    return ','.join(fields)
+
+
+def splitAss(ass: str, outputs: list[tuple[str, float]]):
+    """ split an ass file into chunks of the video, with event times rebased on each chunk
+
+    Events spanning a boundary are kept in both chunks, moving comments resume at the position
+    they reached, so the chunks join without visible seams.
+
+    :param ass: ass file
+    :param outputs: [(output, start)] sorted by start, each chunk ends where the next one starts
+    """
+    starts = [start for _, start in outputs] + [float('inf')]
+    files = [open(output, 'w', encoding='utf-8-sig', buffering=1 << 20) for output, _ in outputs]
+    try:
+        with open(ass, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                if not line.startswith('Dialogue:'):
+                    for file in files:
+                        file.write(line)
+                    continue
+                fields = line.split(',', 3)
+                start, end = _parseTime(fields[1]), _parseTime(fields[2])
+                for i, file in enumerate(files):
+                    if start < starts[i + 1] and end > starts[i]:
+                        file.write(_rebase(line, start, end, starts[i]))
+    finally:
+        for file in files:
+            file.close()
+
+
+def assIntervals(ass: str, gap: float = 0) -> list[tuple[float, float]]:
+    """ time ranges of an ass file with events on screen
+
+    :param ass: ass file
+    :param gap: ranges less than gap seconds apart are merged
+    :return: [(start, end)] sorted and not overlapping
+    """
+    events = []
+    with open(ass, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            if line.startswith('Dialogue:'):
+                fields = line.split(',', 3)
+                events.append((_parseTime(fields[1]), _parseTime(fields[2])))
+    events.sort()
+    intervals = []
+    for start, end in events:
+        if intervals and start <= intervals[-1][1] + gap:
+            intervals[-1] = (intervals[-1][0], max(intervals[-1][1], end))
+        else:
+            intervals.append((start, end))
+    return intervals
+
+
+def convertXml2Ass(xml: str, ass: str, style: AssStyle) -> int:
+    """ convert a BililiveRecorder xml file to ass
+
+    :return: number of events written
+    """
+    with open(ass, 'w', encoding='utf-8-sig', buffering=1 << 20) as output:
+        try:
+            return writeAss(_read(xml, 0, sort=False), output, style)
+        except _OutOfOrder:
+            logger.debug('Danmakus of %s are out of order, sorting before layout.', xml)
+            output.seek(0)
+            output.truncate()
+            return writeAss(_read(xml, 0, sort=True), output, style)
@@ -1,14 +1,25 @@
+import hashlib
 import json
 import os
-from shutil import copy, rmtree
-from typing import Tuple
+import sys
+from shutil import copy, copyfile, rmtree
+from typing import Optional, Tuple
 
 import yaml
 
+# libyaml parser when available, several times faster than the pure python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+if sys.platform == 'linux':
+    import fcntl
+
+FICLONE = 0x40049409
+STAGE_METHODS = ('hardlink', 'reflink', 'copy_file_range', 'copy')
+
 
 def readYml(path: str) -> dict:
     with open(path, 'r', encoding='utf-8') as f:
-        result = yaml.load(f.read(), Loader=yaml.Loader)
+        result = yaml.load(f, Loader=YAML_LOADER)
     return result
 
 
@@ -79,3 +90,88 @@ def renameFile(file: str, new_name: str):
 def renameFiles(files: list[Tuple[str, str]]):
     for file, new_name in files:
         renameFile(file, new_name)
+
+
+def sampleHash(file: str, block=1 << 20) -> str:
+    """ hash of file size and sampled blocks(head, middle, tail), cheap enough for multi-GB videos """
+    size = os.path.getsize(file)
+    sha1 = hashlib.sha1(str(size).encode())
+    with open(file, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - block // 2, 0), max(size - block, 0)}):
+            f.seek(offset)
+            sha1.update(f.read(block))
+    return sha1.hexdigest()
+
+
+def stageFile(file: str, target: str) -> Optional[str]:
+    """ make file available at target, avoiding data copies where the filesystem allows it
+
+    Tries hardlink and reflink on the same device, then falls back to copying. The source is left in place.
+    Target either doesn't exist or is complete, so an interrupted staging can simply be retried.
+
+    :param file: source file
+    :param target: target file
+    :return: the method used(see STAGE_METHODS), None if the source doesn't exist
+    """
+    if not os.path.exists(file):
+        return None
+    same_device = os.stat(file).st_dev == os.stat(os.path.dirname(os.path.abspath(target))).st_dev
+    if same_device:
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(file, target)
+            return 'hardlink'
+        except OSError:  # filesystem without hardlinks, or link count limit
+            pass
+    temp = target + '.part'
+    try:
+        method = _cloneFile(file, temp, same_device)
+        os.replace(temp, target)
+        return method
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def _cloneFile(file: str, target: str, same_device: bool) -> str:
+    with open(file, 'rb') as src, open(target, 'wb') as dst:
+        if sys.platform == 'linux':
+            if same_device:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return 'reflink'
+                except OSError:  # filesystem without reflink support
+                    pass
+            try:
+                # copied in kernel, shared extents are used when the filesystem supports it
+                size, offset = os.fstat(src.fileno()).st_size, 0
+                while offset < size:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                return 'copy_file_range'
+            except OSError:  # old kernel, or not supported between these filesystems
+                dst.truncate(0)
+    copyfile(file, target)
+    return 'copy'
+
+
+def stageFiles(files: list[Tuple[str, str]]) -> dict[str, int]:
+    """ stage files, see stageFile
+
+    A missing source whose target already exists is skipped, the target is kept.
+
+    :param files: [(file, target)]
+    :return: {method: bytes}, including 'missing' for sources that are not found
+    """
+    result = {}
+    for file, target in files:
+        if not os.path.exists(file) and os.path.exists(target):
+            method = 'staged'
+        else:
+            method = stageFile(file, target) or 'missing'
+        size = os.path.getsize(target) if os.path.exists(target) else 0
+        result[method] = result.get(method, 0) + size
+    return result
@@ -0,0 +1,256 @@
+""" Streaming FLV parser.
+
+Walks tag headers without reading payloads (only the first bytes of audio/video tags, which hold
+codec, frame type and the h264 profile of sequence headers), so indexing a multi-GB record takes
+milliseconds to seconds instead of spawning ffmpeg.
+"""
+import bisect
+import functools
+import os
+import struct
+from io import BytesIO
+from dataclasses import dataclass, field
+from typing import BinaryIO, Optional
+
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+TAG_HEADER_SIZE = 11
+
+VIDEO_CODECS = {2: 'h263', 3: 'screen', 4: 'vp6', 5: 'vp6a', 6: 'screen2', 7: 'h264', 12: 'hevc'}
+AUDIO_CODECS = {0: 'pcm', 1: 'adpcm', 2: 'mp3', 3: 'pcm_le', 10: 'aac', 11: 'speex'}
+
+# timestamp jumps larger than this(ms) are reported as discontinuities
+DISCONTINUITY_THRESHOLD = 5000
+MAX_WARNINGS = 100
+
+
+@dataclass
+class FlvIndex:
+    """ index of a flv file
+
+    Attributes:
+        path: 文件路径
+        duration: 时长(秒)
+        start: 第一个音视频tag的时间戳(秒)
+        keyframe_times: 关键帧时间(秒, 相对于start)
+        keyframe_positions: 关键帧tag在文件中的偏移
+        video_codec: 视频编码
+        audio_codec: 音频编码
+        avc_profile: h264序列头中的profile_idc
+        avc_level: h264序列头中的level_idc
+        metadata: onMetaData
+        warnings: 时间戳不连续等警告
+    """
+    path: str
+    duration: float = 0
+    start: float = 0
+    keyframe_times: list[float] = field(default_factory=list)
+    keyframe_positions: list[int] = field(default_factory=list)
+    video_codec: Optional[str] = None
+    audio_codec: Optional[str] = None
+    avc_profile: Optional[int] = None
+    avc_level: Optional[int] = None
+    metadata: dict = field(default_factory=dict)
+    warnings: list[str] = field(default_factory=list)
+
+    width = property(lambda self: int(self.metadata.get('width', 0)))
+    height = property(lambda self: int(self.metadata.get('height', 0)))
+    framerate = property(lambda self: float(self.metadata.get('framerate', 0)))
+
+    def keyframe_before(self, time: float) -> float:
+        """ time of the last keyframe at or before time, 0 if none """
+        i = bisect.bisect_right(self.keyframe_times, time)
+        return self.keyframe_times[i - 1] if i > 0 else 0
+
+    def keyframe_after(self, time: float) -> float:
+        """ time of the first keyframe at or after time, duration if none """
+        i = bisect.bisect_left(self.keyframe_times, time)
+        return self.keyframe_times[i] if i < len(self.keyframe_times) else self.duration
+
+
+def _readAmf(stream: BinaryIO):
+    """ read an AMF0 value """
+    marker = stream.read(1)
+    if not marker:
+        raise EOFError
+    marker = marker[0]
+    if marker == 0:  # number
+        return struct.unpack('>d', stream.read(8))[0]
+    if marker == 1:  # boolean
+        return stream.read(1) != b'\x00'
+    if marker == 2:  # string
+        return _readAmfString(stream)
+    if marker == 3:  # object
+        return _readAmfProperties(stream)
+    if marker in (5, 6):  # null, undefined
+        return None
+    if marker == 8:  # ecma array
+        stream.read(4)
+        return _readAmfProperties(stream)
+    if marker == 10:  # strict array
+        count = struct.unpack('>I', stream.read(4))[0]
+        return [_readAmf(stream) for _ in range(count)]
+    if marker == 11:  # date
+        timestamp = struct.unpack('>d', stream.read(8))[0]
+        stream.read(2)
+        return timestamp
+    if marker == 12:  # long string
+        length = struct.unpack('>I', stream.read(4))[0]
+        return stream.read(length).decode('utf-8', 'replace')
+    raise ValueError(f'Unsupported AMF0 marker: {marker}')
+
+
+def _readAmfString(stream: BinaryIO) -> str:
+    length = struct.unpack('>H', stream.read(2))[0]
+    return stream.read(length).decode('utf-8', 'replace')
+
+
+def _readAmfProperties(stream: BinaryIO) -> dict:
+    result = {}
+    while True:
+        key = _readAmfString(stream)
+        if not key:
+            if stream.read(1) in (b'\x09', b''):  # object end
+                return result
+            continue
+        result[key] = _readAmf(stream)
+
+
+def _parseMetadata(payload: bytes) -> dict:
+    stream = BytesIO(payload)
+    try:
+        if _readAmf(stream) != 'onMetaData':
+            return {}
+        metadata = _readAmf(stream)
+    except (EOFError, ValueError, struct.error, IndexError):
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def _readHeader(f: BinaryIO) -> Optional[tuple[int, int, int]]:
+    """ read a tag header, return (type, data size, timestamp) """
+    header = f.read(TAG_HEADER_SIZE)
+    if len(header) < TAG_HEADER_SIZE:
+        return None
+    tag_type = header[0] & 0x1f
+    data_size = int.from_bytes(header[1:4], 'big')
+    timestamp = int.from_bytes(header[4:7], 'big') | header[7] << 24
+    return tag_type, data_size, timestamp
+
+
+def _openBody(path: str) -> BinaryIO:
+    f = open(path, 'rb')
+    header = f.read(9)
+    if len(header) < 9 or header[:3] != b'FLV':
+        f.close()
+        raise ValueError(f'{path} is not a flv file.')
+    f.seek(int.from_bytes(header[5:9], 'big') + 4)  # skip PreviousTagSize0
+    return f
+
+
+def readMetadata(path: str) -> dict:
+    """ read onMetaData of a flv file """
+    with _openBody(path) as f:
+        while (header := _readHeader(f)) is not None:
+            tag_type, data_size, _ = header
+            if tag_type == TAG_SCRIPT:
+                return _parseMetadata(f.read(data_size))
+            if tag_type in (TAG_AUDIO, TAG_VIDEO):
+                return {}
+            f.seek(data_size + 4, os.SEEK_CUR)
+    return {}
+
+
+def scan(path: str) -> FlvIndex:
+    """ walk all tags of a flv file, results are cached by (path, size, mtime) """
+    stat = os.stat(path)
+    return _scan(path, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=256)
+def _scan(path: str, size: int, _mtime: int) -> FlvIndex:
+    index = FlvIndex(path=path)
+    first, last = None, {TAG_AUDIO: None, TAG_VIDEO: None}
+    end = 0
+    with _openBody(path) as f:
+        while True:
+            position = f.tell()
+            header = _readHeader(f)
+            if header is None:
+                break
+            tag_type, data_size, timestamp = header
+            if position + TAG_HEADER_SIZE + data_size > size:
+                _warn(index, f'Truncated tag at byte {position}.')
+                break
+            if tag_type == TAG_SCRIPT:
+                if not index.metadata:
+                    index.metadata = _parseMetadata(f.read(data_size))
+                    f.seek(4, os.SEEK_CUR)
+                    continue
+            elif tag_type in (TAG_AUDIO, TAG_VIDEO) and data_size > 0:
+                # flags, AVCPacketType, composition time, then AVCDecoderConfigurationRecord for sequence headers
+                head = f.read(min(data_size, 9))
+                flags = head[0]
+                f.seek(data_size - len(head) + 4, os.SEEK_CUR)
+                if first is None:
+                    first = timestamp
+                previous = last[tag_type]
+                if previous is not None and not 0 <= timestamp - previous <= DISCONTINUITY_THRESHOLD:
+                    _warn(index, f'Timestamp jumps from {previous}ms to {timestamp}ms at byte {position}.')
+                last[tag_type] = timestamp
+                end = max(end, timestamp)
+                if tag_type == TAG_VIDEO:
+                    index.video_codec = index.video_codec or VIDEO_CODECS.get(flags & 0x0f, str(flags & 0x0f))
+                    if flags & 0x0f == 7 and len(head) == 9 and head[1] == 0 and index.avc_profile is None:
+                        index.avc_profile, index.avc_level = head[6], head[8]
+                    if flags >> 4 == 1:  # keyframe
+                        index.keyframe_times.append((timestamp - first) / 1000)
+                        index.keyframe_positions.append(position)
+                else:
+                    index.audio_codec = index.audio_codec or AUDIO_CODECS.get(flags >> 4, str(flags >> 4))
+                continue
+            f.seek(data_size + 4, os.SEEK_CUR)
+    if first is not None:
+        index.start = first / 1000
+        index.duration = (end - first) / 1000
+    return index
+
+
+def _warn(index: FlvIndex, warning: str):
+    if len(index.warnings) < MAX_WARNINGS:
+        index.warnings.append(warning)
+
+
+def getDuration(path: str) -> float:
+    """ duration of a flv file in seconds
+
+    Only the first and the last tag are read when the file ends properly,
+    otherwise falls back to a full scan.
+    """
+    stat = os.stat(path)
+    return _getDuration(path, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _getDuration(path: str, size: int, mtime: int) -> float:
+    with _openBody(path) as f:
+        first = None
+        while (header := _readHeader(f)) is not None:
+            tag_type, data_size, timestamp = header
+            if tag_type in (TAG_AUDIO, TAG_VIDEO):
+                first = timestamp
+                break
+            f.seek(data_size + 4, os.SEEK_CUR)
+        if first is None:
+            return 0
+        f.seek(size - 4)
+        tag_size = int.from_bytes(f.read(4), 'big')
+        if TAG_HEADER_SIZE < tag_size < size:
+            f.seek(size - 4 - tag_size)
+            header = _readHeader(f)
+            if header and header[0] in (TAG_AUDIO, TAG_VIDEO) \
+                    and header[1] + TAG_HEADER_SIZE == tag_size:
+                return (header[2] - first) / 1000
+    # the file didn't end properly, e.g. recorder crashed
+    return _scan(path, size, mtime).duration
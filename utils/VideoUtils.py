@@ -1,15 +1,13 @@
 import os.path
-from moviepy.editor import VideoFileClip
 
+from . import FlvUtils
 
-def getVideoTime(video: str) -> int:
-    video_clip = VideoFileClip(video)
-    duration = video_clip.duration
-    video_clip.close()
-    return duration
 
+def getVideoTime(video: str) -> float:
+    return FlvUtils.getDuration(video)
 
-def getTotalTime(videos: list[str]) -> int:
+
+def getTotalTime(videos: list[str]) -> float:
     result = 0
     for video in videos:
         if os.path.exists(video):